@@ -88,6 +88,11 @@ class AccountDAO(db.RippleDAO):
         Must then set upper, lower limits and effective,
         expiry times before flushing to db.
         """
+        if self.data_obj.id is not None:
+            # serialize with payment commits checking these limits
+            db.execute(sql.select([account_table.c.id],
+                                  account_table.c.id == self.data_obj.id,
+                                  for_update=True))
         if self.limits:
             self.limits.is_active = False
             old_limits = self.limits
@@ -100,8 +105,9 @@ class AccountDAO(db.RippleDAO):
             attrs_to_copy.remove('effective_time')
             for attr in attrs_to_copy:
                 setattr(self.limits, attr, getattr(old_limits, attr))
-        # *** may be outstanding transactions using old limits
-        # *** must guard against this when committing transaction!
+        # Outstanding transactions using old limits are guarded against
+        # by the account row lock above: payment commits lock the same
+        # rows before checking limits.
     
     def __setattr__(self, attr, value):
         if attr in self.limits_map:
@@ -0,0 +1,213 @@
+"""
+Compact credit graph store: edges and their credit limits in flat arrays (CSR), for
+MetricAccessObject.
+"""
+
+##################
+# Copyright 2008, Jevgenij Solovjov
+#
+# This file is part of Ripplebase.
+#
+# Ripplebase is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ripplebase is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with Ripplebase, in the file LICENSE.txt.  If not,
+# see <http://www.gnu.org/licenses/>.
+##################
+
+from array import array
+from bisect import bisect_left
+from operator import itemgetter
+
+class CreditGraph(object):
+    """
+    Edges (edge_id, src, dest, credit_limit) in compressed sparse row form. Node ids
+    are kept in the sorted node_ids array, and are interned to their positions in it
+    (found by bisection - no per-node dict). Outgoing edges of the node at position
+    i occupy positions offsets[i]..offsets[i + 1] - 1 of:
+
+        targets      - positions of the destination nodes, ascending
+        capacities   - credit limits; MetricAccessObject stores fixed-point
+                       integers, kept in a machine-word array. A value that
+                       does not fit (or is not an integer) turns it into a
+                       list.
+        edge_ids     - metrix_table ids
+
+    Edges are found by edge id through sorted_edge_ids / edge_positions.
+
+    Changes made after construction (set_edge, remove_edge) are kept aside: removed
+    edges are flagged in 'removed', new ones (and edges that changed endpoints) go
+    to a small dict overlay, by edge id. Once the overlay grows, build a new graph
+    with compacted().
+
+    Where several edges join the same two nodes, credit_limit() gives the limit of
+    the one with the lowest id - among the overlay edges, if there are any - and
+    neighbors() lists the destination once.
+    """
+    def __init__(self, edges):
+        # parallel edges in id order, so that the lowest id comes first
+        edges = sorted([tuple(edge[:4]) for edge in edges], key = itemgetter(1, 2, 0))
+        nodes = set([edge[1] for edge in edges])
+        nodes.update([edge[2] for edge in edges])
+        self.node_ids = array('i', sorted(nodes))
+        n = len(self.node_ids)
+        self.offsets = array('i', [0]) * (n + 1)
+        self.targets = array('i')
+        capacities = []
+        self.edge_ids = array('i')
+        for edgeID, src, dest, capacity in edges:
+            self.offsets[self._position(src) + 1] += 1
+            self.targets.append(self._position(dest))
+            capacities.append(capacity)
+            self.edge_ids.append(edgeID)
+        try:
+            self.capacities = array('l', capacities)
+        except (OverflowError, TypeError):
+            self.capacities = capacities
+        for i in xrange(n):
+            self.offsets[i + 1] += self.offsets[i]
+        order = sorted(xrange(len(self.edge_ids)), key = self.edge_ids.__getitem__)
+        self.sorted_edge_ids = array('i', [self.edge_ids[pos] for pos in order])
+        self.edge_positions = array('i', order)
+        self.removed = array('b', [0]) * len(self.edge_ids)
+        self.added = {}         # {<src>: {<dest>: {<edge id>: <credit limit>}}}
+        self.added_edges = {}   # {<edge id>: (<src>, <dest>)}
+
+    def _position(self, node_id):
+        i = bisect_left(self.node_ids, node_id)
+        if i < len(self.node_ids) and self.node_ids[i] == node_id:
+            return i
+        return None
+
+    def _edge_position(self, src, dest):
+        i = self._position(src)
+        j = self._position(dest)
+        if i is None or j is None:
+            return None
+        end = self.offsets[i + 1]
+        pos = bisect_left(self.targets, j, self.offsets[i], end)
+        # the first of any parallel edges that has not been removed
+        while pos < end and self.targets[pos] == j:
+            if not self.removed[pos]:
+                return pos
+            pos += 1
+        return None
+
+    def _position_of_edge(self, edge_id):
+        k = bisect_left(self.sorted_edge_ids, edge_id)
+        if k < len(self.sorted_edge_ids) and self.sorted_edge_ids[k] == edge_id:
+            pos = self.edge_positions[k]
+            if not self.removed[pos]:
+                return pos
+        return None
+
+    def has_node(self, node_id):
+        return self._position(node_id) is not None or node_id in self.added
+
+    def neighbors(self, node_id):
+        """
+        Ids of the nodes node_id has edges to. Raises KeyError for unknown nodes.
+        """
+        i = self._position(node_id)
+        if i is None and node_id not in self.added:
+            raise KeyError(node_id)
+        result = []
+        if i is not None:
+            nodeIDs, targets, removed = self.node_ids, self.targets, self.removed
+            for pos in xrange(self.offsets[i], self.offsets[i + 1]):
+                # parallel edges are next to each other
+                if not removed[pos] and (not result or result[-1] != nodeIDs[targets[pos]]):
+                    result.append(nodeIDs[targets[pos]])
+        added = self.added.get(node_id)
+        if added:
+            known = set(result)
+            result.extend([dest for dest in added if dest not in known])
+        return result
+
+    def credit_limit(self, src, dest):
+        """
+        Credit limit of the src -> dest edge. Raises KeyError if there is none.
+        """
+        added = self.added.get(src)
+        if added is not None and dest in added:
+            limits = added[dest]
+            return limits[min(limits)]
+        pos = self._edge_position(src, dest)
+        if pos is None:
+            raise KeyError((src, dest))
+        return self.capacities[pos]
+
+    def endpoints(self, edge_id):
+        """
+        (src, dest) of the edge with the given metrix_table id, or None.
+        """
+        if edge_id in self.added_edges:
+            return self.added_edges[edge_id]
+        pos = self._position_of_edge(edge_id)
+        if pos is None:
+            return None
+        src = bisect_left(self.offsets, pos + 1) - 1
+        return self.node_ids[src], self.node_ids[self.targets[pos]]
+
+    def set_edge(self, edge_id, src, dest, credit_limit):
+        """
+        Inserts or updates an edge. Credit limit changes of unmoved edges are made
+        in place; everything else goes to the overlay.
+        """
+        old = self.endpoints(edge_id)
+        if old == (src, dest) and edge_id not in self.added_edges:
+            pos = self._position_of_edge(edge_id)
+            try:
+                self.capacities[pos] = credit_limit
+            except (OverflowError, TypeError):
+                self.capacities = list(self.capacities)
+                self.capacities[pos] = credit_limit
+            return
+        if old is not None:
+            self.remove_edge(edge_id)
+        self.added.setdefault(src, {}).setdefault(dest, {})[edge_id] = credit_limit
+        self.added_edges[edge_id] = (src, dest)
+
+    def remove_edge(self, edge_id):
+        if edge_id in self.added_edges:
+            src, dest = self.added_edges.pop(edge_id)
+            neighbors = self.added[src]
+            del neighbors[dest][edge_id]
+            if not neighbors[dest]:
+                del neighbors[dest]
+                if not neighbors:
+                    del self.added[src]
+            return
+        pos = self._position_of_edge(edge_id)
+        if pos is not None:
+            self.removed[pos] = 1
+
+    def overlay_size(self):
+        return len(self.added_edges)
+
+    def edges(self):
+        """
+        Generates (edge_id, src, dest, credit_limit) tuples of all current edges.
+        """
+        for i in xrange(len(self.node_ids)):
+            src = self.node_ids[i]
+            for pos in xrange(self.offsets[i], self.offsets[i + 1]):
+                if not self.removed[pos]:
+                    yield (self.edge_ids[pos], src, self.node_ids[self.targets[pos]],
+                           self.capacities[pos])
+        for edgeID, (src, dest) in self.added_edges.items():
+            yield edgeID, src, dest, self.added[src][dest][edgeID]
+
+    def compacted(self):
+        """
+        Returns a new graph with the same edges and no overlay.
+        """
+        return CreditGraph(self.edges())
@@ -20,7 +20,10 @@
 # see <http://www.gnu.org/licenses/>.
 ##################
 
+import sqlalchemy as sql
+
 from ripplebase.payment.mappers import *
+from ripplebase.payment.fixedpoint import from_fixed
 from ripplebase.account.dao import AddressDAO
 
 class PaymentDAO(db.RippleDAO):
@@ -53,6 +56,65 @@ class PaymentPathDAO(db.RippleDAO):
     fk_daos = {
         'payment': PaymentDAO,
     }
+
+    @classmethod
+    def create_from_pathset(cls, payment_id, pathset):
+        """Stores the paths of a pathsearch.PathSet and their links
+        in bulk, bypassing the ORM: one executemany inserts the
+        paths, another all the links.  The payment row stays locked
+        until the transaction ends, so nothing else stores paths for
+        the same payment in between.  Returns the new path ids in
+        path_list order.
+        """
+        path_list = [path for path in pathset.path_list if path.element_list]
+        if not path_list:
+            return []
+        db.execute(sql.select([payment_table.c.id],
+                              payment_table.c.id == payment_id,
+                              for_update=True))
+        # element_list is in payment order
+        path_rows = [{'payment_id': payment_id,
+                      'payer_amount': from_fixed(path.element_list[0].amount),
+                      'recipient_amount':
+                          from_fixed(path.element_list[-1].amount)}
+                     for path in path_list]
+        path_ids = allocate_ids(payment_path_table, len(path_rows))
+        if path_ids is not None:
+            for path_id, row in zip(path_ids, path_rows):
+                row['id'] = path_id
+            db.execute(payment_path_table.insert(), path_rows)
+        else:
+            # let the database number them, then read the ids back -
+            # safe only because of the payment lock above
+            db.execute(payment_path_table.insert(), path_rows)
+            query = sql.select([payment_path_table.c.id],
+                               payment_path_table.c.payment_id == payment_id,
+                               order_by=[payment_path_table.c.id.desc()],
+                               limit=len(path_rows))
+            # ids are handed out in insertion order
+            path_ids = sorted([row[0] for row in db.execute(query).fetchall()])
+        link_rows = []
+        for path_id, path in zip(path_ids, path_list):
+            for sequence_number, elt in enumerate(path.element_list):
+                link_rows.append({
+                    'path_id': path_id,
+                    'paying_account_id': elt.link.paying_acct,
+                    'receiving_account_id': elt.link.receiving_acct,
+                    'sequence_number': sequence_number,
+                    'amount': from_fixed(elt.amount)})
+        db.execute(payment_link_table.insert(), link_rows)
+        return path_ids
+        
+def allocate_ids(table, count):
+    """Takes count new ids, in ascending order, from the id sequence
+    of table in one query.  Returns None on databases without
+    sequences.
+    """
+    if db.engine.dialect.name not in ('postgres', 'postgresql'):
+        return None
+    query = sql.select([sql.func.nextval('%s_id_seq' % table.name)],
+                       from_obj=[sql.func.generate_series(1, count)])
+    return sorted([row[0] for row in db.execute(query).fetchall()])
         
     
     
@@ -0,0 +1,68 @@
+"""Fixed-point amounts for path search: integers counting units of
+10**-SCALE, so that the search loops run on int arithmetic.
+Convert with to_fixed/from_fixed at the API and DB boundary.
+"""
+
+##################
+# Copyright 2008, Ryan Fugger
+#
+# This file is part of Ripplebase.
+#
+# Ripplebase is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as 
+# published by the Free Software Foundation, either version 3 of the 
+# License, or (at your option) any later version.
+#
+# Ripplebase is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public 
+# License along with Ripplebase, in the file LICENSE.txt.  If not,
+# see <http://www.gnu.org/licenses/>.
+##################
+
+from decimal import Decimal as D, ROUND_DOWN
+
+from ripplebase import settings
+
+DEFAULT_SCALE = 12  # decimal places when settings.SCALE is not set
+DEFAULT_PRECISION = 30
+
+SCALE = settings.SCALE
+if SCALE is None:
+    SCALE = DEFAULT_SCALE
+PRECISION = settings.PRECISION
+if PRECISION is None:
+    PRECISION = DEFAULT_PRECISION
+
+ONE = 10 ** SCALE
+# More than any amount fitting Numeric(PRECISION, SCALE) - stands for
+# "no credit limit yet".
+UNLIMITED = 10 ** PRECISION
+
+_QUANTUM = D(1).scaleb(-SCALE)
+
+def to_fixed(value):
+    """Converts a Decimal, int, string or float amount to fixed point,
+    rounding towards zero.
+    """
+    if isinstance(value, (int, long)):
+        return value * ONE
+    if isinstance(value, float):
+        value = repr(value)
+    value = D(value).quantize(_QUANTUM, rounding=ROUND_DOWN)
+    return int(value.scaleb(SCALE))
+
+def from_fixed(amount):
+    "Converts a fixed-point amount to Decimal."
+    return D(amount).scaleb(-SCALE)
+
+def fixed_mul(a, b):
+    "a * b, rounded down."
+    return a * b // ONE
+
+def fixed_div(a, b):
+    "a / b, rounded down."
+    return a * ONE // b
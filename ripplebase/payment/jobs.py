@@ -0,0 +1,184 @@
+"Bounded worker pool for long-running jobs, such as payment path searches."
+
+##################
+# Copyright 2008, Ryan Fugger
+#
+# This file is part of Ripplebase.
+#
+# Ripplebase is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ripplebase is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with Ripplebase, in the file LICENSE.txt.  If not,
+# see <http://www.gnu.org/licenses/>.
+##################
+
+import itertools
+import threading
+import time
+import Queue
+
+MAX_WORKERS = 4
+MAX_QUEUED_JOBS = 64
+JOB_TIMEOUT = 30.0  # seconds from submission
+FINISHED_JOB_TTL = 600.0  # how long results of finished jobs can be looked up
+
+# Job status codes
+QUEUED = u'queued'
+RUNNING = u'running'
+DONE = u'done'
+CANCELLED = u'cancelled'
+TIMED_OUT = u'timed out'
+FAILED = u'failed'
+
+class PoolFull(Exception):
+    pass
+
+class JobStopped(Exception):
+    pass
+
+_job_ids = itertools.count(1)
+
+class Job(object):
+    """A unit of work run by a JobPool.  Threads can't be killed,
+    so cancellation is cooperative: the job function must call
+    check() (or poll stopped()) often enough to notice a DELETE or
+    its deadline going by.
+    """
+    def __init__(self, key, fn, timeout, clock=time.time):
+        self.id = _job_ids.next()
+        self.key = key
+        self.fn = fn
+        self.clock = clock
+        self.deadline = clock() + timeout
+        self.status = QUEUED
+        self.error = None
+        self.finished = None
+        self.previous = None  # job it replaces, if that was still going
+        self._cancelled = False
+        self._done = threading.Event()
+
+    def cancel(self):
+        self._cancelled = True
+
+    def stopped(self):
+        "True once the job has been cancelled or has run out of time."
+        return self._cancelled or self.clock() >= self.deadline
+
+    def check(self):
+        "Raises JobStopped if the job should stop."
+        if self.stopped():
+            raise JobStopped()
+
+    def is_finished(self):
+        return self.status not in (QUEUED, RUNNING)
+
+    def wait(self, timeout):
+        "Waits up to timeout seconds for the job to finish."
+        self._done.wait(max(timeout, 0))
+
+    def run(self):
+        if self.previous is not None:
+            # the job this one replaces may still be writing results
+            self.previous.wait(self.deadline - self.clock())
+            self.previous = None
+        if self.stopped():
+            self._finish(None)
+            return
+        self.status = RUNNING
+        try:
+            self.fn(self)
+        except JobStopped:
+            self._finish(None)
+        except Exception, e:
+            self._finish(FAILED, str(e))
+        else:
+            self._finish(DONE)
+
+    def _finish(self, status, error=None):
+        if status is None:
+            status = self._cancelled and CANCELLED or TIMED_OUT
+        self.error = error
+        self.finished = self.clock()
+        self.status = status
+        self._done.set()
+
+    def data_dict(self):
+        return {'id': self.id, 'status': self.status, 'error': self.error}
+
+class JobPool(object):
+    """Runs jobs on at most max_workers threads of its own, so slow
+    jobs tie up neither request threads nor Twisted's reactor thread
+    pool.  Jobs are looked up by key (eg. payment id); submitting a
+    job under a key cancels the job already there, and the new job
+    doesn't start until the old one has stopped.  At most max_queued
+    jobs wait for a worker - beyond that submit raises PoolFull.
+    """
+    def __init__(self, max_workers=MAX_WORKERS, max_queued=MAX_QUEUED_JOBS,
+                 timeout=JOB_TIMEOUT, clock=time.time):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.clock = clock
+        self.queue = Queue.Queue(max_queued)
+        self.jobs = {}  # key: job
+        self.workers = []
+        self.lock = threading.Lock()
+
+    def submit(self, key, fn, timeout=None):
+        """Queues fn(job) to run on a worker thread.  Returns the job
+        right away.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        job = Job(key, fn, timeout, self.clock)
+        self.lock.acquire()
+        try:
+            self._prune()
+            try:
+                self.queue.put_nowait(job)
+            except Queue.Full:
+                raise PoolFull("Too many jobs waiting; try again later.")
+            old_job = self.jobs.get(key)
+            if old_job is not None and not old_job.is_finished():
+                old_job.cancel()
+                job.previous = old_job
+            self.jobs[key] = job
+            if len(self.workers) < self.max_workers:
+                worker = threading.Thread(target=self._work)
+                worker.setDaemon(True)
+                self.workers.append(worker)
+                worker.start()
+        finally:
+            self.lock.release()
+        return job
+
+    def get(self, key):
+        "Returns the latest job submitted under key, or None."
+        return self.jobs.get(key)
+
+    def cancel(self, key):
+        "Cancels job under key.  Returns False if there is none running."
+        job = self.jobs.get(key)
+        if job is None or job.is_finished():
+            return False
+        job.cancel()
+        return True
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            job.run()
+
+    def _prune(self):
+        "Forgets jobs that finished more than FINISHED_JOB_TTL ago."
+        too_old = self.clock() - FINISHED_JOB_TTL
+        for key, job in self.jobs.items():
+            if job.is_finished() and job.finished < too_old:
+                del self.jobs[key]
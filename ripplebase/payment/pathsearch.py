@@ -18,14 +18,14 @@
 # see <http://www.gnu.org/licenses/>.
 ##################
 
-from decimal import Decimal as D
-# *** Make sure decimal module is configured for right precision,
-#     and identical to DB precision.  (May have to write our own
-#     FixedPoint class???)
-# *** Round all numbers to be stored to 12 places.  Write
-#     a round function to do this easily.
+from ripplebase.payment.fixedpoint import (ONE, to_fixed, from_fixed,
+                                            fixed_mul, fixed_div)
+# All amounts, credits and exchange rates used in the search are
+# fixed-point integers (see fixedpoint.py).  PathSearch.find_pathset
+# takes Decimal amounts; get_decimal_amount() converts results back.
 
 MAX_HOPS = 1000
+MAX_PATH_LENGTH = 10
 
 class HopLimitReached(Exception):
     pass
@@ -38,6 +38,8 @@ class Link(object):
     """A path-finding abstraction for holding two account versions
     that make up a link between nodes.
     """
+    __slots__ = ('src_node', 'dest_node', 'src_acct', 'dest_acct', 'backward')
+
     def __init__(self, src_node, dest_node,
                  src_acct, dest_acct,
                  backward):
@@ -52,39 +54,46 @@ class Link(object):
         self.backward = backward
         
     def get_paying_node(self):
-        return backward and dest_node or src_node
+        return self.backward and self.dest_node or self.src_node
     paying_node = property(get_paying_node)
 
     def get_receiving_node(self):
-        return backward and src_node or dest_node
+        return self.backward and self.src_node or self.dest_node
     receiving_node = property(get_receiving_node)
     
     def get_paying_acct(self):
-        return backward and dest_acct or src_acct
+        return self.backward and self.dest_acct or self.src_acct
     paying_acct = property(get_paying_acct)
     
     def get_receiving_acct(self):
-        return backward and src_acct or dest_acct
+        return self.backward and self.src_acct or self.dest_acct
     receiving_acct = property(get_receiving_acct)
     
 class PathElement(object):
     """Payment abstraction for holding two account versions
     that make up a link between nodes.  
     """
+    __slots__ = ('link', 'amount', 'path_units_amount')
+
     def __init__(self, link,
                  amount, path_units_amount):
         self.link = link
         self.amount = amount  # in link (account) units
+        self.path_units_amount = path_units_amount
 
 class Path(object):
-    def __init__(self, amount, element_list=[]):
+    __slots__ = ('amount', 'element_list')
+
+    def __init__(self, amount, element_list=None):
         self.amount = amount  # in path units
+        if element_list is None:
+            element_list = []
         self.element_list = element_list
 
     def prepend_link(self, link, path_to_link_exchange_rate):
-        link_amount = self.amount * path_to_link_exchange_rate
-        elt = PathElement(link, link_amount)
-        if link.backwards:
+        link_amount = fixed_mul(self.amount, path_to_link_exchange_rate)
+        elt = PathElement(link, link_amount, self.amount)
+        if link.backward:
             self.element_list.append(elt)
         else:
             self.element_list.insert(0, elt)
@@ -92,7 +101,9 @@ class Path(object):
 class PathSet(object):
     """Set of paths for payment.
     """
-    def __init__(self, path_list=[])
+    def __init__(self, path_list=None):
+        if path_list is None:
+            path_list = []
         self.path_list = path_list
 
     def merge(self, path_set):
@@ -103,11 +114,14 @@ class PathSet(object):
             path.prepend_link(link, path_to_link_exchange_rate)
 
     def get_total_amount(self):
-        total = D('0.0')
+        total = 0
         for path in self.path_list:
             total += path.amount
         return total
     amount = property(get_total_amount)
+
+    def get_decimal_amount(self):
+        return from_fixed(self.amount)
     
         
 class Hop(object):
@@ -122,14 +136,44 @@ class Hop(object):
         self.distance_list = distance_list
 
 
+class Flow(object):
+    """Amount (in path units) sent along a link by the paths found
+    so far, from in_acct at the link's source node.  rate converts
+    path units to link units, in_rate path units to in_acct units.
+    """
+    __slots__ = ('hop', 'in_acct', 'in_rate', 'rate', 'amount')
+
+    def __init__(self, hop, in_acct, in_rate, rate):
+        self.hop = hop
+        self.in_acct = in_acct
+        self.in_rate = in_rate
+        self.rate = rate
+        self.amount = 0
+
 class PathSearch(object):
+    """Multipath search by successive shortest augmenting paths
+    (Edmonds-Karp): repeatedly finds the path with the fewest links
+    (at most max_path_length) in the residual network, and sends as
+    much of the remaining amount along it as its tightest link
+    allows, until the amount is covered or no path is left.  Besides
+    links with credit left, the residual network has a reverse link
+    for each link the paths found so far use, so a later path can
+    take flow off a link and reroute it - which is what makes the
+    result the maximum available amount, not just a greedy one.
+    Exchanges at nodes can make rerouted amounts inexact; the
+    maximum is exact without them.
+
+    Subclasses provide the credit network through get_next_hop_list,
+    and may watch the search through path_found and paths_rerouted,
+    and stop it early with should_stop.
+    """
     def __init__(self, payer_nodes, recipient_nodes, amounts,
                  src_accts, backward=True):
         self.payer_nodes = payer_nodes
         self.recipient_nodes = recipient_nodes
         self.amounts = amounts
         self.src_accts = src_accts
-        assert len(amounts) = len(src_accts)
+        assert len(amounts) == len(src_accts)
         
         self.backward = backward
         if backward:
@@ -138,100 +182,253 @@ class PathSearch(object):
         else:
             self.src_nodes = payer_nodes
             self.dest_nodes = recipient_nodes
-        assert len(amounts) = len(src_accts)
-        assert len(amounts) = len(src_nodes)
+        assert len(amounts) == len(self.src_nodes)
 
-    def find_pathset(self, hops_to_live=MAX_HOPS):
+    def find_pathset(self, hops_to_live=MAX_HOPS,
+                     max_path_length=MAX_PATH_LENGTH):
         """Searches src_nodes in order until the required
         amount is found.  Returns a list of PathSets, one
-        for each src_node.
-        Raises HopLimitReached when hops_to_live runs out.
+        for each src_node searched, each covering as much of
+        its amount as is available.
+        hops_to_live limits the number of nodes explored in
+        total; when it runs out, the paths found so far are
+        returned, as they are when should_stop() turns true.
+        Raises HopLimitReached if hops run out before any path
+        is found.
         """
         # init search data
-        self.credit_used = {}  # dict indexed by Link
-        self.exhausted_nodes = set()
+        self.credit_used = {}  # in link units, by (paying acct, receiving acct)
+        amounts = [to_fixed(amount) for amount in self.amounts]
         self.hops_to_live = hops_to_live
+        self.max_path_length = max_path_length
 
         pathset_list = []
-        remaining_proportion = D('1.0')
-        for node, amount in zip(self.src_nodes, self.amounts):
-            search_amount = amount * remaining_proportion
-            found_pathset = self.search(node, search_amount, in_acct)
-                                                backward=self.backward)
+        remaining_proportion = ONE
+        for node, amount, src_acct in zip(self.src_nodes, amounts,
+                                          self.src_accts):
+            search_amount = fixed_mul(amount, remaining_proportion)
+            found_pathset = self.search(node, search_amount, src_acct)
             pathset_list.append(found_pathset)
-            remaining_proportion -= found_pathset.amount / amount
-            if remaining_proportion == D('0.0'):
+            remaining_proportion -= fixed_div(found_pathset.amount, amount)
+            if remaining_proportion <= 0 or self.hops_to_live <= 0 or \
+                   self.should_stop():
                 break
+        if self.hops_to_live <= 0 and \
+               not [pathset for pathset in pathset_list if pathset.path_list]:
+            raise HopLimitReached()
         return pathset_list
 
-
-    def search(self, node, amount, path_amount, src_acct, curr_path_nodes=[]):
-        """Returns a hopset, with amount of credit in src_acct
-        units.
+    def search(self, node, amount, src_acct):
+        """Returns a PathSet carrying up to amount (in src_acct
+        units) from node to the destination nodes.
         """
-        self.hops_to_live -= 1
-        if self.hops_to_live == 0:  # give up
-            raise HopLimitReached()
-
-        next_hop_list = self.get_next_hop_list(node, amount,
-                                               src_acct)
-        
+        # flows of the paths from node, by (link key, in_acct, rate),
+        # indexed by the link's source and destination node
+        self.flows_from = {}
+        self.flows_into = {}
         pathset = PathSet()
-        remaining_path_amount = path_amount
-        path_exchange_rate = amount / path_amount
-        for hop in next_hop_list:
-            # Avoid searching already-exhausted accounts,
-            # or going in loops
-            if hop.src_node_acct in exhausted_accts or \
-                    hop.dest_node in curr_path_nodes:
-                continue
-
-            if hop.available_credit > D('0.0'):
-                # compute amount to search for in this direction
-                path_to_hop_exchange_rate = path_exchange_rate * hop.exchange_rate
-                remaining_hop_amount = path_remaining_amount * path_to_hop_exchange_rate
-                search_hop_amount = min(hop.available_credit, remaining_hop_amount)
-                # convert search_hop_amount to path units
-                search_path_amount = search_hop_amount / path_to_hop_exchange_rate
-
-                # *** make sure decimal precision is high enough here so that
-                #     we get the original remaining_path_amount back exactly
-                #     if that's what we're looking for.
-                if search_hop_amount == remaining_hop_amount:
-                    assert search_path_amount = remaining_path_amount
-
-                # check if we've reached destination
-                if hop.dest_node in self.dest_nodes:
-                    found_pathset = PathSet([Path(search_path_amount)])
+        remaining_amount = amount
+        while remaining_amount > 0:
+            step_list = self.find_augmenting_path(node, src_acct)
+            if step_list is None:
+                break
+            path_amount = remaining_amount
+            for hop, rate, in_acct, in_rate, flow in step_list:
+                if flow is None:
+                    step_amount = fixed_div(self.get_available_credit(hop),
+                                            rate)
+                else:  # reverse link: at most the flow can be taken off
+                    step_amount = flow.amount
+                path_amount = min(path_amount, step_amount)
+            if path_amount <= 0:
+                break
+            rerouted = False
+            for hop, rate, in_acct, in_rate, flow in step_list:
+                key = self.get_link_key(hop.link)
+                if flow is None:
+                    self.get_flow(hop, in_acct, in_rate, rate).amount += \
+                        path_amount
+                    self.credit_used[key] = self.credit_used.get(key, 0) + \
+                        fixed_mul(path_amount, rate)
                 else:
-                    # recursive call to search
-                    try:
-                        found_pathset = self.search(
-                            hop.next_node,
-                            search_hop_amount,
-                            search_path_amount,
-                            hop.dest_node_acct,
-                            cur_path_nodes + [node])
-                    except DeadEnd:
-                        continue
-                    
-                found_pathset.prepend(hop.link, path_to_hop_exchange_rate)
-                pathset.merge(found_pathset)
-                if pathset.amount == path_amount:
-                    return pathset
-                remaining_amount -= search
-
-        if pathset.amount < path_amount:
-            self.exhausted_nodes.add(node)
-        if pathset.amount == D('0.0'):
-            raise DeadEnd()
-            
+                    flow.amount -= path_amount
+                    self.credit_used[key] = max(self.credit_used[key] -
+                        fixed_mul(path_amount, flow.rate), 0)
+                    rerouted = True
+            if rerouted:
+                pathset = self.decompose(node, src_acct)
+                self.paths_rerouted(node, pathset)
+            else:
+                path = Path(path_amount)
+                for hop, rate, in_acct, in_rate, flow in reversed(step_list):
+                    path.prepend_link(hop.link, rate)
+                pathset.merge(PathSet([path]))
+                self.path_found(node, path)
+            remaining_amount -= path_amount
         return pathset
-                
+
+    def get_flow(self, hop, in_acct, in_rate, rate):
+        link = hop.link
+        key = (self.get_link_key(link), in_acct, rate)
+        flows = self.flows_from.setdefault(link.src_node, {})
+        flow = flows.get(key)
+        if flow is None:
+            flow = flows[key] = Flow(hop, in_acct, in_rate, rate)
+            self.flows_into.setdefault(link.dest_node, {})[key] = flow
+        return flow
+
+    def decompose(self, node, src_acct):
+        """Splits the flows from node into paths.  Returns them as
+        a PathSet.
+        """
+        left = {}  # flow: amount not yet in a path
+        for flows in self.flows_from.values():
+            for flow in flows.values():
+                if flow.amount > 0:
+                    left[flow] = flow.amount
+        pathset = PathSet()
+        while True:
+            # follow flows from node to a destination, cancelling
+            # any cycles on the way
+            flow_list = []
+            node_list = [node]
+            in_acct = src_acct
+            while node_list[-1] not in self.dest_nodes:
+                flow = self._next_flow(node_list[-1], in_acct, left)
+                if flow is None:
+                    break
+                next_node = flow.hop.link.dest_node
+                if next_node in node_list:
+                    index = node_list.index(next_node)
+                    cycle = flow_list[index:] + [flow]
+                    cycle_amount = min([left[f] for f in cycle])
+                    for f in cycle:
+                        left[f] -= cycle_amount
+                    del flow_list[index:]
+                    del node_list[index + 1:]
+                    if flow_list:
+                        in_acct = flow_list[-1].hop.link.dest_acct
+                    else:
+                        in_acct = src_acct
+                    continue
+                flow_list.append(flow)
+                node_list.append(next_node)
+                in_acct = flow.hop.link.dest_acct
+            if not flow_list or node_list[-1] not in self.dest_nodes:
+                break
+            path = Path(min([left[flow] for flow in flow_list]))
+            for flow in reversed(flow_list):
+                left[flow] -= path.amount
+                path.prepend_link(flow.hop.link, flow.rate)
+            pathset.merge(PathSet([path]))
+        return pathset
+
+    def _next_flow(self, node, in_acct, left):
+        # a flow out of node with some amount left, from in_acct if any
+        candidates = [flow for flow in self.flows_from.get(node, {}).values()
+                      if left.get(flow, 0) > 0]
+        for flow in candidates:
+            if flow.in_acct == in_acct:
+                return flow
+        return candidates and candidates[0] or None
+
+    def find_augmenting_path(self, node, src_acct):
+        """Breadth-first search from node for the shortest path
+        to a destination node in the residual network.  Returns a
+        list of (hop, path_to_hop_exchange_rate, in_acct, in_rate,
+        flow) steps - flow is None for a link with credit available,
+        and the Flow to take off for a reverse link - or None if
+        there is no such path within max_path_length links (or
+        hops_to_live runs out).
+        """
+        dest_nodes = self.dest_nodes
+        # per reached node: (previous node, step)
+        parents = {node: None}
+        level = [(node, src_acct, ONE)]
+        for path_length in xrange(self.max_path_length):
+            next_level = []
+            for curr_node, in_acct, exchange_rate in level:
+                if self.hops_to_live <= 0 or self.should_stop():
+                    return None
+                self.hops_to_live -= 1
+                next_hop_list = self.sort_next_hop_list(
+                    self.get_next_hop_list(curr_node, in_acct, dest_nodes))
+                for hop in next_hop_list:
+                    next_node = hop.link.dest_node
+                    if next_node in parents:
+                        continue
+                    path_to_hop_exchange_rate = fixed_mul(exchange_rate,
+                                                          hop.exchange_rate)
+                    # credit must carry at least one unit of path amount,
+                    # or the path would carry nothing
+                    if fixed_div(self.get_available_credit(hop),
+                                 path_to_hop_exchange_rate) <= 0:
+                        continue
+                    parents[next_node] = (curr_node, (
+                        hop, path_to_hop_exchange_rate, in_acct,
+                        exchange_rate, None))
+                    if next_node in dest_nodes:
+                        return self._trace_path(parents, next_node)
+                    next_level.append((next_node, hop.link.dest_acct,
+                                       path_to_hop_exchange_rate))
+                for flow in self.flows_into.get(curr_node, {}).values():
+                    prev_node = flow.hop.link.src_node
+                    if flow.amount <= 0 or prev_node in parents:
+                        continue
+                    # carry on as the paths through flow came
+                    parents[prev_node] = (curr_node, (
+                        flow.hop, flow.rate, flow.in_acct, flow.in_rate, flow))
+                    next_level.append((prev_node, flow.in_acct, flow.in_rate))
+            if not next_level:
+                break
+            level = next_level
+        return None
+
+    def _trace_path(self, parents, node):
+        step_list = []
+        while parents[node] is not None:
+            prev_node, step = parents[node]
+            step_list.append(step)
+            node = prev_node
+        step_list.reverse()
+        return step_list
+
+    def get_link_key(self, link):
+        return (link.paying_acct, link.receiving_acct)
+
+    def get_available_credit(self, hop):
+        "Credit left on hop after the paths found so far, in link units."
+        return hop.available_credit - \
+               self.credit_used.get(self.get_link_key(hop.link), 0)
             
-    def sort_next_hop_list(self, next_hop_list, amount):
-        pass
+    def sort_next_hop_list(self, next_hop_list):
+        """Order in which hops are explored - decides between
+        paths of equal length.  Prefers more available credit.
+        """
+        next_hop_list = list(next_hop_list)
+        next_hop_list.sort(key=self.get_available_credit, reverse=True)
+        return next_hop_list
 
-    def get_next_hop_list(self, node, in_acct, dest_list):
-        pass
+    def path_found(self, node, path):
+        """Called with each path as soon as it is found, so results
+        can be used before the search ends.
+        """
+
+    def paths_rerouted(self, node, pathset):
+        """Called instead of path_found when a new path reroutes
+        credit of the paths found from node so far: pathset holds
+        all of them now, replacing those passed before.
+        """
+
+    def should_stop(self):
+        """Checked before exploring each node.  Return True to end
+        the search (eg. when it has been cancelled).
+        """
+        return False
 
+    def get_next_hop_list(self, node, in_acct, dest_list):
+        """Returns Hops leading out of node, with exchange rates
+        from in_acct units.  Credits and rates are fixed-point.
+        Subclasses know the credit network; here there is none.
+        """
+        return []
@@ -18,17 +18,27 @@
 # see <http://www.gnu.org/licenses/>.
 ##################
 
-from psycopg import connect
 # from routing.rmanager import ROUTING_DB_CONNECT_STR
+from routing.dbutil import PreparedStatement, int_array
+from routing.dbpool import get_pool, ThreadCursor
+from routing.distcache import get_distance_vector
+from payment.creditgraph import CreditGraph
+from payment.fixedpoint import to_fixed, UNLIMITED
+from payment.reservations import ledger
 import time
 import sys
-from operator import getitem, setitem, add, getslice
+import threading
+import heapq
+import itertools
+from operator import getitem, setitem, add, getslice, itemgetter, neg
 
 ROUTING_DB_CONNECT_STR = "dbname=routing_dev_db1 user=dev1 password=devdevdevdev host=localhost"
 
-conn = connect(ROUTING_DB_CONNECT_STR)
-curs = conn.cursor()
-conn.autocommit()
+# per-thread cursors on pooled connections (see routing.dbpool), so that concurrent
+# path searches do not share one connection. Nothing connects until first use, or
+# warm_up().
+pool = get_pool(ROUTING_DB_CONNECT_STR)
+curs = ThreadCursor(pool)
 
 RESULT_NODE_EXHAUSTED = 0
 RESULT_PATH_FOUND = 1
@@ -37,6 +47,12 @@ RESULT_GOING_UP_REGRESSION_CHAIN = 4 # the node wasn't the destination node, nor
 RESULT_INTERMEDIARY_HOP = 8          # nothing special about this hop
 RESULT_PATH_GENERATOR_EXHAUSTED = 16 # sick and tired; let's give up :) travelled through maximum specified nr of nodes
 
+MAX_ASTAR_EXPANSIONS = 1000     # default node expansion budget of PathSetCr.find_path_astar
+# default budgets of a PathGenerator: node expansions over the whole search, and
+# seconds per next_paths() call
+PATH_GENERATOR_MAX_EXPANSIONS = 10000
+PATH_GENERATOR_TIME_BUDGET = 2.0
+
 # a bit of magic, to allow passing either object or its certain attribute to a function;
 # meta_to_attr returns decorator corresponding to provided lists:
 #   - argument position in args list arg_pos_list;
@@ -58,8 +74,9 @@ def meta_deco_to_attr(arg_pos_list, attr_name_list):
                 changed_args_list = map(getattr, args_tobe_changed_list, attr_name_list)
             except:
                 return fn(cls, *args, **kwargs)
-            changed_args = tuple(changed_args_list)
-            return fn(cls, *changed_args, **kwargs)
+            for pos, changed_arg in zip(arg_pos_list, changed_args_list):
+                args_list[pos] = changed_arg
+            return fn(cls, *args_list, **kwargs)
         return fn_wrapper
     return deco
 
@@ -93,6 +110,72 @@ def cr_autonext(cr_gen):
     return cr_wrapper
 
     
+# Maximum number of contexts kept by each of the Hop and Edge registries. Contexts are
+# released when their search finishes (PathSetCr.close()); this cap only protects
+# long-running servers from searches that are never closed.
+MAX_CONTEXTS = 10000
+
+_context_serials = itertools.count(1)
+
+def new_context():
+    """
+    Returns a context key never used before - unlike id(<object>), which is recycled
+    once the object is gone.
+    """
+    return _context_serials.next()
+
+class ContextRegistry(object):
+    """
+    Per-context dictionaries of Hop or Edge clones. Contexts can be released
+    explicitly; when there are more than max_contexts, the least recently used tenth
+    is evicted.
+    """
+    def __init__(self, max_contexts = None):
+        self.max_contexts = max_contexts
+        self.dicts = {}
+        self.last_used = {}
+        self._clock = 0
+        self._lock = threading.Lock()
+
+    def get(self, context):
+        """
+        Returns the dictionary of 'context', creating it if needed.
+        """
+        self._lock.acquire()
+        try:
+            self._clock += 1
+            self.last_used[context] = self._clock
+            try:
+                return self.dicts[context]
+            except KeyError:
+                maxContexts = self.max_contexts or MAX_CONTEXTS
+                if len(self.dicts) >= maxContexts:
+                    self._evict(max(1, maxContexts // 10))
+                d = self.dicts[context] = {}
+                return d
+        finally:
+            self._lock.release()
+
+    def release(self, contexts):
+        self._lock.acquire()
+        try:
+            for context in contexts:
+                self.dicts.pop(context, None)
+                self.last_used.pop(context, None)
+        finally:
+            self._lock.release()
+
+    def _evict(self, count):
+        for context in heapq.nsmallest(count, self.last_used, key = self.last_used.get):
+            del self.dicts[context]
+            del self.last_used[context]
+
+    def __len__(self):
+        return len(self.dicts)
+
+    def __repr__(self):
+        return repr(self.dicts)
+
 class EGSException(Exception):
     pass
 
@@ -105,15 +188,19 @@ class Edge(object):
     the constructor call, already exists - returns existing edge; creates new instance otherwise.
     Edges can be bound to specific context, by passing context parameter to the constructor.
     The same edge is represented by distinct objects in different contexts. Context parameter
-    is arbitrary hashable parameter. I use id(context_object)
+    is arbitrary hashable parameter. I use path.context (see new_context())
     """
     global mao
     _edge_dict = {}
-    _contextual_edge_dicts = {}
-    mao_synced = False
+    _contextual_edge_dicts = ContextRegistry()
+    # mao.generation the _edge_dict credit limits come from; edges whose reservations
+    # change are dropped by _forget_edges()
+    _edge_dict_generation = None
     
     class _Edge(object):
         # underlying edge representation
+        __slots__ = ('src', 'dest', 'credit_limit')
+
         def __init__(self, src, dest, credit_limit, context = None):
             self.src = Hop(src, context)
             self.dest = Hop(dest, context)
@@ -125,24 +212,49 @@ class Edge(object):
     @edge_to_src_dest
     def __new__(cls, src, dest, context = None):
         # src and dest are expected to be Hop's, not ids
-        if not cls.mao_synced:
-            mao.synchronize_with_metric_db_table()
-            cls.mao_synced = True
+        mao.ensure_synchronized()
+        generation = mao.generation
+        if cls._edge_dict_generation != generation:
+            cls._edge_dict.clear()
+            cls._edge_dict_generation = generation
         if context is None:
             edge_dict = cls._edge_dict
         else:
-            edge_dict = cls._contextual_edge_dicts.setdefault(context, {})
+            edge_dict = cls._contextual_edge_dicts.get(context)
         try:
             return edge_dict[src.id][dest.id]
         except KeyError:
             try:
-                credit_limit = mao.metric_cache[src.id][dest.id]
+                credit_limit = mao.get_residual_credit(src.id, dest.id)
             except KeyError:
                 raise EdgeException("No such edge")
             edge_dict.setdefault(src.id, {})
-            res = edge_dict[src.id][dest.id] = cls._Edge(src, dest, credit_limit)
+            res = edge_dict[src.id][dest.id] = cls._Edge(src, dest, credit_limit, context)
             return res
 
+    @classmethod
+    def find(cls, src_id, dest_id, context = None):
+        """
+        Returns the existing src_id -> dest_id edge of the context, or None.
+        """
+        if context is None:
+            edge_dict = cls._edge_dict
+        else:
+            edge_dict = cls._contextual_edge_dicts.dicts.get(context, {})
+        return edge_dict.get(src_id, {}).get(dest_id)
+
+    @classmethod
+    def _forget_edges(cls, edge_keys):
+        """
+        Drops the shared edges with these (src id, dest id) keys - their residual
+        credit has changed. Registered with mao.reservations.
+        """
+        edge_dict = cls._edge_dict
+        for src_id, dest_id in edge_keys:
+            dest_dict = edge_dict.get(src_id)
+            if dest_dict is not None:
+                dest_dict.pop(dest_id, None)
+
     @classmethod    
     def print_dicts(cls):
         print "_edge_dict: %s" % cls._edge_dict
@@ -154,7 +266,7 @@ class Hop(object):
     accept both 'Hop' (usually to clone a hop in another context) or 'hop id'.
     """
     _hop_dict = {}
-    _contextual_hop_dicts = {}
+    _contextual_hop_dicts = ContextRegistry()
     class _Hop(object):
         """
         Path hop representation - collection of edges to neighbors
@@ -162,12 +274,13 @@ class Hop(object):
         # This object is not in any way obliged to have edges. Has to be properly filled with list of
         # outgoing edges, before trying to route through it.
         global mao
-        edge_list = []
-        dist_to_dest = -1       # not determined by default
+        __slots__ = ('id', 'context', 'edge_list', 'dist_to_dest')
         
         def __init__(self, hop_id, context = None):
             self.id = hop_id
             self.context = context
+            self.edge_list = []
+            self.dist_to_dest = -1      # not determined by default
             
         def query_and_register_outw_edges(self):
             #if not self.edge_list: # *** was buggy, find out why
@@ -181,11 +294,11 @@ class Hop(object):
         if context is None:
             hop_dict = cls._hop_dict
         else:
-            hop_dict = cls._contextual_hop_dicts.setdefault(context, {})
+            hop_dict = cls._contextual_hop_dicts.get(context)
         try:
             return hop_dict[hop_id]
         except KeyError:
-            res = hop_dict[hop_id] = cls._Hop(hop_id)
+            res = hop_dict[hop_id] = cls._Hop(hop_id, context)
             return res
 
     @classmethod    
@@ -194,33 +307,30 @@ class Hop(object):
         print "_contextual_hop_dicts: %s" % cls._contextual_hop_dicts
 
     @classmethod
-    def register_distance_to_dest(cls, dest, hop_list, reset = False):
+    def register_distance_to_dest(cls, dest, hop_list, reset = False, distance_memo = None):
+        """
+        Sets 'dist_to_dest' of the hops in hop_list - unless 'reset', only of those
+        without one. Distances come from distance_memo (a DistanceMemo for dest) if
+        given, otherwise from the routing table. Hops with no known route to dest are
+        left alone. Returns (hop, distance) tuples of the hops set.
+        """
         if not reset:
             affected_hop_list = filter(lambda x: x.dist_to_dest < 0, hop_list)
         else:
             affected_hop_list = hop_list
-        # result, returned by mao.get_nodes_distances_to_dest is not
-        # guaranteed to be sorted in any way; workaround: sort both
-        # hop and distance lists by corresponding hop.id, and then
-        # combine.
+        if not affected_hop_list:
+            return []
         affected_id_list = map(getattr, affected_hop_list, ('id',)*len(affected_hop_list))
-
-        if affected_id_list:
-            id_hop_tuple_list = zip(affected_id_list, affected_hop_list)
-        
-            id_hop_tuple_list.sort()
-            id_dist_tuple_list = mao.get_nodes_distances_to_dest(dest.id, affected_id_list)
-            id_dist_tuple_list.sort()
-
-            ordered_hop_list = list(zip(*id_hop_tuple_list)[1])
-            ordered_dist_list = list(zip(*id_dist_tuple_list)[1])
-
-            map(setattr, ordered_hop_list, ('dist_to_dest',)*len(ordered_hop_list), ordered_dist_list)
+        if distance_memo is not None:
+            dist_dict = dict(distance_memo.get_distances(affected_id_list))
         else:
-            ordered_hop_list = []
-            ordered_dist_list = []
-            
-        return zip(ordered_hop_list, ordered_dist_list)
+            dist_dict = dict(mao.get_nodes_distances_to_dest(dest.id, affected_id_list))
+        result = []
+        for hop in affected_hop_list:
+            if hop.id in dist_dict:
+                hop.dist_to_dest = dist_dict[hop.id]
+                result.append((hop, hop.dist_to_dest))
+        return result
         
 class ExploredGraphSegment(object):
     """
@@ -234,9 +344,12 @@ class ExploredGraphSegment(object):
     added_edges_dest_dict = {}      # hashmap for indexing edges by destination
     edge_id_serial = 0          # integer used to uniquely identify next edge; increased when a new edge is registered;
     
-    def __init__(self, src_node_id, dest_node_id):
+    def __init__(self, src_node_id, dest_node_id, payment_id = None):
+        if payment_id is None:
+            payment_id = ('search', new_context())
+        self.payment_id = payment_id    # owner of the reservations made for found paths
         self.mao = MetricAccessObject()
-        self.mao.synchronize_with_metric_db_table()
+        self.mao.synchronize_delta()
         self.src = self.hop_storage[src_node_id] = Hop(src_node_id)
         self.src.query_and_register_outw_edges()
         self.dest = self.hop_storage[dest_node_id] = Hop(dest_node_id)
@@ -252,51 +365,229 @@ class ExploredGraphSegment(object):
         self.added_edges_dest_dict = {}
         self.edge_id_serial = 0
 
-    def adjust_metrics_according_to_path(self, path, affected_contexts_list):
-        edge_list = list(zip(*path.hop_edge_sequence)[0])
-        contexted_edge_lists = map(Edge, (edge_list,)*len(affected_contexts_list))
+    def adjust_metrics_according_to_path(self, path, affected_contexts_list, amount = None):
+        """
+        Takes the credit carried by 'path' (its credit limit, unless 'amount' is given) 
+        off its edges: reserves it for self.payment_id in mao.reservations, so that
+        later searches - of this payment or concurrent ones - see the reduced 
+        capacity, and lowers the credit limits of the edges' existing clones in the
+        affected contexts.
+        """
+        if amount is None:
+            amount = path.credit_limit
+        edgeKeys = [(edge.src.id, edge.dest.id) for hop, edge in path.hop_edge_sequence
+                    if edge is not None]
+        mao.reservations.reserve(self.payment_id, edgeKeys, amount)
+        for context in affected_contexts_list:
+            for src_id, dest_id in edgeKeys:
+                edge = Edge.find(src_id, dest_id, context)
+                if edge is not None:
+                    edge.credit_limit -= amount
         
 
         
+# Change log of metrix_table, for MetricAccessObject.synchronize_delta(): a trigger
+# records the id of every inserted, updated or deleted edge. Created by 
+# install_metric_change_log(); without it, delta syncs fall back to full reloads.
+CREATE_METRIC_LOG_TABLE_STATEMENT = """
+CREATE TABLE metrix_log(
+    log_id bigserial PRIMARY KEY,
+    edge_id int4 NOT NULL
+)
+"""
+CREATE_METRIC_LOG_FUNCTION_STATEMENT = """
+CREATE OR REPLACE FUNCTION log_metrix_change() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        INSERT INTO metrix_log(edge_id) VALUES (OLD.id);
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        INSERT INTO metrix_log(edge_id) VALUES (NEW.id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+CREATE_METRIC_LOG_TRIGGER_STATEMENT = """
+CREATE TRIGGER metrix_change_log AFTER INSERT OR UPDATE OR DELETE ON metrix_table
+    FOR EACH ROW EXECUTE PROCEDURE log_metrix_change()
+"""
+# Log ids are handed out when rows are written, but become visible in commit order.
+# A delta sync re-reads this many log ids before the last one seen, so that changes
+# committed late by concurrent transactions are not skipped (re-applying a change
+# is harmless - the current row is read).
+METRIC_LOG_OVERLAP = 1000
+# last log entries applied: edge ids with their current rows (NULL if deleted)
+SQL_GET_METRIC_CHANGES = """
+SELECT l.log_id, l.edge_id, m.* FROM metrix_log AS l
+    LEFT JOIN metrix_table AS m ON m.id = l.edge_id
+    WHERE l.log_id > %s ORDER BY l.log_id
+"""
+
+def install_metric_change_log():
+    """
+    Creates metrix_log and the trigger on metrix_table feeding it.
+    """
+    curs.execute(CREATE_METRIC_LOG_TABLE_STATEMENT)
+    curs.execute(CREATE_METRIC_LOG_FUNCTION_STATEMENT)
+    curs.execute(CREATE_METRIC_LOG_TRIGGER_STATEMENT)
+
+# routing table queries of MetricAccessObject; node lists are passed as arrays
+SQL_GET_NODE_CLOSEST_TO_DEST = PreparedStatement("mao_get_node_closest_to_dest", ("int4", "int4[]"),
+    "SELECT src_node_id FROM routing_table WHERE dest_node_id = $1 AND src_node_id = ANY($2)"
+    " ORDER BY distance ASC LIMIT 1")
+SQL_GET_NODES_DISTANCES_TO_DEST = PreparedStatement("mao_get_nodes_distances_to_dest", ("int4", "int4[]"),
+    "SELECT src_node_id, distance FROM routing_table WHERE dest_node_id = $1 AND src_node_id = ANY($2)")
+
 class MetricAccessObject(object):
     # should not use Hop or Edge objects at this level of abstraction; id's instead.
     # *** can probably be a singleton?
-    distinct_hops_set = set([])
-    metric_cache = {}
+    # metrix_table contents (see payment.creditgraph); shared by all instances
+    credit_graph = CreditGraph([])
+    metric_cache_loaded = False     # credit_graph is loaded on first use
+    # Increased whenever credit_graph changes, so that data derived from it can
+    # tell whether it is stale.
+    generation = 0
+    last_log_id = None      # last metrix_log entry reflected in credit_graph
+    # overlay size (in edges) at which delta syncs rebuild credit_graph
+    CREDIT_GRAPH_COMPACT_THRESHOLD = 10000
+    _sync_lock = threading.RLock()
+    # Optional distance oracle used for hop ordering instead of routing_table lookups:
+    # any object with an estimate(src_id, dest_id) method, returning the (estimated)
+    # distance or None if unknown - e.g. routing.landmarks.LandmarkOracle.
+    distance_oracle = None
+    # Otherwise, routing distances come from the process-wide cache of distance vectors
+    # (routing.distcache) if set, or from routing_table queries
+    use_distance_cache = True
+    # Credit reserved by payments between path search and commit; taken off the credit
+    # limits by get_residual_credit()
+    reservations = ledger
 
     def get_neighbor_list(self, node_id):
-        metric_cache_entry = self.metric_cache[node_id]
-        return metric_cache_entry.keys()
+        self.ensure_synchronized()
+        return self.credit_graph.neighbors(node_id)
+
+    def get_credit_limit(self, src_id, dest_id):
+        """
+        Credit limit of the src_id -> dest_id edge, in fixed point (see
+        payment.fixedpoint); KeyError if there is no such edge.
+        """
+        self.ensure_synchronized()
+        return self.credit_graph.credit_limit(src_id, dest_id)
+
+    def get_residual_credit(self, src_id, dest_id, payment_id = None):
+        """
+        Credit limit of the src_id -> dest_id edge less the credit reserved on it by
+        payments other than payment_id.
+        """
+        return self.get_credit_limit(src_id, dest_id) - \
+               self.reservations.get_reserved(src_id, dest_id, payment_id)
 
     def synchronize_with_metric_db_table(self):
         """
-        Loads edge metric data from database into self.metric_cache dictionary.
+        Loads edge metric data from database into self.credit_graph.
         """
         SQL_GET_METRICS = "SELECT * FROM metrix_table"
-        self.metric_cache.clear()
-        curs.execute(SQL_GET_METRICS)
-        metrics_tuple_list = curs.fetchall()
-        self.distinct_hops_set.clear()
-        for metric_tuple in metrics_tuple_list:
-            self.distinct_hops_set.add(metric_tuple[1])
-        for hop in self.distinct_hops_set:
-            self.metric_cache[hop] = {}
-        while metrics_tuple_list:
-            metric_tuple = metrics_tuple_list.pop()
-            self.metric_cache[metric_tuple[1]][metric_tuple[2]] = metric_tuple[3]
+        self._sync_lock.acquire()
+        try:
+            # changes logged from now on will be applied by the next delta sync
+            lastLogID = self._get_last_log_id()
+            curs.execute(SQL_GET_METRICS)
+            MetricAccessObject.credit_graph = CreditGraph([(row[0], row[1], row[2], to_fixed(row[3]))
+                                                           for row in curs.fetchall()])
+            MetricAccessObject.last_log_id = lastLogID
+            MetricAccessObject.generation += 1
+            MetricAccessObject.metric_cache_loaded = True
+        finally:
+            self._sync_lock.release()
+
+    def _get_last_log_id(self):
+        """
+        Returns the last metrix_log id (0 if the log is empty), or None if there is 
+        no change log.
+        """
+        curs.execute("SELECT count(*) FROM pg_tables WHERE tablename = 'metrix_log'")
+        if curs.fetchone()[0] == 0:
+            return None
+        curs.execute("SELECT max(log_id) FROM metrix_log")
+        return curs.fetchone()[0] or 0
+
+    def synchronize_delta(self):
+        """
+        Brings credit_graph up to date by applying only the edges inserted, updated
+        or deleted since the last sync, as recorded in metrix_log. Falls back to a
+        full reload if the cache is not loaded yet or there is no change log.
+        Returns the number of changed edges.
+        """
+        self._sync_lock.acquire()
+        try:
+            if not self.metric_cache_loaded or self.last_log_id is None:
+                self.synchronize_with_metric_db_table()
+                return len(self.credit_graph.edge_ids)
+            curs.execute(SQL_GET_METRIC_CHANGES, (max(self.last_log_id - METRIC_LOG_OVERLAP, 0),))
+            changes = curs.fetchall()
+            changed = 0
+            latestRows = {}     # {<edge id>: <current row, or None if deleted>}
+            for change in changes:
+                latestRows[change[1]] = change[2] is not None and change[2:] or None
+            for edgeID, row in latestRows.items():
+                if self._apply_edge_change(edgeID, row):
+                    changed += 1
+            if changes:
+                MetricAccessObject.last_log_id = max(self.last_log_id, changes[-1][0])
+            if self.credit_graph.overlay_size() > self.CREDIT_GRAPH_COMPACT_THRESHOLD:
+                MetricAccessObject.credit_graph = self.credit_graph.compacted()
+            if changed:
+                MetricAccessObject.generation += 1
+            return changed
+        finally:
+            self._sync_lock.release()
+
+    def _apply_edge_change(self, edge_id, metric_tuple):
+        """
+        Makes credit_graph reflect the current metrix_table row of edge_id (None if 
+        the edge has been deleted). Returns True if anything changed.
+        """
+        graph = self.credit_graph
+        old = graph.endpoints(edge_id)
+        if metric_tuple is None:
+            if old is None:
+                return False
+            graph.remove_edge(edge_id)
+            return True
+        src, dest, metric = metric_tuple[1], metric_tuple[2], to_fixed(metric_tuple[3])
+        if old == (src, dest) and graph.credit_limit(src, dest) == metric:
+            return False
+        graph.set_edge(edge_id, src, dest, metric)
+        return True
+
+    def ensure_synchronized(self):
+        """
+        Loads credit_graph, unless it has been loaded already.
+        """
+        if self.metric_cache_loaded:
+            return
+        self._sync_lock.acquire()
+        try:
+            if not self.metric_cache_loaded:
+                self.synchronize_with_metric_db_table()
+        finally:
+            self._sync_lock.release()
             
     def get_node_closest_to_dest(self, dest_id, node_list):
         if not node_list: return []
         dest_present = False      # flag, saying whether dest_node is among neighbors - False by default
         if dest_id in node_list:
             return dest_id
-        NODE_LIST = "src_node_id = %s" % node_list[0]
-        for n in node_list[1:]:
-            NODE_LIST = NODE_LIST + " OR src_node_id = %s" % n
-        SQL_GET_NODE_CLOSEST_TO_DEST = "SELECT src_node_id FROM routing_table WHERE dest_node_id = %s AND (" % dest_id\
-            + "%s) ORDER BY distance ASC LIMIT 1" % NODE_LIST
-        #print SQL_GET_NODE_CLOSEST_TO_DEST
-        curs.execute(SQL_GET_NODE_CLOSEST_TO_DEST)
+        if self.distance_oracle is not None:
+            id_dist_tuple_list = self.get_oracle_distances(dest_id, node_list)
+            if not id_dist_tuple_list: return None
+            return min(id_dist_tuple_list, key = itemgetter(1))[0]
+        if self.use_distance_cache:
+            id_dist_tuple_list = self.get_cached_distances(dest_id, node_list)
+            if not id_dist_tuple_list: return None
+            return min(id_dist_tuple_list, key = itemgetter(1))[0]
+        SQL_GET_NODE_CLOSEST_TO_DEST.execute(curs, (dest_id, int_array(node_list)))
         result = curs.fetchone()
         #print "get_node_closest_to_dest: result is %s" % result
         return result[0]
@@ -304,40 +595,142 @@ class MetricAccessObject(object):
     def get_nodes_distances_to_dest(self, dest_id, node_list):
         # in general, DOES NOT sort the list according to distances
         if not node_list: return []
+        if self.distance_oracle is not None:
+            return self.get_oracle_distances(dest_id, node_list)
+        if self.use_distance_cache:
+            return self.get_cached_distances(dest_id, node_list)
         dest_present = False      # flag, saying whether dest_node is among neighbors - False by default
         if dest_id in node_list:
             dest_present = True
             node_list.remove(dest_id)
-        NODE_LIST = "src_node_id = %s" % node_list[0]
-        for n in node_list[1:]:
-            NODE_LIST = NODE_LIST + " OR src_node_id = %s" % n
-        SQL_GET_NODE_CLOSEST_TO_DEST = "SELECT src_node_id, distance FROM routing_table WHERE dest_node_id = %s AND (" % dest_id\
-            + "%s)" % NODE_LIST
-        curs.execute(SQL_GET_NODE_CLOSEST_TO_DEST)
+        SQL_GET_NODES_DISTANCES_TO_DEST.execute(curs, (dest_id, int_array(node_list)))
         result = curs.fetchall()
         if dest_present: result.append((dest_id, 0))
         return result
+
+    def get_oracle_distances(self, dest_id, node_list):
+        """
+        (node_id, distance) tuples from self.distance_oracle; like routing_table
+        queries, leaves out the nodes with no known route to dest_id.
+        """
+        estimate = self.distance_oracle.estimate
+        result = []
+        for node_id in node_list:
+            distance = estimate(node_id, dest_id)
+            if distance is not None:
+                result.append((node_id, distance))
+        return result
+
+    def get_cached_distances(self, dest_id, node_list, vector = None):
+        """
+        (node_id, distance) tuples from dest_id's cached distance vector (or 'vector');
+        leaves out the nodes with no route to dest_id.
+        """
+        if vector is None:
+            vector = get_distance_vector(curs, dest_id)
+        result = []
+        for node_id in node_list:
+            distance = vector.get(node_id)
+            if distance is not None:
+                result.append((node_id, distance))
+        return result
     
-mao = MetricAccessObject()
-mao.synchronize_with_metric_db_table()
+mao = MetricAccessObject()     # credit_graph is loaded on first use, or by warm_up()
+mao.reservations.listeners.append(Edge._forget_edges)
+
+# routing_table rows read by one DistanceMemo query
+DISTANCE_MEMO_CHUNK_SIZE = 10000
+SQL_GET_DISTANCES_TO_DEST_CHUNK = PreparedStatement("mao_get_distances_to_dest_chunk",
+    ("int4", "int4", "int4"),
+    "SELECT src_node_id, distance FROM routing_table WHERE dest_node_id = $1 AND src_node_id > $2"
+    " ORDER BY src_node_id LIMIT $3")
+
+class DistanceMemo(object):
+    """
+    Routing distances of all nodes to one destination, kept for the duration of a
+    search. Rather than querying the routing table for every expanded hop, reads the
+    destination's rows in chunks of chunk_size, in src_node_id order, as far as the
+    lookups need them. Uses mao.distance_oracle instead, if it is set, or else the
+    cached distance vector (mao.use_distance_cache) - held on to for the whole search,
+    so that a routing table refresh does not change distances half way through.
+    """
+    def __init__(self, dest_id, chunk_size = None):
+        self.dest_id = dest_id
+        self.chunk_size = chunk_size or DISTANCE_MEMO_CHUNK_SIZE
+        self.distances = {dest_id: 0}
+        self.loaded_up_to = None    # src_node_id of the last row read
+        self.complete = False
+        self.vector = None
+
+    def _load_up_to(self, node_id):
+        while not self.complete and (self.loaded_up_to is None or self.loaded_up_to < node_id):
+            if self.loaded_up_to is None:
+                after = -sys.maxint - 1
+            else:
+                after = self.loaded_up_to
+            SQL_GET_DISTANCES_TO_DEST_CHUNK.execute(curs, (self.dest_id, after, self.chunk_size))
+            rows = curs.fetchall()
+            self.distances.update(rows)
+            if len(rows) < self.chunk_size:
+                self.complete = True
+            if rows:
+                self.loaded_up_to = rows[-1][0]
+
+    def get_distances(self, node_ids):
+        """
+        (node_id, distance) tuples of the node_ids with a known route to dest_id.
+        """
+        if not node_ids:
+            return []
+        if mao.distance_oracle is not None:
+            return mao.get_oracle_distances(self.dest_id, node_ids)
+        if mao.use_distance_cache:
+            if self.vector is None:
+                self.vector = get_distance_vector(curs, self.dest_id)
+            return mao.get_cached_distances(self.dest_id, node_ids, self.vector)
+        self._load_up_to(max(node_ids))
+        distances = self.distances
+        return [(node_id, distances[node_id]) for node_id in node_ids if node_id in distances]
+
+    def get(self, node_id):
+        """
+        Distance from node_id to dest_id, or None if there is no known route.
+        """
+        result = self.get_distances([node_id])
+        if result:
+            return result[0][1]
+        return None
+
+def warm_up():
+    """
+    Connects to the routing DB and loads the metric cache ahead of the first search.
+    """
+    pool.warm_up()
+    mao.ensure_synchronized()
 
 STATUS_PATH_NEUTRAL = 0
 STATUS_PATH_SUCCESSFUL = 1
 STATUS_PATH_EXHAUSTED = 2
 
 class Path(object):
-    hop_edge_sequence = []      # stores (curr_hop, next_edge) tuples
-    #edge_id_sequence = []      
-    status = STATUS_PATH_NEUTRAL
-    credit_limit = 0.0
+    __slots__ = ('context', 'hop_edge_sequence', 'status', 'credit_limit')
+
+    def __init__(self):
+        self.context = new_context()  # key of the path's Hop and Edge clones
+        self.hop_edge_sequence = []   # stores (curr_hop, next_edge) tuples
+        self.status = STATUS_PATH_NEUTRAL
+        self.credit_limit = 0
     
 class PathScope(object):
     """
     Describes sequence of hops and their outward traversable edges' characteristics
     """
-    step_data_sequence = []     # [[(edge1, edge2, ..), (hop1, hop2, ..), (dist1, dist2, ..),\
-                                #  (cred_lim1, cred_lim2, ..), (<dist1+step_nr>, <dist2+step_nr>, ..)],..].
-    
+    __slots__ = ('step_data_sequence',)
+
+    def __init__(self):
+        self.step_data_sequence = []    # [[(edge1, edge2, ..), (hop1, hop2, ..), (dist1, dist2, ..),\
+                                        #  (cred_lim1, cred_lim2, ..), (<dist1+step_nr>, <dist2+step_nr>, ..)],..].
+
     def _prune_path_scope_leaf(self):
         # made private - should only be executed within self.process_path_scope
         length = len(self.step_data_sequence)
@@ -400,7 +793,7 @@ class PathScope(object):
         
         best_step, best_value = self.get_best_dist_step()
 
-        self.switch_to_contexted_scope_data(best_step, id(path))
+        self.switch_to_contexted_scope_data(best_step, path.context)
 
         if best_step > 0:            
             same_path_segment_scope_edge_data = map(getitem, self.step_data_sequence[:best_step], (0,)*(best_step))
@@ -433,15 +826,17 @@ class PathScope(object):
         return i, best_value
     
 class PathSetCr(object):
-    found_paths_list = []
-    exhausted_paths_list = []
-    path_scopes_list = []
-    
-    def __init__(self, src_node, dest_node):
+    def __init__(self, src_node, dest_node, payment_id = None):
         """
         Initialize the object
         """
-        self.egs = ExploredGraphSegment(src_node, dest_node)
+        self.found_paths_list = []
+        self.exhausted_paths_list = []
+        self.path_scopes_list = []
+        self.contexts = set([])     # contexts of this search's paths, see close()
+        self.distance_memo = DistanceMemo(dest_node)
+        self.egs = ExploredGraphSegment(src_node, dest_node, payment_id)
+        self.payment_id = self.egs.payment_id
         self.src_node = Hop(src_node)
         self.dest_node = Hop(dest_node)
         self.search_agent = self.cr_search()
@@ -462,17 +857,107 @@ class PathSetCr(object):
             while res[2] != RESULT_PATH_FOUND:
                 res = self.search_agent.send((path, path_scope, curr_hop, max_path_length))
                 total_hops += 1
-                if total_hops >= 1000: yield RESULT_PATH_GENERATOR_EXHAUSTED
+                if total_hops >= max_total_hops:
+                    # the cursor and contexts are released: no more searching
+                    self.close()
+                    yield RESULT_PATH_GENERATOR_EXHAUSTED
+                    return
                 curr_hop = res[0][1]
             self.found_paths_list.append(path)
             self.path_scopes_list.append(path_scope)
             path_scope.process_path_scope()
             path, curr_hop, path_scope = path_scope.convert_to_path()
+            self.contexts.add(path.context)
             res = (None,)*5
+
+    def find_path_astar(self, max_path_length = 10, max_expansions = MAX_ASTAR_EXPANSIONS,
+                        credit_used = None, deadline = None):
+        """
+        A* alternative to cr_find_next_path: expands nodes in order of hops so far plus
+        routing distance to dest_node (ties: larger credit limit first), each node at
+        most once. Paths longer than max_path_length hops are pruned, and the search 
+        gives up after max_expansions expanded nodes, or at time.time() 'deadline'.
+        Edges' credit is their residual credit (see MetricAccessObject), not counting
+        reservations of self.payment_id, less credit_used ({(src id, dest id): credit}).
+        Returns a Path (also added to found_paths_list), or None if no path was found.
+        self.expansions is the number of nodes expanded; self.astar_interrupted tells
+        whether the search ran out of budget.
+        """
+        srcID, destID = self.src_node.id, self.dest_node.id
+        if credit_used is None:
+            credit_used = {}
+        self.expansions = 0
+        self.astar_interrupted = False
+        startDist = self._get_distances_to_dest([srcID]).get(srcID)
+        if startDist is None:
+            return None
+        closed = set([])
+        serials = itertools.count()
+        # heap entries: (estimated length, -credit limit, serial, hops so far, node id, parent entry)
+        heap = [(startDist, -UNLIMITED, serials.next(), 0, srcID, None)]
+        while heap:
+            entry = heapq.heappop(heap)
+            negCreditLimit, hops, nodeID = entry[1], entry[3], entry[4]
+            if nodeID in closed:
+                continue
+            if nodeID == destID:
+                return self._astar_entry_to_path(entry)
+            if self.expansions >= max_expansions or \
+                   (deadline is not None and time.time() >= deadline):
+                self.astar_interrupted = True
+                break
+            closed.add(nodeID)
+            self.expansions += 1
+            neighborIDs = [neighborID for neighborID in mao.get_neighbor_list(nodeID)
+                           if neighborID not in closed]
+            dists = self._get_distances_to_dest(neighborIDs)
+            for neighborID in neighborIDs:
+                dist = dists.get(neighborID)
+                if dist is None or hops + 1 + dist > max_path_length:
+                    continue
+                creditLimit = min(-negCreditLimit,
+                                  mao.get_residual_credit(nodeID, neighborID, self.payment_id) -
+                                  credit_used.get((nodeID, neighborID), 0))
+                if creditLimit <= 0:
+                    continue
+                heapq.heappush(heap, (hops + 1 + dist, -creditLimit, serials.next(),
+                                      hops + 1, neighborID, entry))
+        return None
+
+    def _get_distances_to_dest(self, node_ids):
+        # {node id: routing distance to dest_node}; nodes without a route are left out
+        return dict(self.distance_memo.get_distances(node_ids))
+
+    def _astar_entry_to_path(self, entry):
+        path = Path()
+        self.contexts.add(path.context)
+        path.credit_limit = -entry[1]
+        nodeIDs = []
+        while entry is not None:
+            nodeIDs.append(entry[4])
+            entry = entry[5]
+        nodeIDs.reverse()
+        hops = [Hop(nodeID, path.context) for nodeID in nodeIDs]
+        for i in xrange(len(hops) - 1):
+            path.hop_edge_sequence.append((hops[i], Edge(hops[i], hops[i + 1], path.context)))
+        path.hop_edge_sequence.append((hops[-1], None))
+        self.found_paths_list.append(path)
+        return path
+
+    def close(self):
+        """
+        Ends the search: releases the Hop and Edge clones registered for its paths,
+        and hands the thread's routing DB connection back to the pool. Paths found
+        so far remain valid - they reference their hops and edges directly.
+        """
+        Hop._contextual_hop_dicts.release(self.contexts)
+        Edge._contextual_edge_dicts.release(self.contexts)
+        self.contexts.clear()
+        curs.release()
         
     @cr_autonext
     def cr_search(self):
-        next_vector, credit_limit, result_flag = (None, 1000000000000000000.0, None)
+        next_vector, credit_limit, result_flag = (None, UNLIMITED, None)
         while True:
             path, path_scope, curr_hop, max_path_length = yield next_vector, credit_limit, result_flag
             if curr_hop.id == self.dest_node.id:
@@ -482,7 +967,8 @@ class PathSetCr(object):
                 result_flag = RESULT_PATH_FOUND
                 continue
 
-            contexted_curr_hop = Hop(curr_hop, id(path)) # create context-bound (current path-bound) clone of the hop
+            self.contexts.add(path.context)
+            contexted_curr_hop = Hop(curr_hop, path.context) # create context-bound (current path-bound) clone of the hop
             
             step_nr = len(path.hop_edge_sequence)
 
@@ -496,7 +982,8 @@ class PathSetCr(object):
             
             edge_list, context_tr_neighbor_list = self.hop_edge_registrar.send((path, contexted_curr_hop, context_tr_neighbor_list))
 
-            Hop.register_distance_to_dest(self.dest_node, context_tr_neighbor_list)
+            Hop.register_distance_to_dest(self.dest_node, context_tr_neighbor_list,
+                                          distance_memo = self.distance_memo)
             
             
             dist_list = map(getattr, context_tr_neighbor_list, ('dist_to_dest',)*len(context_tr_neighbor_list))
@@ -512,7 +999,8 @@ class PathSetCr(object):
 
             self.dist_crlim_sorting_agent.send((edge_list, context_tr_neighbor_list, dist_list, cred_lim_list, step_dist_list))
 
-            next_vector = zip(edge_list, context_tr_neighbor_list, dist_list, cred_lim_list, step_dist_list)[0]
+            # the lists are ranked best first
+            next_vector = (edge_list[0], context_tr_neighbor_list[0], dist_list[0], cred_lim_list[0], step_dist_list[0])
             credit_limit = path.credit_limit = next_vector[3]
             print "cr_search: credit_limit = %s" % credit_limit
 
@@ -530,7 +1018,7 @@ class PathSetCr(object):
         while True:
             path, hop, traversable_neighbor_list = yield edge_list, traversable_neighbor_list
             edge_list = map(Edge, (hop,)*len(traversable_neighbor_list), traversable_neighbor_list, \
-                                                       (id(path),)*len(traversable_neighbor_list))
+                                                       (path.context,)*len(traversable_neighbor_list))
             hop.edge_list = edge_list
 
     @cr_autonext
@@ -580,17 +1068,9 @@ class PathSetCr(object):
         while True:
             edge_list, context_tr_neighbor_list, dist_list, credit_limit, step_dist_list\
                 = yield edge_list, context_tr_neighbor_list, dist_list, credit_limit, step_dist_list
-            dset = set(dist_list)
-            dvalues = list(set(dist_list))
-            dvalues.sort()
-            aggregate_list = zip(edge_list, context_tr_neighbor_list, dist_list, credit_limit, step_dist_list)
-            cp = 0              # current position in list
-            sorted_aggregate_list = []
-            for d in dvalues:
-                aggregate_slice = filter(lambda x: x[2] == d, aggregate_list)
-                aggregate_slice.sort(lambda x, y: cmp(x[3], y[3]), reverse = True)
-                map(sorted_aggregate_list.append, aggregate_slice)
-            edge_list[:], context_tr_neighbor_list[:], dist_list[:], credit_limit[:], step_dist_list[:] = zip(*sorted_aggregate_list)
+            order = rank_by_dist_and_cred_lim(dist_list, credit_limit)
+            for column in (edge_list, context_tr_neighbor_list, dist_list, credit_limit, step_dist_list):
+                column[:] = map(column.__getitem__, order)
             
     
 
@@ -599,6 +1079,140 @@ class PathSetCr(object):
 
     
 
+class PathGenerator(object):
+    """
+    Resumable search for successive paths from src_node to dest_node (ids), with
+    budgets. Every path is found by PathSetCr.find_path_astar on the credit left over
+    by the paths before it, so that together they can carry more than any single one.
+    Iterate, or ask for several paths at a time with next_paths().
+
+    Budgets: max_expansions node expansions over the whole search, and time_budget
+    seconds per next_paths() call. checkpoint() returns the state of the search as
+    plain data - e.g. to be kept between HTTP requests - and resume() continues it;
+    only the search for a path cut short by a budget starts over.
+
+    With a payment_id, the credit of the paths found is reserved for the payment in
+    mao.reservations, hiding it from concurrent searches. The reservations are
+    released when the search fails, and by close() unless the paths are kept for
+    the payment's commit - then they last until release_reservations(), or until
+    they expire.
+    """
+    def __init__(self, src_node, dest_node, max_path_length = 10, max_expansions = None,
+                 time_budget = None, payment_id = None):
+        self.src_node = src_node
+        self.payment_id = payment_id
+        self.dest_node = dest_node
+        self.max_path_length = max_path_length
+        self.max_expansions = max_expansions or PATH_GENERATOR_MAX_EXPANSIONS
+        self.time_budget = time_budget or PATH_GENERATOR_TIME_BUDGET
+        self.expansions = 0         # used up so far
+        self.credit_used = {}       # {(src id, dest id): credit taken by the paths found}
+        self.found_paths = []       # [(<node id list>, <credit limit>)]
+        self.exhausted = False      # True when there are no more paths
+        self._search = None
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        paths = self.next_paths(1)
+        if not paths:
+            raise StopIteration
+        return paths[0]
+
+    def next_paths(self, count, time_budget = None):
+        """
+        Finds up to 'count' more paths and returns them (Path objects). Fewer are
+        returned when the search is exhausted, or out of budget - see budget_left().
+        """
+        try:
+            try:
+                return self._next_paths(count, time_budget)
+            except:
+                self.release_reservations()
+                raise
+        finally:
+            # a generator may be resumed in another thread; don't keep a connection
+            # between calls
+            curs.release()
+
+    def _next_paths(self, count, time_budget):
+        deadline = time.time() + (time_budget or self.time_budget)
+        if self.payment_id is not None:
+            mao.reservations.renew(self.payment_id)
+        result = []
+        while len(result) < count and not self.exhausted and self.budget_left() \
+                  and time.time() < deadline:
+            if self._search is None:
+                self._search = PathSetCr(self.src_node, self.dest_node, self.payment_id)
+            search = self._search
+            path = search.find_path_astar(self.max_path_length,
+                                          self.max_expansions - self.expansions,
+                                          credit_used = self.credit_used, deadline = deadline)
+            self.expansions += search.expansions
+            if path is None:
+                if not search.astar_interrupted:
+                    self.exhausted = True
+                break
+            nodeIDs = [hop.id for hop, edge in path.hop_edge_sequence]
+            for edgeKey in zip(nodeIDs, nodeIDs[1:]):
+                self.credit_used[edgeKey] = self.credit_used.get(edgeKey, 0) + path.credit_limit
+            self.found_paths.append((nodeIDs, path.credit_limit))
+            if self.payment_id is not None:
+                mao.reservations.reserve_path(self.payment_id, nodeIDs, path.credit_limit)
+            result.append(path)
+        return result
+
+    def budget_left(self):
+        return self.expansions < self.max_expansions
+
+    def checkpoint(self):
+        """
+        Returns the state of the search as a dict of numbers and lists (JSON
+        serializable), for resume().
+        """
+        return {
+            'src_node': self.src_node,
+            'dest_node': self.dest_node,
+            'max_path_length': self.max_path_length,
+            'max_expansions': self.max_expansions,
+            'time_budget': self.time_budget,
+            'expansions': self.expansions,
+            'credit_used': [[src, dest, credit] for (src, dest), credit in self.credit_used.items()],
+            'found_paths': [[nodeIDs, creditLimit] for nodeIDs, creditLimit in self.found_paths],
+            'exhausted': self.exhausted,
+            'payment_id': self.payment_id,
+        }
+
+    @classmethod
+    def resume(cls, checkpoint):
+        generator = cls(checkpoint['src_node'], checkpoint['dest_node'],
+                        checkpoint['max_path_length'], checkpoint['max_expansions'],
+                        checkpoint['time_budget'], checkpoint.get('payment_id'))
+        generator.expansions = checkpoint['expansions']
+        generator.credit_used = dict([((src, dest), credit)
+                                      for src, dest, credit in checkpoint['credit_used']])
+        generator.found_paths = [(list(nodeIDs), creditLimit)
+                                 for nodeIDs, creditLimit in checkpoint['found_paths']]
+        generator.exhausted = checkpoint['exhausted']
+        return generator
+
+    def release_reservations(self):
+        if self.payment_id is not None:
+            mao.reservations.release(self.payment_id)
+
+    def close(self, keep_reservations = False):
+        """
+        Releases the search's Hop and Edge clones (see PathSetCr.close()), and its
+        reservations unless keep_reservations is set - for paths about to be
+        committed.
+        """
+        if self._search is not None:
+            self._search.close()
+            self._search = None
+        if not keep_reservations:
+            self.release_reservations()
+
 ###################################################################################################
 ###### -------------------------------OBSOLETE (non-coroutine)------------------------------ ######
 ###################################################################################################
@@ -699,7 +1313,7 @@ class PathSet(object):
                 yield RESULT_PATH_FOUND
                 break
             else:
-                contexted_curr_hop = Hop(curr_hop, id(path)) # create context-bound (current path-bound) clone of the hop
+                contexted_curr_hop = Hop(curr_hop, path.context) # create context-bound (current path-bound) clone of the hop
                 
                 curr_hop_all_neighbors_list = map(getattr, curr_hop.edge_list, ('dest',)*len(curr_hop.edge_list))
                 curr_hop_all_neighbors_set = set(curr_hop_all_neighbors_list)
@@ -713,7 +1327,7 @@ class PathSet(object):
                 traversable_neighbor_list = list(traversable_neighbor_set)
                 
                 contexted_curr_hop.edge_list = map(Edge, (curr_hop,)*len(traversable_neighbor_list), traversable_neighbor_list, \
-                                                       (id(path),)*len(traversable_neighbor_list))
+                                                       (path.context,)*len(traversable_neighbor_list))
 
                 # *** since anyway required, perhaps give this argument to new_sort_hops_edges
                 neighbor_hops = map(getattr, contexted_curr_hop.edge_list, ('dest',)*len(contexted_curr_hop.edge_list))
@@ -734,7 +1348,7 @@ class PathSet(object):
                     yield RESULT_NODE_EXHAUSTED # no more edges here
                     break
 
-                curr_edge = Edge(contexted_curr_hop, next_hop, context = id(path))
+                curr_edge = Edge(contexted_curr_hop, next_hop, context = path.context)
                 path.hop_edge_sequence.append((contexted_curr_hop, curr_edge))
 
                 if credit_limit is not None:
@@ -766,6 +1380,14 @@ class PathSet(object):
 #    def find_path_coroutine(self, max_path_length):
         
     
+def rank_by_dist_and_cred_lim(dist_list, cred_lim_list):
+    """
+    Returns the positions of parallel dist_list and cred_lim_list, ordered by distance
+    (ascending), then credit limit (descending). One keyed sort, ties keep their order.
+    """
+    keys = zip(dist_list, map(neg, cred_lim_list))
+    return sorted(xrange(len(keys)), key = keys.__getitem__)
+
 def sort_objects_by_attr(attr, object_list, in_place = True):
     """
     attr, object_list -> object_list
@@ -0,0 +1,150 @@
+"""
+Tentative reservations of credit on credit graph edges, per payment, for path
+searches to take off the credit limits of MetricAccessObject.
+"""
+
+##################
+# Copyright 2008, Jevgenij Solovjov
+#
+# This file is part of Ripplebase.
+#
+# Ripplebase is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ripplebase is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with Ripplebase, in the file LICENSE.txt.  If not,
+# see <http://www.gnu.org/licenses/>.
+##################
+
+import heapq
+import threading
+import time
+
+# Seconds a reservation lasts unless renewed - long enough for a payment to go from
+# path search to commit
+RESERVATION_TTL = 120.0
+
+class ReservationLedger(object):
+    """
+    Credit reserved on edges ((src id, dest id) tuples) by payments. A payment's
+    reservations expire together, ttl seconds after they were last made or renewed,
+    and are dropped at once by release() - on commit or cancellation.
+
+    'version' changes whenever the reserved amounts do. Caches of residual credit
+    can also add a function to 'listeners', to be called with the list of edges
+    whose reserved amounts changed, and drop just those.
+    """
+    def __init__(self, ttl = None, clock = time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self.reservations = {}  # {<payment id>: [<expiry time>, {<edge>: <amount>}]}
+        self.reserved = {}      # {<edge>: <amount reserved by all payments>}
+        self.version = 0
+        self.listeners = []
+        self._expiries = []     # heap of (expiry time, payment id); stale entries skipped
+        self._lock = threading.RLock()
+
+    def reserve(self, payment_id, edges, amount, ttl = None):
+        """
+        Reserves 'amount' on each of 'edges' for payment_id (on top of what it has
+        reserved already), and renews its reservations.
+        """
+        self._lock.acquire()
+        try:
+            self.expire()
+            reservation = self.reservations.setdefault(payment_id, [None, {}])
+            amounts = reservation[1]
+            for edge in edges:
+                amounts[edge] = amounts.get(edge, 0) + amount
+                self.reserved[edge] = self.reserved.get(edge, 0) + amount
+            self._changed(edges)
+            self.renew(payment_id, ttl)
+        finally:
+            self._lock.release()
+
+    def reserve_path(self, payment_id, node_ids, amount, ttl = None):
+        """
+        Reserves 'amount' on the edges between consecutive node_ids.
+        """
+        self.reserve(payment_id, zip(node_ids, node_ids[1:]), amount, ttl)
+
+    def renew(self, payment_id, ttl = None):
+        self._lock.acquire()
+        try:
+            reservation = self.reservations.get(payment_id)
+            if reservation is None:
+                return
+            reservation[0] = self.clock() + (ttl or self.ttl or RESERVATION_TTL)
+            heapq.heappush(self._expiries, (reservation[0], payment_id))
+        finally:
+            self._lock.release()
+
+    def release(self, payment_id):
+        """
+        Drops all reservations of payment_id.
+        """
+        self._lock.acquire()
+        try:
+            reservation = self.reservations.pop(payment_id, None)
+            if reservation is None:
+                return
+            for edge, amount in reservation[1].items():
+                left = self.reserved[edge] - amount
+                if left:
+                    self.reserved[edge] = left
+                else:
+                    del self.reserved[edge]
+            self._changed(reservation[1].keys())
+        finally:
+            self._lock.release()
+
+    def _changed(self, edges):
+        self.version += 1
+        for listener in self.listeners:
+            listener(edges)
+
+    def expire(self):
+        """
+        Releases the reservations whose time is up.
+        """
+        expiries = self._expiries
+        if not expiries or expiries[0][0] > self.clock():
+            return
+        self._lock.acquire()
+        try:
+            now = self.clock()
+            while expiries and expiries[0][0] <= now:
+                expiry, paymentID = heapq.heappop(expiries)
+                reservation = self.reservations.get(paymentID)
+                if reservation is not None and reservation[0] == expiry:
+                    self.release(paymentID)
+        finally:
+            self._lock.release()
+
+    def get_reserved(self, src_id, dest_id, exclude_payment_id = None):
+        """
+        Credit reserved on the src_id -> dest_id edge, not counting what
+        exclude_payment_id has reserved.
+        """
+        self.expire()
+        edge = (src_id, dest_id)
+        amount = self.reserved.get(edge, 0)
+        if amount and exclude_payment_id is not None:
+            reservation = self.reservations.get(exclude_payment_id)
+            if reservation is not None:
+                amount -= reservation[1].get(edge, 0)
+        return amount
+
+    def __len__(self):
+        return len(self.reservations)
+
+# The ledger of path searches on the routing graph (payment.pathsetv1) in this
+# process.
+ledger = ReservationLedger()
@@ -18,10 +18,21 @@
 # see <http://www.gnu.org/licenses/>.
 ##################
 
+from datetime import datetime
+
+import sqlalchemy as sql
+
+from ripplebase import db
 from ripplebase.resource import (RippleObjectListHandler, RippleObjectHandler,
                                  RequestHandler)
 from ripplebase.payment.dao import *
+from ripplebase.payment.pathsearch import (PathSearch, PathSet, Link, Hop,
+                                           HopLimitReached)
+from ripplebase.payment.fixedpoint import ONE, to_fixed, from_fixed, fixed_div
+from ripplebase.payment.jobs import JobPool
+from ripplebase.payment.reservations import ReservationLedger
 from ripplebase.account.dao import AddressDAO
+from ripplebase.account.tables import account_table, account_limits_table
 
 # Payment status codes
 REQUESTED = u'RQ'
@@ -31,6 +42,12 @@ CANCELLED = u'CA'
 REFUSED = u'RF'
 FAILED = u'FA'
 
+# Path searches run here, not in request threads.
+search_jobs = JobPool()
+# Credit held for payments on the links of their stored paths, by
+# (paying account id, receiving account id), from search to commit.
+account_reservations = ReservationLedger()
+
 
 class PaymentListHandler(RippleObjectListHandler):
     DAO = PaymentDAO
@@ -65,13 +82,34 @@ class PaymentHandler(RippleObjectHandler):
     DAO = PaymentDAO
 
 class PathSearchHandler(RequestHandler):
-    allowed_methods = ('GET', 'HEAD', 'POST')
+    """Searches run as jobs in search_jobs, so a slow one doesn't
+    tie up a request thread: POST starts a search and returns its
+    job id right away, GET shows the paths stored so far, and
+    DELETE cancels the search.  Searches also stop by themselves
+    after jobs.JOB_TIMEOUT.
+    """
+    allowed_methods = ('GET', 'HEAD', 'POST', 'DELETE')
 
     def get(self, payment_id):
         "Display results of previous search."
+        pmt = PaymentDAO.get(int(payment_id))
+        return search_result(pmt)
         
     def post(self, payment_id):
-        "Search for paths and return results."
+        "Start a search for paths and return its job."
+        pmt = PaymentDAO.get(int(payment_id))
+        if pmt.status not in (REQUESTED, APPROVED):
+            raise ValueError("Can't search for paths for a closed payment.")
+        payment_id = pmt.id
+        job = search_jobs.submit(
+            payment_id, lambda job: run_path_search(payment_id, job))
+        return {'job': job.data_dict()}
+
+    def delete(self, payment_id):
+        "Cancel search.  Paths found so far are kept."
+        pmt = PaymentDAO.get(int(payment_id))
+        search_jobs.cancel(pmt.id)
+        return search_result(pmt)
 
 class PaymentCommitHandler(RequestHandler):
     allowed_methods = ('POST',)
@@ -81,6 +119,18 @@ class PaymentCommitHandler(RequestHandler):
         Paths must match what was most recently returned from
         path search handler.
         """
+        pmt = PaymentDAO.get(int(payment_id))
+        if pmt.status != APPROVED:
+            raise ValueError("Only approved payments can be committed.")
+        job = search_jobs.get(pmt.id)
+        if job is not None and not job.is_finished():
+            raise ValueError("Path search still running.")
+        data = getattr(self.request, 'parsed_content', None) or {}
+        commit_payment(pmt, data.get('paths'))
+        db.commit()
+        # only now is the credit gone from the accounts
+        account_reservations.release(pmt.id)
+        return {'id': pmt.id, 'status': pmt.status}
         
 class PaymentRequestListHandler(RippleObjectListHandler):
     """Check payment requests to client.
@@ -95,8 +145,275 @@ class PaymentRequestListHandler(RippleObjectListHandler):
         "Get payment requests for this client."
 
 
-def path_search(pmt):
-    "Find and store paths for payment."
+SQL_GET_LINKS = """
+SELECT a.id, p.id, pa.address_id,
+       a.balance, al.upper_limit, al.lower_limit,
+       p.balance, pl.upper_limit, pl.lower_limit
+FROM account_addresses aa
+JOIN account a ON a.id = aa.account_id
+JOIN account p ON p.relationship_id = a.relationship_id AND p.id <> a.id
+JOIN account_addresses pa ON pa.account_id = p.id
+LEFT JOIN account_limits al ON al.account_id = a.id AND al.is_active = :active
+LEFT JOIN account_limits pl ON pl.account_id = p.id AND pl.is_active = :active
+WHERE aa.address_id = :node AND a.is_active = :active AND p.is_active = :active
+"""
+
+# exchanges through a node, from or to account :acct
+SQL_GET_EXCHANGES = """
+SELECT e.%s_account_id, v.value
+FROM exchange e
+LEFT JOIN exchange_exchange_rate eer
+     ON eer.exchange_id = e.id AND eer.is_active = :active
+LEFT JOIN exchange_rate_value v
+     ON v.rate_id = eer.rate_id AND v.is_active = :active
+WHERE e.%s_account_id = :acct AND e.is_active = :active
+"""
+
+def paying_room(balance, lower_limit):
+    "How much an account can pay, in fixed point.  No limit means 0."
+    return to_fixed(balance) - to_fixed(lower_limit or 0)
+
+def receiving_room(balance, upper_limit):
+    "How much an account can receive, in fixed point.  No limit means 0."
+    return to_fixed(upper_limit or 0) - to_fixed(balance)
+
+class AccountPathSearch(PathSearch):
+    """PathSearch over the account tables.  Nodes are addresses,
+    linked by the two accounts of each relationship.  Payments only
+    pass through a node between accounts it has an active exchange
+    for.  Found paths are stored as they come (all of them again
+    when the search reroutes some), and the search stops when job
+    (if given) is cancelled or times out.  The credit of stored
+    paths is held in account_reservations, out of other payments'
+    searches, until the payment is committed or the holds expire.
+    """
+    def __init__(self, pmt, job=None):
+        data_obj = pmt.data_obj
+        # search from the end whose amount is fixed
+        PathSearch.__init__(self, [data_obj.payer.id],
+                            [data_obj.recipient.id],
+                            [data_obj.amount], [None],
+                            backward=data_obj.amount_for_recipient)
+        self.pmt = pmt
+        self.job = job
+        
+    def get_next_hop_list(self, node, in_acct, dest_list):
+        if in_acct is not None:
+            exchange_rates = self.get_exchange_rates(in_acct)
+        hop_list = []
+        for row in db.execute(SQL_GET_LINKS,
+                              {'node': node, 'active': True}).fetchall():
+            acct, partner_acct, partner_node = row[:3]
+            if in_acct is None:
+                exchange_rate = ONE
+            elif acct in exchange_rates:
+                exchange_rate = exchange_rates[acct]
+            else:
+                continue
+            if self.backward:  # partner pays acct
+                credit = min(paying_room(row[6], row[8]),
+                             receiving_room(row[3], row[4]))
+            else:
+                credit = min(paying_room(row[3], row[5]),
+                             receiving_room(row[6], row[7]))
+            link = Link(node, partner_node, acct, partner_acct, self.backward)
+            # less what other payments' paths hold
+            credit -= account_reservations.get_reserved(
+                link.paying_acct, link.receiving_acct, self.pmt.id)
+            hop_list.append(Hop(link, credit, exchange_rate, None))
+        return hop_list
+
+    def get_exchange_rates(self, in_acct):
+        """Returns {<acct>: <exchange rate from in_acct units>} for
+        accounts the node passes payments to/from in_acct through.
+        Rate values are target account units per source account unit.
+        """
+        if self.backward:  # payment goes from acct to in_acct
+            query = SQL_GET_EXCHANGES % ('source', 'target')
+        else:
+            query = SQL_GET_EXCHANGES % ('target', 'source')
+        exchange_rates = {}
+        for acct, value in db.execute(query, {'acct': in_acct,
+                                              'active': True}).fetchall():
+            if value is None:
+                exchange_rates[acct] = ONE
+            elif value > 0:
+                if self.backward:
+                    exchange_rates[acct] = fixed_div(ONE, to_fixed(value))
+                else:
+                    exchange_rates[acct] = to_fixed(value)
+        return exchange_rates
+
+    def path_found(self, node, path):
+        self.store(PathSet([path]))
+
+    def paths_rerouted(self, node, pathset):
+        delete_paths(self.pmt)
+        account_reservations.release(self.pmt.id)
+        self.store(pathset)
+
+    def store(self, pathset):
+        PaymentPathDAO.create_from_pathset(self.pmt.id, pathset)
+        db.commit()  # make it visible to GET right away
+        for path in pathset.path_list:
+            for elt in path.element_list:
+                account_reservations.reserve(
+                    self.pmt.id,
+                    [(elt.link.paying_acct, elt.link.receiving_acct)],
+                    elt.amount)
+        if self.job is not None:
+            self.job.check()
+
+    def should_stop(self):
+        return self.job is not None and self.job.stopped()
+
+def run_path_search(payment_id, job):
+    """Body of a search job.  Runs in a search_jobs thread.
+    A cancelled or failed search gives up the credit held for the
+    payment.
+    """
+    try:
+        path_search(PaymentDAO.get(payment_id), job)
+    except:
+        account_reservations.release(payment_id)
+        raise
+    finally:
+        db.close()
+
+def path_search(pmt, job=None):
+    """Find and store paths for payment, replacing those of
+    earlier searches.  Raises jobs.JobStopped if job stops first.
+    """
+    delete_paths(pmt)
+    db.commit()
+    account_reservations.release(pmt.id)
+    try:
+        AccountPathSearch(pmt, job).find_pathset()
+    except HopLimitReached:
+        pass
+    if job is not None:
+        job.check()
+
+def delete_paths(pmt):
+    path_ids = sql.select([payment_path_table.c.id],
+                          payment_path_table.c.payment_id == pmt.id)
+    db.execute(payment_link_table.delete(
+        payment_link_table.c.path_id.in_(path_ids)))
+    db.execute(payment_path_table.delete(
+        payment_path_table.c.payment_id == pmt.id))
     
 def get_paths(pmt):
     "Retrieve stored paths for payment."
+    query = sql.select([payment_path_table.c.id,
+                        payment_path_table.c.payer_amount,
+                        payment_path_table.c.recipient_amount,
+                        account_table.c.name],
+                       sql.and_(payment_path_table.c.payment_id == pmt.id,
+                                payment_link_table.c.path_id ==
+                                payment_path_table.c.id,
+                                payment_link_table.c.sequence_number == 0,
+                                account_table.c.id ==
+                                payment_link_table.c.paying_account_id),
+                       order_by=[payment_path_table.c.id])
+    return [{'id': path_id,
+             'paying_account': paying_account,
+             'payer_amount': payer_amount,
+             'recipient_amount': recipient_amount}
+            for path_id, payer_amount, recipient_amount, paying_account
+            in db.execute(query).fetchall()]
+
+def commit_payment(pmt, path_ids=None):
+    """Moves the payment's amounts along its stored paths.
+
+    The payment row is locked first, and the payment must still be
+    approved - so a payment can't be committed twice, even by
+    concurrent requests.  Everything that doesn't need more locks is
+    worked out next: the balance change of every account involved,
+    and whether the paths cover the payment amount.  Then all those
+    accounts are locked in one SELECT ... FOR UPDATE in id order
+    (the same order in every commit, so concurrent commits can't
+    deadlock), their limits are checked against the current
+    balances, and all balances are changed with one UPDATE.  Limit
+    changes lock the account row too (AccountDAO.new_limits), so
+    limits can't change under a commit.
+    Raises ValueError if the payment is no longer approved, the
+    paths are not path_ids (when given) or a limit would be
+    exceeded; the caller must then roll back.  Holds on the
+    paths' credit are left for the caller to release once the
+    transaction is committed.
+    """
+    status_query = sql.select([payment_table.c.status],
+                              payment_table.c.id == pmt.id, for_update=True)
+    if db.execute(status_query).fetchone()[0] != APPROVED:
+        raise ValueError("Only approved payments can be committed.")
+    query = sql.select([payment_path_table.c.id,
+                        payment_path_table.c.payer_amount,
+                        payment_path_table.c.recipient_amount,
+                        payment_link_table.c.paying_account_id,
+                        payment_link_table.c.receiving_account_id,
+                        payment_link_table.c.amount],
+                       sql.and_(payment_path_table.c.payment_id == pmt.id,
+                                payment_link_table.c.path_id ==
+                                payment_path_table.c.id))
+    path_amounts = {}  # path id: (payer amount, recipient amount)
+    deltas = {}  # account id: balance change, in fixed point
+    for (path_id, payer_amount, recipient_amount,
+         paying_acct, receiving_acct, amount) in db.execute(query).fetchall():
+        path_amounts[path_id] = (payer_amount, recipient_amount)
+        amount = to_fixed(amount)
+        deltas[paying_acct] = deltas.get(paying_acct, 0) - amount
+        deltas[receiving_acct] = deltas.get(receiving_acct, 0) + amount
+    if path_ids is not None and \
+           sorted(path_amounts.keys()) != sorted(path_ids):
+        raise ValueError("Paths have changed since they were retrieved.")
+    if pmt.amount_for_recipient:
+        index = 1
+    else:
+        index = 0
+    total = sum([to_fixed(amounts[index])
+                 for amounts in path_amounts.values()])
+    if total != to_fixed(pmt.amount):
+        raise ValueError("Paths don't carry the payment amount.")
+
+    acct_ids = sorted(deltas.keys())
+    lock_query = sql.select([account_table.c.id, account_table.c.balance,
+                             account_table.c.is_active],
+                            account_table.c.id.in_(acct_ids),
+                            order_by=[account_table.c.id], for_update=True)
+    accounts = db.execute(lock_query).fetchall()
+    limits_query = sql.select([account_limits_table.c.account_id,
+                               account_limits_table.c.upper_limit,
+                               account_limits_table.c.lower_limit],
+                              sql.and_(account_limits_table.c.account_id.in_(
+                                           acct_ids),
+                                       account_limits_table.c.is_active ==
+                                       True))
+    limits = dict([(acct, (upper_limit, lower_limit))
+                   for acct, upper_limit, lower_limit
+                   in db.execute(limits_query).fetchall()])
+    if len(accounts) != len(acct_ids):
+        raise ValueError("Account on payment path no longer exists.")
+    for acct, balance, is_active in accounts:
+        if not is_active:
+            raise ValueError("Account on payment path is inactive.")
+        upper_limit, lower_limit = limits.get(acct, (None, None))
+        delta = deltas[acct]
+        if delta < 0 and paying_room(balance, lower_limit) < -delta or \
+               delta > 0 and receiving_room(balance, upper_limit) < delta:
+            raise ValueError("Account limit exceeded - search again.")
+
+    balance_type = account_table.c.balance.type
+    db.execute(account_table.update(
+        account_table.c.id.in_(acct_ids),
+        values={'balance': account_table.c.balance + sql.case(
+            [(account_table.c.id == acct,
+              sql.literal(from_fixed(deltas[acct]), balance_type))
+             for acct in acct_ids])}))
+    pmt.status = COMPLETED
+    pmt.data_obj.commit_date = datetime.now()
+    db.flush()
+
+def search_result(pmt):
+    job = search_jobs.get(pmt.id)
+    return {'job': job and job.data_dict() or None,
+            'paths': get_paths(pmt)}
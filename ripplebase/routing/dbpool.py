@@ -0,0 +1,240 @@
+"""
+Connection pool for the routing DB. Threads check connections out of the pool
+instead of sharing one module-global connection and cursor.
+"""
+
+##################
+# Copyright 2008, Jevgenij Solovjov
+#
+# This file is part of Ripplebase.
+#
+# Ripplebase is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ripplebase is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with Ripplebase, in the file LICENSE.txt.  If not,
+# see <http://www.gnu.org/licenses/>.
+##################
+
+import threading
+import time
+from psycopg import connect
+
+# Maximum number of connections per pool - matches the default maximum size of
+# Twisted's reactor thread pool, since every thread holds at most one connection.
+POOL_MAX_SIZE = 10
+# Seconds checkout() waits for a connection to be checked in, when the pool is full
+POOL_CHECKOUT_TIMEOUT = 30.0
+# Statement run on connections idle for more than HEALTH_CHECK_INTERVAL seconds,
+# before handing them out again
+HEALTH_CHECK_STATEMENT = "SELECT 1"
+HEALTH_CHECK_INTERVAL = 30.0
+
+class ConnectionPoolEx(Exception):
+    pass
+
+class PooledConnection(object):
+    """
+    A pooled connection together with its single cursor, and per-session state
+    that goes when the connection is closed: the names of the routing.dbutil
+    prepared statements of the session.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.last_used = time.time()
+        self.prepared = set([])
+
+    def is_healthy(self):
+        try:
+            self.cursor.execute(HEALTH_CHECK_STATEMENT)
+            self.cursor.fetchone()
+        except Exception:
+            return False
+        return True
+
+    def close(self):
+        try:
+            self.conn.close()
+        except Exception:
+            pass    # already broken
+
+class ConnectionPool(object):
+    """
+    Holds up to max_size autocommit connections to one database. min_size
+    connections are opened right away; by default, none is opened before the 
+    first checkout() or warm_up(). checkout() hands out an idle connection
+    (health-checked first if it has been idle for a while - broken ones are
+    replaced) or opens a new one; when max_size connections are all in use, it
+    waits for a checkin().
+    """
+    def __init__(self, connect_str, max_size = None, min_size = 0, connect_fn = connect):
+        if max_size is None:
+            max_size = POOL_MAX_SIZE
+        self.connect_str = connect_str
+        self.max_size = max_size
+        self.connect_fn = connect_fn
+        self._idle = []
+        self._size = 0      # open connections, idle or checked out
+        self.thread_local = threading.local()   # connections held by ThreadCursors
+        self._cond = threading.Condition()
+        for i in xrange(min_size):
+            self._idle.append(self._open())
+            self._size += 1
+
+    def warm_up(self, count = 1):
+        """
+        Opens connections until at least 'count' of them are idle (or the pool is
+        full), so that the first requests do not pay for connecting.
+        """
+        self._cond.acquire()
+        try:
+            while len(self._idle) < count and self._size < self.max_size:
+                self._idle.append(self._open())
+                self._size += 1
+        finally:
+            self._cond.release()
+
+    def _open(self):
+        conn = self.connect_fn(self.connect_str)
+        conn.autocommit()
+        return PooledConnection(conn)
+
+    def checkout(self, timeout = None):
+        """
+        Returns a PooledConnection. Raises ConnectionPoolEx if none becomes
+        available within 'timeout' seconds (POOL_CHECKOUT_TIMEOUT by default).
+        """
+        if timeout is None:
+            timeout = POOL_CHECKOUT_TIMEOUT
+        deadline = time.time() + timeout
+        self._cond.acquire()
+        try:
+            while True:
+                while self._idle:
+                    pooled = self._idle.pop()
+                    if time.time() - pooled.last_used < HEALTH_CHECK_INTERVAL \
+                           or pooled.is_healthy():
+                        return pooled
+                    pooled.close()
+                    self._size -= 1
+                if self._size < self.max_size:
+                    self._size += 1     # reserve the slot while connecting
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise ConnectionPoolEx("No routing DB connection available "
+                                           "(%d in use)" % self._size)
+                self._cond.wait(remaining)
+        finally:
+            self._cond.release()
+        try:
+            return self._open()
+        except:
+            self._discard_slot()
+            raise
+
+    def checkin(self, pooled, broken = False):
+        """
+        Returns a connection to the pool. Broken connections are closed instead.
+        """
+        self._cond.acquire()
+        try:
+            if broken:
+                pooled.close()
+                self._size -= 1
+            else:
+                pooled.last_used = time.time()
+                self._idle.append(pooled)
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def _discard_slot(self):
+        self._cond.acquire()
+        try:
+            self._size -= 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def size(self):
+        return self._size
+
+    def idle_count(self):
+        return len(self._idle)
+
+    def close(self):
+        """
+        Closes the idle connections. Connections checked out at the moment are
+        closed when they are checked in broken, or stay usable until then.
+        """
+        self._cond.acquire()
+        try:
+            while self._idle:
+                self._idle.pop().close()
+                self._size -= 1
+        finally:
+            self._cond.release()
+
+class ThreadCursor(object):
+    """
+    Stands in for a module-global cursor: every thread gets the cursor of its own
+    pooled connection, checked out on first use and held until release(). Cursor
+    methods and attributes (execute, fetchall, copy_from, ...) are forwarded.
+
+    ThreadCursors on the same pool share the thread's connection, so a thread never
+    holds more than one connection of a pool. Whoever is done with it first
+    releases it; the next use checks one out again.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self._local = pool.thread_local
+
+    def current_connection(self):
+        pooled = getattr(self._local, 'pooled', None)
+        if pooled is None:
+            pooled = self._local.pooled = self.pool.checkout()
+        return pooled
+
+    def current_cursor(self):
+        return self.current_connection().cursor
+
+    def __getattr__(self, name):
+        return getattr(self.current_cursor(), name)
+
+    def commit(self):
+        self.current_connection().conn.commit()
+
+    def release(self, broken = False):
+        """
+        Checks the calling thread's connection back into the pool. Must not be
+        called within a transaction.
+        """
+        pooled = getattr(self._local, 'pooled', None)
+        if pooled is not None:
+            self._local.pooled = None
+            self.pool.checkin(pooled, broken)
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(connect_str, **kwargs):
+    """
+    Returns the pool for connect_str, creating it (with kwargs) on first request, so
+    that modules using the same database share connections.
+    """
+    _pools_lock.acquire()
+    try:
+        if connect_str not in _pools:
+            _pools[connect_str] = ConnectionPool(connect_str, **kwargs)
+        return _pools[connect_str]
+    finally:
+        _pools_lock.release()
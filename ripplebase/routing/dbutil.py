@@ -0,0 +1,85 @@
+"""
+Helpers for routing DB access: server-side prepared statements and array parameters.
+"""
+
+##################
+# Copyright 2008, Jevgenij Solovjov
+#
+# This file is part of Ripplebase.
+#
+# Ripplebase is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ripplebase is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with Ripplebase, in the file LICENSE.txt.  If not,
+# see <http://www.gnu.org/licenses/>.
+##################
+
+def int_array(values):
+    """
+    Renders a sequence of integers as a Postgres array literal ('{1,2,3}'), to be
+    passed as a single int4[] parameter - e.g. for "src_node_id = ANY($2)". Every
+    value goes through int(), so nothing but numbers ends up in the literal.
+    """
+    return "{%s}" % ",".join([str(int(value)) for value in values])
+
+class PreparedStatement(object):
+    """
+    Server-side prepared statement. The statement is planned once per DB session
+    (PREPARE), and each call only sends the parameters (EXECUTE). 'sql' refers to
+    parameters as $1, $2, ...; 'types' lists their Postgres types, e.g.
+
+        s = PreparedStatement("get_distance", ("int4", "int4"),
+            "SELECT distance FROM routing_table WHERE src_node_id = $1 AND dest_node_id = $2")
+        s.execute(curs, (src, dest))
+
+    Prepared statements belong to a session. On a routing.dbpool.ThreadCursor, the
+    statements prepared are recorded on the pooled connection, and go with it when
+    the pool closes it. Other cursors are remembered by the statement - it is
+    assumed that every connection is used through a single cursor, which is
+    referenced for as long as the statement lives (so that its id is never reused
+    by another cursor) unless forget() is called.
+    """
+    def __init__(self, name, types, sql):
+        self.name = name
+        self.types = tuple(types)
+        self.sql = sql
+        self._prepared_cursors = {}     # {id(cursor): cursor}
+
+    def prepare(self, cursor):
+        # another module instance might have prepared it already in this session
+        cursor.execute("SELECT count(*) FROM pg_prepared_statements WHERE name = %s",
+                       (self.name,))
+        if cursor.fetchone()[0] == 0:
+            cursor.execute("PREPARE %s (%s) AS %s" % (self.name, ", ".join(self.types), self.sql))
+
+    def execute(self, cursor, params = ()):
+        # a routing.dbpool.ThreadCursor stands for a different session in every thread
+        if hasattr(cursor, 'current_connection'):
+            pooled = cursor.current_connection()
+            cursor = pooled.cursor
+            if self.name not in pooled.prepared:
+                self.prepare(cursor)
+                pooled.prepared.add(self.name)
+        elif id(cursor) not in self._prepared_cursors:
+            self.prepare(cursor)
+            self._prepared_cursors[id(cursor)] = cursor
+        if params:
+            placeholders = ", ".join(["%s"] * len(params))
+            cursor.execute("EXECUTE %s (%s)" % (self.name, placeholders), tuple(params))
+        else:
+            cursor.execute("EXECUTE %s" % self.name)
+
+    def forget(self, cursor):
+        """
+        Call when a (non-pooled) cursor's connection is closed: a new session has to
+        prepare again.
+        """
+        self._prepared_cursors.pop(id(cursor), None)
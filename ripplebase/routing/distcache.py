@@ -0,0 +1,230 @@
+"""
+Process-wide cache of routing table data: for a destination, the distances of all
+nodes to it ("reverse distance vectors"), and for a node, its neighbors. Entries are
+tagged with the routing table generation they were read from, and evicted least
+recently used first to keep within a memory budget.
+"""
+
+##################
+# Copyright 2008, Jevgenij Solovjov
+#
+# This file is part of Ripplebase.
+#
+# Ripplebase is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ripplebase is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with Ripplebase, in the file LICENSE.txt.  If not,
+# see <http://www.gnu.org/licenses/>.
+##################
+
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+from routing.dbutil import PreparedStatement
+
+# Bytes of vectors kept by the process-wide cache
+DISTANCE_CACHE_MEMORY_BUDGET = 256 * 1024 * 1024
+# Seconds for which a routing DB's generation number is trusted without reading it
+# again - cached entries can outlive a routing table refresh by this much.
+GENERATION_CHECK_INTERVAL = 1.0
+
+# The generation and the rows are read from one snapshot, so that entries are never
+# tagged with the wrong generation (see rmanager.swap_shadow_tables). A read-only
+# snapshot needs no more than REPEATABLE READ, which never fails to serialize.
+SQL_START_SNAPSHOT = "START TRANSACTION ISOLATION LEVEL REPEATABLE READ"
+SQL_COMMIT_TRANS = "COMMIT TRANSACTION"
+SQL_ROLLBACK_TRANS = "ROLLBACK TRANSACTION"
+SQL_GET_GENERATION = "SELECT generation FROM routing_generation"
+SQL_GET_DISTANCE_VECTOR = PreparedStatement("dc_get_distance_vector", ("int4",),
+    "SELECT src_node_id, distance FROM routing_table WHERE dest_node_id = $1"
+    " ORDER BY src_node_id")
+SQL_GET_NEIGHBOR_IDS = PreparedStatement("dc_get_neighbor_ids", ("int4",),
+    "SELECT dest_node_id FROM routing_table WHERE src_node_id = $1 AND distance = 1"
+    " ORDER BY dest_node_id")
+
+class DistanceVector(object):
+    """
+    Distances of nodes to one destination: node ids in a sorted array, distances in
+    a parallel one. The destination itself is at distance 0.
+    """
+    def __init__(self, dest_node_id, rows):
+        self.dest_node_id = dest_node_id
+        self.node_ids = array('i')
+        self.distances = array('i')
+        for nodeID, distance in rows:
+            self.node_ids.append(nodeID)
+            self.distances.append(distance)
+
+    def get(self, node_id):
+        """
+        Distance from node_id to the destination, or None if there is no route.
+        """
+        if node_id == self.dest_node_id:
+            return 0
+        i = bisect_left(self.node_ids, node_id)
+        if i < len(self.node_ids) and self.node_ids[i] == node_id:
+            return self.distances[i]
+        return None
+
+    def nbytes(self):
+        return (len(self.node_ids) + len(self.distances)) * self.node_ids.itemsize
+
+class DistanceVectorCache(object):
+    """
+    Thread-safe LRU map of (connect_str, kind, node id, generation) keys to vectors
+    (anything with an nbytes() method), holding at most memory_budget bytes. Keys
+    are kept in a circular doubly linked list in order of use, least recent first,
+    so that using or evicting an entry takes constant time.
+    """
+    def __init__(self, memory_budget = None):
+        self.memory_budget = memory_budget
+        self.entries = {}
+        self.size = 0       # bytes held
+        self._links = {}    # {<key>: [<previous link>, <next link>, <key>]}
+        self._root = []     # sentinel of the list
+        self._root[:] = [self._root, self._root, None]
+        self._lock = threading.Lock()
+
+    def _unlink(self, link):
+        prevLink, nextLink = link[0], link[1]
+        prevLink[1] = nextLink
+        nextLink[0] = prevLink
+
+    def _append(self, link):
+        # as the most recently used
+        root = self._root
+        last = root[0]
+        link[0], link[1] = last, root
+        last[1] = root[0] = link
+
+    def _touch(self, key):
+        link = self._links.get(key)
+        if link is None:
+            link = self._links[key] = [None, None, key]
+        else:
+            self._unlink(link)
+        self._append(link)
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            vector = self.entries.get(key)
+            if vector is not None:
+                self._touch(key)
+            return vector
+        finally:
+            self._lock.release()
+
+    def put(self, key, vector):
+        budget = self.memory_budget or DISTANCE_CACHE_MEMORY_BUDGET
+        nbytes = vector.nbytes()
+        if nbytes > budget:
+            return      # would evict everything else
+        self._lock.acquire()
+        try:
+            if key in self.entries:
+                self.size -= self.entries[key].nbytes()
+            self.entries[key] = vector
+            self._touch(key)
+            self.size += nbytes
+            while self.size > budget:
+                oldest = self._root[1]
+                self._unlink(oldest)
+                del self._links[oldest[2]]
+                self.size -= self.entries.pop(oldest[2]).nbytes()
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self.entries.clear()
+            self._links.clear()
+            self._root[:] = [self._root, self._root, None]
+            self.size = 0
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self.entries)
+
+class NeighborVector(object):
+    def __init__(self, rows):
+        self.node_ids = array('i', [row[0] for row in rows])
+
+    def nbytes(self):
+        return len(self.node_ids) * self.node_ids.itemsize
+
+cache = DistanceVectorCache()
+_generations = {}    # {<connect_str>: (<generation>, <time read>)}
+
+def _read_generation(curs):
+    # routing DBs without a routing_generation table never change generation
+    curs.execute("SELECT count(*) FROM pg_tables WHERE tablename = 'routing_generation'")
+    if curs.fetchone()[0] == 0:
+        return 0
+    curs.execute(SQL_GET_GENERATION)
+    row = curs.fetchone()
+    return row and row[0] or 0
+
+def get_generation(curs):
+    """
+    Generation of the routing table behind curs (a routing.dbpool.ThreadCursor),
+    read from the DB at most every GENERATION_CHECK_INTERVAL seconds.
+    """
+    connectStr = curs.pool.connect_str
+    now = time.time()
+    known = _generations.get(connectStr)
+    if known is not None and now - known[1] < GENERATION_CHECK_INTERVAL:
+        return known[0]
+    generation = _read_generation(curs)
+    _generations[connectStr] = (generation, now)
+    return generation
+
+def _load(curs, statement, node_id, make_vector):
+    curs.execute(SQL_START_SNAPSHOT)
+    try:
+        generation = _read_generation(curs)
+        statement.execute(curs, (node_id,))
+        vector = make_vector(curs.fetchall())
+    except:
+        curs.execute(SQL_ROLLBACK_TRANS)
+        raise
+    curs.execute(SQL_COMMIT_TRANS)
+    return generation, vector
+
+def _get_cached(curs, kind, node_id, statement, make_vector):
+    connectStr = curs.pool.connect_str
+    generation = get_generation(curs)
+    vector = cache.get((connectStr, kind, node_id, generation))
+    if vector is None:
+        loadedGeneration, vector = _load(curs, statement, node_id, make_vector)
+        cache.put((connectStr, kind, node_id, loadedGeneration), vector)
+        if loadedGeneration != generation:
+            _generations[connectStr] = (loadedGeneration, time.time())
+    return vector
+
+def get_distance_vector(curs, dest_node_id):
+    """
+    DistanceVector of dest_node_id in the routing table behind curs, from the cache
+    if it holds one of the current generation.
+    """
+    return _get_cached(curs, 'dist', dest_node_id, SQL_GET_DISTANCE_VECTOR,
+                       lambda rows: DistanceVector(dest_node_id, rows))
+
+def get_neighbor_ids(curs, node_id):
+    """
+    Sorted array of the ids of node_id's neighbors (routing table distance 1).
+    """
+    return _get_cached(curs, 'neighbors', node_id, SQL_GET_NEIGHBOR_IDS,
+                       NeighborVector).node_ids
@@ -0,0 +1,169 @@
+"""
+Landmark distance oracle: BFS distances from and to a few landmark nodes, bounding
+the distance between any two nodes by the triangle inequality. Takes k*n space,
+against the n^2 of the full routing table.
+"""
+
+##################
+# Copyright 2008, Jevgenij Solovjov
+#
+# This file is part of Ripplebase.
+#
+# Ripplebase is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ripplebase is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with Ripplebase, in the file LICENSE.txt.  If not,
+# see <http://www.gnu.org/licenses/>.
+##################
+
+from array import array
+from routing.smallworld import get_neighbors, ids
+from routing.rindex import RoutingIndex
+
+# Default number of landmarks. Every landmark costs two BFS runs to build, and two
+# array lookups per landmark per estimate.
+LANDMARKS_COUNT = 16
+# distance stored for nodes that a landmark cannot reach (or be reached from)
+UNREACHABLE = -1
+
+class LandmarkOracle(object):
+    """
+    For every landmark L, dist_from[k][i] holds d(L, node i) and dist_to[k][i] holds
+    d(node i, L) - the graph is directed. For any landmark,
+
+        d(s, t) <= d(s, L) + d(L, t)
+        d(s, t) >= d(L, t) - d(L, s)
+        d(s, t) >= d(s, L) - d(t, L)
+
+    Landmarks are picked by highest degree: in a small world graph, the hubs lie on
+    (or next to) many shortest paths, which keeps the upper bound tight.
+    """
+    def __init__(self, landmarks, node_ids, dist_from, dist_to):
+        self.landmarks = list(landmarks)
+        self.node_ids = node_ids
+        self.index_of = dict([(id, i) for i, id in enumerate(node_ids)])
+        self.dist_from = dist_from
+        self.dist_to = dist_to
+
+    @classmethod
+    def build(cls, get_ids_fn = ids, get_neighbors_fn = get_neighbors,
+              landmarks_count = LANDMARKS_COUNT):
+        index = RoutingIndex(get_ids_fn, get_neighbors_fn)
+        return cls.from_routing_index(index, landmarks_count)
+
+    @classmethod
+    def from_routing_index(cls, index, landmarks_count = LANDMARKS_COUNT):
+        n = index.nodes_count()
+        # (-degree, index) pairs: highest degree first, ties broken by index
+        degrees = [(index.offsets[i] - index.offsets[i + 1]
+                    + index.rev_offsets[i] - index.rev_offsets[i + 1], i) for i in xrange(n)]
+        degrees.sort()
+        landmarkIndexes = [i for negDegree, i in degrees[:landmarks_count]]
+        dist_from = [_bfs_distances(l, index.offsets, index.targets, n) for l in landmarkIndexes]
+        dist_to = [_bfs_distances(l, index.rev_offsets, index.rev_targets, n) for l in landmarkIndexes]
+        return cls([index.node_ids[l] for l in landmarkIndexes], index.node_ids,
+                   dist_from, dist_to)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Builds the oracle from (landmark_id, node_id, distance_from, distance_to)
+        rows, as produced by rows() and stored in landmark_table.
+        """
+        rows = list(rows)
+        landmarks = sorted(set([row[0] for row in rows]))
+        node_ids = array('i', sorted(set([row[1] for row in rows])))
+        position = dict([(id, i) for i, id in enumerate(node_ids)])
+        dist_from = [array('i', [UNREACHABLE]) * len(node_ids) for l in landmarks]
+        dist_to = [array('i', [UNREACHABLE]) * len(node_ids) for l in landmarks]
+        k = dict([(l, i) for i, l in enumerate(landmarks)])
+        for landmark, node, distanceFrom, distanceTo in rows:
+            dist_from[k[landmark]][position[node]] = distanceFrom
+            dist_to[k[landmark]][position[node]] = distanceTo
+        return cls(landmarks, node_ids, dist_from, dist_to)
+
+    def rows(self):
+        """
+        Yields (landmark_id, node_id, distance_from, distance_to) tuples for storage;
+        nodes entirely disconnected from a landmark are left out.
+        """
+        for k, landmark in enumerate(self.landmarks):
+            distFrom, distTo = self.dist_from[k], self.dist_to[k]
+            for i, node in enumerate(self.node_ids):
+                if distFrom[i] != UNREACHABLE or distTo[i] != UNREACHABLE:
+                    yield landmark, node, distFrom[i], distTo[i]
+
+    def has_node(self, node_id):
+        return node_id in self.index_of
+
+    def upper_bound(self, src_node_id, dest_node_id):
+        """
+        Length of the shortest walk from src to dest through some landmark; None if
+        no landmark connects them (or either node is unknown).
+        """
+        if src_node_id == dest_node_id: return 0
+        try:
+            s = self.index_of[src_node_id]
+            t = self.index_of[dest_node_id]
+        except KeyError:
+            return None
+        best = None
+        for k in xrange(len(self.landmarks)):
+            toLandmark = self.dist_to[k][s]
+            fromLandmark = self.dist_from[k][t]
+            if toLandmark == UNREACHABLE or fromLandmark == UNREACHABLE:
+                continue
+            if best is None or toLandmark + fromLandmark < best:
+                best = toLandmark + fromLandmark
+        return best
+
+    def lower_bound(self, src_node_id, dest_node_id):
+        """
+        Lower bound of the distance from src to dest (0 for unknown nodes).
+        """
+        if src_node_id == dest_node_id: return 0
+        try:
+            s = self.index_of[src_node_id]
+            t = self.index_of[dest_node_id]
+        except KeyError:
+            return 0
+        best = 1
+        for k in xrange(len(self.landmarks)):
+            distFrom, distTo = self.dist_from[k], self.dist_to[k]
+            if distFrom[s] != UNREACHABLE and distFrom[t] != UNREACHABLE:
+                best = max(best, distFrom[t] - distFrom[s])
+            if distTo[s] != UNREACHABLE and distTo[t] != UNREACHABLE:
+                best = max(best, distTo[s] - distTo[t])
+        return best
+
+    def estimate(self, src_node_id, dest_node_id):
+        """
+        Distance estimate for ordering hops: the upper bound, which is exact when
+        some landmark lies on a shortest path from src to dest.
+        """
+        return self.upper_bound(src_node_id, dest_node_id)
+
+def _bfs_distances(start, offsets, targets, n):
+    distances = array('i', [UNREACHABLE]) * n
+    distances[start] = 0
+    frontier = [start]
+    distance = 0
+    while frontier:
+        distance += 1
+        newFrontier = []
+        for i in frontier:
+            for pos in xrange(offsets[i], offsets[i + 1]):
+                j = targets[pos]
+                if distances[j] == UNREACHABLE:
+                    distances[j] = distance
+                    newFrontier.append(j)
+        frontier = newFrontier
+    return distances
@@ -18,8 +18,11 @@
 # see <http://www.gnu.org/licenses/>.
 ##################
 
-from psycopg import connect
 from routing.rmanager import ROUTING_DB_CONNECT_STR
+from routing.dbpool import get_pool, ThreadCursor
+from routing.rindex import RoutingIndex
+from routing.dbutil import PreparedStatement, int_array
+from routing.distcache import get_distance_vector, get_neighbor_ids
 
 class PathFinderEx(Exception):
     pass
@@ -33,35 +36,114 @@ SQL_START_TRANS = "START TRANSACTION"
 SQL_COMMIT_TRANS = "COMMIT TRANSACTION"
 SQL_ROLLBACK_TRANS = "ROLLBACK TRANSACTION"
 
-# connect to the routing DB
-try:
-    conn = connect(ROUTING_DB_CONNECT_STR)
-    curs = conn.cursor() # connect to the routing table storage database
-except:
-    raise RoutingTableEx(e)
-conn.autocommit()
+# connect to the routing DB - through the pool shared with rmanager, on first use 
+# (or warm_up()). A thread keeps its connection for the duration of a 
+# find_shortest_path(s) call.
+pool = get_pool(ROUTING_DB_CONNECT_STR)
+curs = ThreadCursor(pool)
+
+# Routing table queries, prepared once per connection; node lists are passed as arrays
+SQL_GET_DISTANCE = PreparedStatement("pf_get_distance", ("int4", "int4"),
+    "SELECT distance FROM routing_table WHERE src_node_id = $1 AND dest_node_id = $2")
+# finds first node 1 hop away from the current hop ($1) and $3 hops away from the
+# destination ($2)
+SQL_FIND_NEXT_HOP = PreparedStatement("pf_find_next_hop", ("int4", "int4", "int4"),
+    "SELECT hop_id FROM"
+    " (SELECT dest_node_id AS hop_id FROM routing_table"
+    " WHERE src_node_id = $1 AND distance = 1) AS source_part JOIN"
+    " (SELECT src_node_id AS hop_id FROM routing_table"
+    " WHERE dest_node_id = $2 AND distance = $3) AS dest_part"
+    " USING (hop_id) LIMIT 1")
+SQL_GET_DISTANCES_TO = PreparedStatement("pf_get_distances_to", ("int4", "int4[]"),
+    "SELECT src_node_id, distance FROM routing_table"
+    " WHERE dest_node_id = $1 AND src_node_id = ANY($2)")
+# For every node in the $2 array, returns one neighbor that is one hop closer to the
+# destination ($1), together with the neighbor's distance to the destination.
+SQL_FIND_NEXT_HOPS = PreparedStatement("pf_find_next_hops", ("int4", "int4[]"),
+    "SELECT DISTINCT ON (hop.src_node_id)"
+    " hop.src_node_id, hop.dest_node_id, rest.distance"
+    " FROM routing_table AS hop"
+    " JOIN routing_table AS curr ON curr.src_node_id = hop.src_node_id"
+    " AND curr.dest_node_id = $1"
+    " JOIN routing_table AS rest ON rest.src_node_id = hop.dest_node_id"
+    " AND rest.dest_node_id = $1"
+    " WHERE hop.distance = 1 AND rest.distance = curr.distance - 1"
+    " AND hop.src_node_id = ANY($2)"
+    " ORDER BY hop.src_node_id")
+
+# In-memory routing index (see routing.rindex) used by find_shortest_path, if set.
+# The routing DB is queried only for nodes the index does not know about.
+routing_index = None
+# Otherwise, paths are put together from the process-wide cache of routing table data
+# (routing.distcache) if set, or found with routing_table queries
+use_distance_cache = True
+
+def load_routing_index(get_ids_fn = None, get_neighbors_fn = None):
+    """
+    Builds a RoutingIndex from the graph (routing.smallworld by default) and makes
+    find_shortest_path use it. Call again after the graph changes; lookups running
+    meanwhile keep using the previous index.
+    """
+    global routing_index
+    kwargs = {}
+    if get_ids_fn is not None: kwargs['get_ids_fn'] = get_ids_fn
+    if get_neighbors_fn is not None: kwargs['get_neighbors_fn'] = get_neighbors_fn
+    routing_index = RoutingIndex(**kwargs)
+    return routing_index
+
+def warm_up(load_index = False):
+    """
+    Connects to the routing DB ahead of the first lookup and, if load_index is 
+    True, builds the routing index as well.
+    """
+    pool.warm_up()
+    if load_index:
+        load_routing_index()
+
+def unload_routing_index():
+    global routing_index
+    routing_index = None
 
 def find_shortest_path(src_node_id, dest_node_id):
     """
-    Issues a series of queries to the DB, to find:
+    If a routing index is loaded and knows both nodes, the path is found in memory.
+    Otherwise, issues a series of queries to the DB, to find:
       - the length of shortest path between src_node_id and dest_node_id;
       - the nodes - "milestones" of the shortest path;
       - the sequence of traversing the nodes.
-    WARNING! INPUT INVALIDATED!!! - *** to be fixed (SQL_GET_DISTANCE, SQL_GET_MILESTONES)
     """
-    global conn, curs
+    global curs
 
     # check if source and destination coincide; return 0 and empty path if they do
     if src_node_id == dest_node_id: return 0, []    
-    
-    # begin a transaction - work on a database snapshot
+
+    index = routing_index
+    if index is not None and index.has_node(src_node_id) and index.has_node(dest_node_id):
+        result = index.shortest_path(src_node_id, dest_node_id)
+        if result is None:
+            raise PathFinderNoEntryEx("No route between the nodes")
+        return result
+    try:
+        if use_distance_cache:
+            result = _find_shortest_paths_cached(dest_node_id, [src_node_id]).get(src_node_id)
+            if result is None:
+                raise PathFinderNoEntryEx("No appropriate DB entry")
+            return result
+        return _find_shortest_path_in_db(src_node_id, dest_node_id)
+    finally:
+        curs.release()  # hand the connection back to the pool
+
+def _find_shortest_path_in_db(src_node_id, dest_node_id):
+    global curs
+    # begin a transaction - work on a database snapshot. The first query locks
+    # routing_table until the transaction ends, so a concurrent refresh cannot swap
+    # in a new generation half way through the path (see rmanager.swap_shadow_tables);
+    # every return or raise below must end the transaction, or refreshes will block.
     curs.execute(SQL_START_TRANS)
     
     # issue SQL statement to fetch distance between source and destination 
-    SQL_GET_DISTANCE = "SELECT distance FROM routing_table WHERE src_node_id = %s AND dest_node_id = %s" %\
-        (src_node_id, dest_node_id)
     try:
-        curs.execute(SQL_GET_DISTANCE)
+        SQL_GET_DISTANCE.execute(curs, (src_node_id, dest_node_id))
         distance = curs.fetchone()[0]
     except:
         curs.execute(SQL_ROLLBACK_TRANS)
@@ -77,7 +159,7 @@ def find_shortest_path(src_node_id, dest_node_id):
     
     # if distance == 1
     if distance == 1: 
-        
+        curs.execute(SQL_COMMIT_TRANS)
         return 1, [[src_node_id, dest_node_id]]
     
     #print "%s" % distance
@@ -93,19 +175,11 @@ def find_shortest_path(src_node_id, dest_node_id):
     #   -- return
     for i in hopsIterator:
         #print "i = %s" % i
-        SQL_FIND_NEXT_HOP = "SELECT hop_id FROM" \
-                            + " (SELECT dest_node_id AS hop_id FROM routing_table" \
-                            + " WHERE src_node_id = %s" % curr_node_id \
-                            + " AND distance = 1) AS source_part JOIN" \
-                            + " (SELECT src_node_id AS hop_id FROM routing_table" \
-                            + " WHERE dest_node_id = %s" % dest_node_id \
-                            + " AND distance = %s) AS dest_part" % (distance - i) \
-                            + " USING (hop_id) LIMIT 1"  # finds first suitable node
-        curs.execute(SQL_FIND_NEXT_HOP)
-        #print "%s" % SQL_FIND_NEXT_HOP
+        SQL_FIND_NEXT_HOP.execute(curs, (curr_node_id, dest_node_id, distance - i))
         try:
             next_node_id = curs.fetchone()[0]
         except TypeError:
+            curs.execute(SQL_ROLLBACK_TRANS)
             raise PathFinderEx("Failed to fetch next hop!")
         
         path.append([curr_node_id, next_node_id])
@@ -128,9 +202,123 @@ def find_shortest_path(src_node_id, dest_node_id):
     
     return distance, path
 
+def find_shortest_paths(pairs):
+    """
+    Batch version of find_shortest_path(). Takes a sequence of (src_node_id, 
+    dest_node_id) tuples and returns a list of (distance, path) tuples in the same
+    order, None standing for pairs with no route. Pairs are grouped by destination:
+    each group is answered with a single backwards BFS when the routing index is 
+    loaded, or else with one set-based query per hop level (see 
+    _find_shortest_paths_in_db) instead of one query per hop per pair.
+    """
+    results = [None] * len(pairs)
+    # {<dest>: {<src>: [<positions in pairs>]}}
+    groups = {}
+    for position, (src_node_id, dest_node_id) in enumerate(pairs):
+        if src_node_id == dest_node_id:
+            results[position] = (0, [])
+        else:
+            groups.setdefault(dest_node_id, {}).setdefault(src_node_id, []).append(position)
+    
+    index = routing_index
+    try:
+        for dest_node_id, srcPositions in groups.items():
+            src_node_ids = srcPositions.keys()
+            found = {}
+            if index is not None and index.has_node(dest_node_id):
+                indexed = [src for src in src_node_ids if index.has_node(src)]
+                found = index.shortest_paths_to(dest_node_id, indexed)
+                src_node_ids = [src for src in src_node_ids if not index.has_node(src)]
+            if src_node_ids and use_distance_cache:
+                found.update(_find_shortest_paths_cached(dest_node_id, src_node_ids))
+            elif src_node_ids:
+                found.update(_find_shortest_paths_in_db(dest_node_id, src_node_ids))
+            for src_node_id, positions in srcPositions.items():
+                for position in positions:
+                    results[position] = found.get(src_node_id)
+    finally:
+        curs.release()
+    return results
+
+def _find_shortest_paths_in_db(dest_node_id, src_node_ids):
+    """
+    Finds shortest paths from all src_node_ids to dest_node_id in the routing table.
+    The distances are fetched with one query; then, for all nodes on the current
+    hop level at once, one query fetches the next hop towards the destination.
+    Paths that meet share the rest of the route. Returns {<src node id>: (distance, path)}
+    for the sources that have a routing table entry.
+    """
+    global curs
+    curs.execute(SQL_START_TRANS)
+    try:
+        SQL_GET_DISTANCES_TO.execute(curs, (dest_node_id, int_array(src_node_ids)))
+        distances = dict(curs.fetchall())
+        nextHops = {}
+        level = set([node for node, distance in distances.items() if distance > 1])
+        while level:
+            SQL_FIND_NEXT_HOPS.execute(curs, (dest_node_id, int_array(level)))
+            nextLevel = set([])
+            for node, hop, hopDistance in curs.fetchall():
+                nextHops[node] = hop
+                if hop not in distances:
+                    distances[hop] = hopDistance
+                    if hopDistance > 1:
+                        nextLevel.add(hop)
+            if level - set(nextHops):
+                raise PathFinderEx("Failed to fetch next hop!")
+            level = nextLevel
+    except:
+        curs.execute(SQL_ROLLBACK_TRANS)
+        raise
+    curs.execute(SQL_COMMIT_TRANS)
+    
+    results = {}
+    for src_node_id in src_node_ids:
+        if src_node_id not in distances:
+            continue    # no route
+        path = []
+        node = src_node_id
+        while distances.get(node, 0) > 1:
+            path.append([node, nextHops[node]])
+            node = nextHops[node]
+        path.append([node, dest_node_id])
+        results[src_node_id] = (len(path), path)
+    return results
+
+def _find_shortest_paths_cached(dest_node_id, src_node_ids):
+    """
+    Same as _find_shortest_paths_in_db, from the cached distance vector of dest_node_id
+    and neighbor lists of the nodes on the way - repeated lookups for a destination
+    do not touch the DB. If the cached data do not add up (read across a routing 
+    table refresh), falls back to _find_shortest_paths_in_db.
+    """
+    vector = get_distance_vector(curs, dest_node_id)
+    nextHops = {}
+    results = {}
+    for src_node_id in src_node_ids:
+        distance = vector.get(src_node_id)
+        if distance is None or distance < 1:
+            continue    # no route
+        path = []
+        node = src_node_id
+        while distance > 1:
+            if node not in nextHops:
+                for neighbor in get_neighbor_ids(curs, node):
+                    if vector.get(neighbor) == distance - 1:
+                        nextHops[node] = neighbor
+                        break
+                else:
+                    return _find_shortest_paths_in_db(dest_node_id, src_node_ids)
+            path.append([node, nextHops[node]])
+            node = nextHops[node]
+            distance -= 1
+        path.append([node, dest_node_id])
+        results[src_node_id] = (len(path), path)
+    return results
+
 def shutdown():
     """
-    Shutdown pathfinder module. Essentially, close DB connection.
+    Shutdown pathfinder module. Essentially, close DB connections.
     """
-    global conn
-    conn.close()
+    global pool
+    pool.close()
@@ -0,0 +1,202 @@
+"""
+In-memory routing index: compact adjacency arrays, answering shortest path queries
+with bidirectional BFS, without any routing DB round trips.
+"""
+
+##################
+# Copyright 2008, Jevgenij Solovjov
+#
+# This file is part of Ripplebase.
+#
+# Ripplebase is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ripplebase is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with Ripplebase, in the file LICENSE.txt.  If not,
+# see <http://www.gnu.org/licenses/>.
+##################
+
+from array import array
+from routing.smallworld import get_neighbors, ids
+
+class RoutingIndexEx(Exception):
+    pass
+
+class RoutingIndex(object):
+    """
+    Snapshot of graph adjacency in compressed sparse row (CSR) form. Node ids are
+    interned into consecutive indexes 0..n-1; neighbors of node with index i are
+
+        targets[offsets[i]:offsets[i + 1]]
+
+    Both outgoing (offsets, targets) and incoming (rev_offsets, rev_targets) edges
+    are stored, so that the search can also proceed backwards from the destination.
+    The index is never modified after construction - build a new one when the graph
+    changes, and replace the reference.
+    """
+    def __init__(self, get_ids_fn = ids, get_neighbors_fn = get_neighbors):
+        adjacency = [(node, get_neighbors_fn(node)) for node in get_ids_fn()]
+        # nodes without outgoing edges appear only as neighbors
+        allIDs = set([node for node, neighbors in adjacency])
+        for node, neighbors in adjacency:
+            allIDs.update(neighbors)
+        self.node_ids = array('i', sorted(allIDs))
+        self.index_of = dict([(id, i) for i, id in enumerate(self.node_ids)])
+        n = len(self.node_ids)
+
+        outDegrees = [0] * n
+        inDegrees = [0] * n
+        for node, neighbors in adjacency:
+            outDegrees[self.index_of[node]] = len(neighbors)
+            for neighbor in neighbors:
+                inDegrees[self.index_of[neighbor]] += 1
+        self.offsets = self._offsets(outDegrees)
+        self.rev_offsets = self._offsets(inDegrees)
+
+        self.targets = array('i', [0]) * self.offsets[n]
+        self.rev_targets = array('i', [0]) * self.rev_offsets[n]
+        revFill = list(self.rev_offsets[:n])
+        for node, neighbors in adjacency:
+            i = self.index_of[node]
+            pos = self.offsets[i]
+            for neighbor in neighbors:
+                j = self.index_of[neighbor]
+                self.targets[pos] = j
+                pos += 1
+                self.rev_targets[revFill[j]] = i
+                revFill[j] += 1
+
+    def _offsets(self, degrees):
+        offsets = array('i', [0]) * (len(degrees) + 1)
+        total = 0
+        for i, degree in enumerate(degrees):
+            total += degree
+            offsets[i + 1] = total
+        return offsets
+
+    def has_node(self, node_id):
+        return node_id in self.index_of
+
+    def nodes_count(self):
+        return len(self.node_ids)
+
+    def shortest_path(self, src_node_id, dest_node_id):
+        """
+        Returns (distance, path) in the format of pathfinder.find_shortest_path -
+        path is a list of [<node id>, <next node id>] hops - or None if there is
+        no route. Raises RoutingIndexEx if either node is not in the index.
+        """
+        try:
+            src = self.index_of[src_node_id]
+            dest = self.index_of[dest_node_id]
+        except KeyError, e:
+            raise RoutingIndexEx("Node %s is not in the routing index" % e)
+        if src == dest:
+            return 0, []
+        nodes = self._bidirectional_bfs(src, dest)
+        if nodes is None:
+            return None
+        ids = [self.node_ids[i] for i in nodes]
+        return len(ids) - 1, [[ids[k], ids[k + 1]] for k in xrange(len(ids) - 1)]
+
+    def shortest_paths_to(self, dest_node_id, src_node_ids):
+        """
+        Answers many shortest path queries to a single destination with one BFS
+        backwards from it, stopping as soon as all sources are reached.
+        Returns {<src node id>: (distance, path)} for the reachable sources (path
+        format as in shortest_path()). Raises RoutingIndexEx for unknown nodes.
+        """
+        try:
+            dest = self.index_of[dest_node_id]
+            pending = set([self.index_of[src_node_id] for src_node_id in src_node_ids])
+        except KeyError, e:
+            raise RoutingIndexEx("Node %s is not in the routing index" % e)
+        # nextHops[i] is the next node on a shortest path from i to dest
+        nextHops = {dest: -1}
+        pending.discard(dest)
+        frontier = [dest]
+        while frontier and pending:
+            newFrontier = []
+            for i in frontier:
+                for pos in xrange(self.rev_offsets[i], self.rev_offsets[i + 1]):
+                    j = self.rev_targets[pos]
+                    if j not in nextHops:
+                        nextHops[j] = i
+                        newFrontier.append(j)
+                        pending.discard(j)
+            frontier = newFrontier
+        results = {}
+        for src_node_id in src_node_ids:
+            i = self.index_of[src_node_id]
+            if i not in nextHops:
+                continue    # unreachable
+            path = []
+            while i != dest:
+                path.append([self.node_ids[i], self.node_ids[nextHops[i]]])
+                i = nextHops[i]
+            results[src_node_id] = (len(path), path)
+        return results
+
+    def _bidirectional_bfs(self, src, dest):
+        """
+        Grows BFS frontiers from both ends, always expanding the smaller one by a
+        whole level. Once a level reaches nodes seen from the other end, the best
+        meeting node of that level lies on a shortest path.
+        Returns list of node indexes from src to dest, or None.
+        """
+        # parent maps double as visited sets; distances are implied by levels
+        fwdParents, bwdParents = {src: -1}, {dest: -1}
+        fwdDist, bwdDist = {src: 0}, {dest: 0}
+        fwdFrontier, bwdFrontier = [src], [dest]
+        while fwdFrontier and bwdFrontier:
+            if len(fwdFrontier) <= len(bwdFrontier):
+                fwdFrontier, meet = self._expand_level(fwdFrontier, self.offsets, self.targets,
+                                                       fwdParents, fwdDist, bwdDist)
+            else:
+                bwdFrontier, meet = self._expand_level(bwdFrontier, self.rev_offsets, self.rev_targets,
+                                                       bwdParents, bwdDist, fwdDist)
+            if meet is not None:
+                return self._join_paths(meet, fwdParents, bwdParents)
+        return None
+
+    def _expand_level(self, frontier, offsets, targets, parents, dist, otherDist):
+        """
+        Expands one BFS level. Returns the new frontier and the meeting node with the
+        minimum total distance (None if the other side has not been reached).
+        """
+        newFrontier = []
+        meet, meetDist = None, None
+        for i in frontier:
+            nextDist = dist[i] + 1
+            for pos in xrange(offsets[i], offsets[i + 1]):
+                j = targets[pos]
+                if j in parents:
+                    continue
+                parents[j] = i
+                dist[j] = nextDist
+                newFrontier.append(j)
+                if j in otherDist:
+                    total = nextDist + otherDist[j]
+                    if meetDist is None or total < meetDist:
+                        meet, meetDist = j, total
+        return newFrontier, meet
+
+    def _join_paths(self, meet, fwdParents, bwdParents):
+        nodes = []
+        i = meet
+        while i != -1:
+            nodes.append(i)
+            i = fwdParents[i]
+        nodes.reverse()
+        i = bwdParents[meet]
+        while i != -1:
+            nodes.append(i)
+            i = bwdParents[i]
+        return nodes
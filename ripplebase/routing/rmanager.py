@@ -26,8 +26,11 @@ Future versions could support work with persistent storage.
 ##################
 
 import thread
-from psycopg import connect, ProgrammingError   # current implementation uses DBAPI for DB access
+from multiprocessing import Pool
+from psycopg import ProgrammingError   # current implementation uses DBAPI for DB access
+from routing.dbpool import get_pool, ThreadCursor
 from routing.smallworld import get_neighbors, ids
+from routing.landmarks import LandmarkOracle, LANDMARKS_COUNT
 
 
 class RoutingTableEx(Exception):
@@ -35,13 +38,20 @@ class RoutingTableEx(Exception):
 
 # Database tables model & connection information
 ROUTING_DB_CONNECT_STR = "dbname=routing_dev_db user=dev password=devdevdev host=localhost"
-# connect to the routing DB and clear the tables
-try:
-    conn = connect(ROUTING_DB_CONNECT_STR)
-    curs = conn.cursor() # connect to the routing table storage database
-except:
-    raise RoutingTableEx(e)
-conn.autocommit()
+# Routing DB connections come from a pool shared with the pathfinder; every thread 
+# works through a cursor of its own (see routing.dbpool). Nothing connects until 
+# the first query, or warm_up().
+pool = get_pool(ROUTING_DB_CONNECT_STR)
+curs = ThreadCursor(pool)
+
+def warm_up():
+    """
+    Connects to the routing DB ahead of the first query.
+    """
+    try:
+        pool.warm_up()
+    except Exception, e:
+        raise RoutingTableEx(e)
 
 DROP_NODES_TABLE_STATEMENT = """
 DROP TABLE nodes_table
@@ -55,23 +65,82 @@ DELETE FROM nodes_table
 CLEAR_ROUTING_TABLE_STATEMENT = """
 DELETE FROM routing_table
 """
-CREATE_NODES_TABLE_STATEMENT = """
-CREATE TABLE nodes_table(
+NODES_TABLE_COLUMNS = """(
     id int4 PRIMARY KEY,
     routing_id varchar(10) UNIQUE
 )
 """
+CREATE_NODES_TABLE_STATEMENT = "CREATE TABLE nodes_table" + NODES_TABLE_COLUMNS
 # no foreign key constraint checked - due to performance issues
-CREATE_ROUTING_TABLE_STATEMENT = """
-CREATE TABLE routing_table(
+ROUTING_TABLE_COLUMNS = """(
     id bigserial PRIMARY KEY,
     src_node_id int4,
     dest_node_id int4,
     distance int4
 )
 """
-# *** CREATE INDEX for src_node_id and dest_node_id - very significant performance improvement
-#     for the pathfinder
+CREATE_ROUTING_TABLE_STATEMENT = "CREATE TABLE routing_table" + ROUTING_TABLE_COLUMNS
+
+# Double buffering. refresh_routing_table builds complete new tables under the
+# *_shadow names, then swap_shadow_tables() renames them into place in a single 
+# transaction, so readers never see a partially built routing table. Every swap
+# increments the number stored in routing_generation (within the same transaction),
+# which lets caches of routing data tell whether they are stale.
+CREATE_NODES_SHADOW_TABLE_STATEMENT = "CREATE TABLE nodes_table_shadow" + NODES_TABLE_COLUMNS
+CREATE_ROUTING_SHADOW_TABLE_STATEMENT = "CREATE TABLE routing_table_shadow" + ROUTING_TABLE_COLUMNS
+SWAPPED_TABLES = ("routing_table", "nodes_table")
+CREATE_GENERATION_TABLE_STATEMENT = """
+CREATE TABLE routing_generation(
+    generation int4 NOT NULL
+)
+"""
+SQL_START_TRANS = "START TRANSACTION"
+SQL_COMMIT_TRANS = "COMMIT TRANSACTION"
+SQL_ROLLBACK_TRANS = "ROLLBACK TRANSACTION"
+
+# Bulk loading target; column order matches the rows written by the loader, so that
+# COPY needs no column list (routing_table itself starts with the serial id).
+CREATE_ROUTING_STAGING_TABLE_STATEMENT = """
+CREATE TABLE routing_table_staging(
+    src_node_id int4,
+    dest_node_id int4,
+    distance int4
+)
+"""
+DROP_ROUTING_STAGING_TABLE_STATEMENT = """
+DROP TABLE routing_table_staging
+"""
+MOVE_STAGED_ROUTES_STATEMENT = """
+INSERT INTO %s(src_node_id, dest_node_id, distance)
+    SELECT src_node_id, dest_node_id, distance FROM routing_table_staging
+"""
+# indexes for src_node_id and dest_node_id - very significant performance improvement
+# for the pathfinder. Created after the table is loaded, which is much faster than
+# maintaining them row by row. Index names are tagged with the generation number,
+# since the indexes keep their names when their table is renamed.
+CREATE_ROUTING_INDEX_STATEMENTS = (
+    "CREATE INDEX routing_table_src_node_id_idx_%(generation)d ON %(table)s(src_node_id)",
+    "CREATE INDEX routing_table_dest_node_id_idx_%(generation)d ON %(table)s(dest_node_id)",
+    "ANALYZE %(table)s",
+)
+
+# Landmark distances (see routing.landmarks) - k*n rows, an alternative to 
+# routing_table for graphs too big for the full distance matrix.
+LANDMARK_TABLE_COLUMNS = """(
+    landmark_id int4,
+    node_id int4,
+    distance_from int4,
+    distance_to int4
+)
+"""
+CREATE_LANDMARK_SHADOW_TABLE_STATEMENT = "CREATE TABLE landmark_table_shadow" + LANDMARK_TABLE_COLUMNS
+
+# Number of worker processes refresh_routing_table uses for the BFS computation
+# (1 - compute in the calling process), and number of source nodes per worker task.
+ROUTING_WORKERS = 1
+ROUTING_WORKER_CHUNK_SIZE = 64
+# Number of rows per INSERT batch, when the DB driver offers no COPY support
+BULK_LOAD_BATCH_SIZE = 5000
 
 
 # *** Ryan: Can we do this in-memory, or should we use db?  space = O(n^2)
@@ -95,7 +164,7 @@ CREATE TABLE routing_table(
 
 def prepare_tables():
     #try:
-    global conn, curs
+    global curs
     if True:
         try:
             curs.execute(CLEAR_NODES_TABLE_STATEMENT)    # try to delete contents of nodes_table
@@ -111,20 +180,160 @@ def prepare_tables():
                 curs.execute(CLEAR_ROUTING_TABLE_STATEMENT)
             except ProgrammingError:
                 curs.execute(CREATE_ROUTING_TABLE_STATEMENT)
-        conn.commit()
+        curs.commit()
 #    except:
 #        conn.rollback()
 #        raise RoutingTableEx
     
-def populate_nodes_table(idList):
+def prepare_shadow_tables():
+    """
+    Creates empty nodes_table_shadow and routing_table_shadow, dropping whatever 
+    an interrupted refresh might have left behind.
+    """
+    global curs
+    for table in SWAPPED_TABLES:
+        for suffix in ("_shadow", "_retired"):
+            try:
+                curs.execute("DROP TABLE %s%s" % (table, suffix))
+            except ProgrammingError:
+                pass    # the table does not exist
+    curs.execute(CREATE_NODES_SHADOW_TABLE_STATEMENT)
+    curs.execute(CREATE_ROUTING_SHADOW_TABLE_STATEMENT)
+
+def table_exists(table):
     global curs
+    curs.execute("SELECT count(*) FROM pg_tables WHERE tablename = %s", (table,))
+    return curs.fetchone()[0] > 0
+
+def swap_shadow_tables(generation):
+    """
+    Replaces routing_table and nodes_table with their shadow copies and sets the 
+    routing table generation number, all in one transaction. The replaced tables
+    are dropped after the commit, so that readers already waiting for them still 
+    get a complete (old) snapshot.
+    """
+    global curs
+    get_generation()    # make sure routing_generation exists
+    retired = []
+    curs.execute(SQL_START_TRANS)
+    try:
+        for table in SWAPPED_TABLES:
+            if table_exists(table):
+                curs.execute("ALTER TABLE %s RENAME TO %s_retired" % (table, table))
+                retired.append(table + "_retired")
+            curs.execute("ALTER TABLE %s_shadow RENAME TO %s" % (table, table))
+        curs.execute("UPDATE routing_generation SET generation = %s", (generation,))
+    except:
+        curs.execute(SQL_ROLLBACK_TRANS)
+        raise
+    curs.execute(SQL_COMMIT_TRANS)
+    for table in retired:
+        curs.execute("DROP TABLE %s" % table)
+
+def get_generation():
+    """
+    Returns generation number of the routing table in use: increased by every 
+    refresh_routing_table() and by every incremental update that changes something.
+    0 if the routing table has never been built.
+    """
+    global curs
+    try:
+        curs.execute("SELECT generation FROM routing_generation")
+    except ProgrammingError:    # the table does not exist
+        curs.execute(CREATE_GENERATION_TABLE_STATEMENT)
+        curs.execute("INSERT INTO routing_generation(generation) VALUES (0)")
+        return 0
+    return curs.fetchone()[0]
+
+def bump_generation():
+    global curs
+    get_generation()    # make sure routing_generation exists
+    curs.execute("UPDATE routing_generation SET generation = generation + 1")
+
+def populate_nodes_table(idList, table = "nodes_table"):
     if not idList: return # the list is empty - there is nothing to do
-    addNodeStatement = "INSERT INTO nodes_table(id, routing_id) VALUES " 
-    for id in idList:
-        addNodeStatement = addNodeStatement + "(%d, 'node_%d')," % (id, id) # *** can be comparatively slow
-    stLength = len(addNodeStatement)
-    addNodeStatement = addNodeStatement[:stLength-1] # remove trailing comma
-    curs.execute(addNodeStatement)
+    bulk_load(table, [(id, 'node_%d' % id) for id in idList])
+
+class _CopyRowStream(object):
+    """
+    File-like object for cursor.copy_from(): renders rows (tuples of numbers or
+    strings without tabs/newlines/backslashes) in COPY text format, pulling them 
+    from the 'rows' iterable only as the driver reads - so the whole data set is
+    never materialized.
+    """
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = ''
+
+    def readline(self, size = -1):
+        if self.buffer:
+            line, self.buffer = self.buffer, ''
+            return line
+        for row in self.rows:
+            return '\t'.join([str(value) for value in row]) + '\n'
+        return ''
+
+    def read(self, size = -1):
+        chunks = []
+        length = 0
+        while size < 0 or length < size:
+            line = self.readline()
+            if not line:
+                break
+            chunks.append(line)
+            length += len(line)
+        data = ''.join(chunks)
+        if size >= 0:
+            data, self.buffer = data[:size], data[size:]
+        return data
+
+def bulk_load(table, rows, cursor = None):
+    """
+    Writes all rows (tuples matching the column order of 'table') into 'table' with
+    a single COPY, if the cursor supports it. Otherwise, falls back to parameterized
+    INSERT statements sent in batches of BULK_LOAD_BATCH_SIZE rows.
+    """
+    global curs
+    if cursor is None:
+        cursor = curs
+    if hasattr(cursor, 'copy_from'):
+        cursor.copy_from(_CopyRowStream(rows), table)
+        return
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BULK_LOAD_BATCH_SIZE:
+            _insert_batch(cursor, table, batch)
+            batch = []
+    if batch:
+        _insert_batch(cursor, table, batch)
+
+def _insert_batch(cursor, table, batch):
+    placeholders = ', '.join(['%s'] * len(batch[0]))
+    cursor.executemany("INSERT INTO %s VALUES (%s)" % (table, placeholders), batch)
+
+def create_routing_indexes(table, generation):
+    global curs
+    for statement in CREATE_ROUTING_INDEX_STATEMENTS:
+        curs.execute(statement % {'table': table, 'generation': generation})
+
+def load_routing_table(rows, table, generation):
+    """
+    Bulk loads (src_node_id, dest_node_id, distance) rows into 'table' (a freshly 
+    created, empty copy of routing_table): streams them into routing_table_staging, 
+    moves them into 'table' with a single statement, and then creates the indexes.
+    """
+    global curs
+    try:
+        curs.execute(DROP_ROUTING_STAGING_TABLE_STATEMENT)  # left over by a failed load
+    except ProgrammingError:
+        pass
+    curs.execute(CREATE_ROUTING_STAGING_TABLE_STATEMENT)
+    bulk_load("routing_table_staging", rows)
+    curs.execute(MOVE_STAGED_ROUTES_STATEMENT % table)
+    curs.execute(DROP_ROUTING_STAGING_TABLE_STATEMENT)
+    create_routing_indexes(table, generation)
+
 #def create_routing_table():
 #    """
 #    Create routing_table. in DB. This function is used in two branches of table 
@@ -137,6 +346,7 @@ def add_distance(nodeID, otherNodeIDs, distance):
     A handy method for updating routing table nested dictionary.
     Takes current node ID and list/set of other nodes', that have fixed distance 'distance'
     from the current node, IDs.  
+    For loading many distances at once, see load_routing_table().
     """
     global curs
     # debug:
@@ -151,23 +361,18 @@ def add_distance(nodeID, otherNodeIDs, distance):
 #        _routingTable[nodeID].update({onID: distance})
 # -----------------------------------------------------
     if not otherNodeIDs: return # the list is empty - there is nothing to do
-    addDistanceStatement = "INSERT INTO routing_table(src_node_id, dest_node_id, distance) VALUES " 
-    for onID in otherNodeIDs:
-        addDistanceStatement = addDistanceStatement + "(%s, %s, %d)," % (nodeID, onID, distance) # *** can be comparatively slow
-    stLength = len(addDistanceStatement)
-    addDistanceStatement = addDistanceStatement[:stLength-1] # remove trailing comma
-    #try:
-    curs.execute(addDistanceStatement)
-    #except:
-    #raise RoutingTableEx
+    curs.executemany("INSERT INTO routing_table(src_node_id, dest_node_id, distance) VALUES (%s, %s, %s)",
+                     [(nodeID, onID, distance) for onID in otherNodeIDs])
         
 # *** Ryan: Why pass in fcns here?  In the regular course of the program, 
 #           will there be different ones passed in?  If not, why not just
 #           call the canonical one, wherever it lives?
-def refresh_routing_table(get_ids_fn, get_neighbors_fn):
+def refresh_routing_table(get_ids_fn, get_neighbors_fn, workers = None):
     """
     Refresh routing table. Takes a graphObject, which must have get_neighbors(self, id)
     method, to provide list of adjacent nodes.
+    'workers' is the number of processes computing BFS in parallel (ROUTING_WORKERS
+    by default); see parallel_bfs_levels().
     'waitflag' defines behavior in case _synLock is locked. If True, RoutingTableLockEx
     is raised. If False, waits until the lock gets unlocked.
     If get_neighbors() causes IndexError, it is passed further.
@@ -205,12 +410,15 @@ def refresh_routing_table(get_ids_fn, get_neighbors_fn):
 #    # first, acquire the lock
 #    if _synLock.acquire(waitflag) != 1:
 #        raise RoutingTableLockEx("RoutingManager.refresh_routing_table(): Unable to acquire lock")
-    _routingTable = {}
-    prepare_tables()
+    # The new tables are built aside and swapped in when complete - readers keep 
+    # using the previous generation meanwhile. Incremental updates made to the 
+    # current tables during the refresh are lost with the swap.
+    generation = get_generation() + 1
+    prepare_shadow_tables()
     # *** perhaps, should validate the adjacency list here???
     # retrieve the list of nodes in graph
     nodeList = get_ids_fn()
-    populate_nodes_table(nodeList)
+    populate_nodes_table(nodeList, "nodes_table_shadow")
     
     # *** Ryan: Why go through every node recreating the whole table?  
     #           Shouldn't we just start at nodes that have gained or lost an edge since the last
@@ -218,43 +426,132 @@ def refresh_routing_table(get_ids_fn, get_neighbors_fn):
     #             anything anymore?
     # *** Jevgenij: incremental approach is indeed better if just one or two edges appear. Recalculating
     #             from scratch can be useful too, e.g. to recover from failures.
-    for node in nodeList:
-        # set initial white, grey and black sets
-        # *** Ryan: What are these?  Document.
-        # Jevgenij: done.
-        _greySet = set([node])
-        # _whiteSet = set([])
-        _whiteSet = set(nodeList[:])
-        _whiteSet.discard(node)
-        _blackSet = set([])
-        # traverse every other reachable node, registering minimum distance to it 
-        # (white-grey-black coloring)
-            
-        distance = 0
-        while True:
-            # checking if greySet contains values
-            if not _greySet: 
-                break          
-            # assemble a union of 'white' neighbors, which will be then 'repainted' in 'grey'
-            distance += 1
-            allWhiteNeighbors = set([])
-            for greyNode in _greySet:
-                neighbors = set(get_neighbors_fn(greyNode)) # get list of all immediate neighbors
-                # *** Ryan: Use python 'set' primitive below
-				# *** Jevgenij: yes, use sets! has to be reworked.
-                # *** Jevgenij: Done.
-                whiteNeighbors = _whiteSet & neighbors # leave only neighbors that are 'white' (intersection of sets)
-                allWhiteNeighbors.update(whiteNeighbors) # append the new white neighbors to allWhiteNeighbors set
-            
-            _blackSet.update(_greySet) # 'repaint' 'grey' nodes in 'black'
-            _greySet = allWhiteNeighbors.copy() # 'repaint' 'white' neighbors in grey
-            for whiteNode in allWhiteNeighbors:
-                _whiteSet.discard(whiteNode)
-                
-            add_distance(node, allWhiteNeighbors, distance)
+    if workers is None:
+        workers = ROUTING_WORKERS
+    if workers > 1:
+        nodeLevels = parallel_bfs_levels(nodeList, get_neighbors_fn, workers)
+    else:
+        nodeLevels = ((node, bfs_levels(node, get_neighbors_fn)) for node in nodeList)
+    load_routing_table(_routing_rows(nodeLevels), "routing_table_shadow", generation)
+    swap_shadow_tables(generation)
+
+def refresh_landmark_table(get_ids_fn, get_neighbors_fn, landmarksCount = LANDMARKS_COUNT):
+    """
+    Computes landmark distances (see routing.landmarks.LandmarkOracle) for the graph
+    and replaces the contents of landmark_table with them, the same way 
+    refresh_routing_table replaces routing_table. Returns the new oracle.
+    """
+    global curs
+    oracle = LandmarkOracle.build(get_ids_fn, get_neighbors_fn, landmarksCount)
+    for suffix in ("_shadow", "_retired"):
+        try:
+            curs.execute("DROP TABLE landmark_table%s" % suffix)
+        except ProgrammingError:
+            pass    # the table does not exist
+    curs.execute(CREATE_LANDMARK_SHADOW_TABLE_STATEMENT)
+    bulk_load("landmark_table_shadow", oracle.rows())
+    retired = table_exists("landmark_table")
+    curs.execute(SQL_START_TRANS)
+    try:
+        if retired:
+            curs.execute("ALTER TABLE landmark_table RENAME TO landmark_table_retired")
+        curs.execute("ALTER TABLE landmark_table_shadow RENAME TO landmark_table")
+    except:
+        curs.execute(SQL_ROLLBACK_TRANS)
+        raise
+    curs.execute(SQL_COMMIT_TRANS)
+    if retired:
+        curs.execute("DROP TABLE landmark_table_retired")
+    return oracle
+
+def load_landmark_oracle():
+    """
+    Returns a LandmarkOracle built from landmark_table, or None if the table has 
+    not been computed yet.
+    """
+    global curs
+    if not table_exists("landmark_table"):
+        return None
+    curs.execute("SELECT landmark_id, node_id, distance_from, distance_to FROM landmark_table")
+    return LandmarkOracle.from_rows(curs.fetchall())
+
+def _routing_rows(nodeLevels):
+    """
+    Flattens (node, levels) tuples into (src_node_id, dest_node_id, distance) rows.
+    """
+    for node, levels in nodeLevels:
+        for distance, allWhiteNeighbors in levels:
+            for otherNode in allWhiteNeighbors:
+                yield (node, otherNode, distance)
+
+def bfs_levels(node, get_neighbors_fn):
+    """
+    Generator performing the BFS traversal from 'node' described in 
+    refresh_routing_table(). Yields (distance, allWhiteNeighbors) tuples - the set
+    of nodes first reached at each distance - until every reachable node is black.
+    A node is white as long as it is neither grey nor black, so the list of all 
+    graph nodes is not needed.
+    """
+    # set initial grey and black sets
+    _greySet = set([node])
+    _blackSet = set([])
+    # traverse every other reachable node, registering minimum distance to it 
+    # (white-grey-black coloring)
+    distance = 0
+    while _greySet:
+        # assemble a union of 'white' neighbors, which will be then 'repainted' in 'grey'
+        distance += 1
+        _blackSet.update(_greySet) # 'repaint' 'grey' nodes in 'black'
+        allWhiteNeighbors = set([])
+        for greyNode in _greySet:
+            neighbors = set(get_neighbors_fn(greyNode)) # get list of all immediate neighbors
+            allWhiteNeighbors.update(neighbors - _blackSet) # leave only neighbors that are 'white'
+        _greySet = allWhiteNeighbors # 'repaint' 'white' neighbors in grey
+        if allWhiteNeighbors:
+            yield distance, allWhiteNeighbors
+
+# Parallel BFS. Worker processes are forked, so each of them inherits the graph
+# (e.g. smallworld.swGraph) as it is when the pool is created, and only reads it;
+# neither the graph nor get_neighbors_fn is pickled. Workers never touch the
+# routing DB - all results are written by the calling process.
+_worker_get_neighbors_fn = None
+
+def _init_bfs_worker(get_neighbors_fn):
+    global _worker_get_neighbors_fn
+    _worker_get_neighbors_fn = get_neighbors_fn
+
+def _bfs_shard(nodeList):
+    """
+    Worker task: BFS from every node in nodeList. Returns a list of 
+    (node, [(distance, [<node ids>]), ...]) tuples.
+    """
+    return [(node, [(distance, list(levelNodes)) for distance, levelNodes
+                    in bfs_levels(node, _worker_get_neighbors_fn)])
+            for node in nodeList]
+
+def parallel_bfs_levels(nodeList, get_neighbors_fn, workers, chunkSize = None):
+    """
+    Shards nodeList across 'workers' processes, each running bfs_levels() for its
+    source nodes. Generates (node, levels) tuples in completion order, where levels
+    is a list of (distance, nodes) tuples as produced by bfs_levels().
+    """
+    if chunkSize is None:
+        chunkSize = ROUTING_WORKER_CHUNK_SIZE
+    nodeList = list(nodeList)
+    shards = [nodeList[i:i + chunkSize] for i in xrange(0, len(nodeList), chunkSize)]
+    pool = Pool(workers, _init_bfs_worker, (get_neighbors_fn,))
+    try:
+        for shardResult in pool.imap_unordered(_bfs_shard, shards):
+            for nodeResult in shardResult:
+                yield nodeResult
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
 
 def close_db_conn():
-    conn.close()
+    curs.release()
+    pool.close()
 
 #    # release the lock
 #    _synLock.release()
@@ -290,11 +587,179 @@ def close_db_conn():
 ####    Return how many nodes the graph has
 ####    """
 
-def incremental_add_edge(nodeID1, nodeID2):
+# Incremental maintenance. Adding or removing edge (u, v) can only change
+# distance(s, t) for pairs whose (new or old) shortest path runs through the edge,
+# i.e. distance(s, t) = distance(s, u) + 1 + distance(v, t). Neither distance(s, u)
+# nor distance(v, t) is affected by the change (a shortest path to u never leaves u,
+# a shortest path from v never enters v), so both are read from the routing table.
+# Sources are visited level by level, in increasing distance(s, u), starting from u.
+# A source s on level k+1 is examined only if one of its neighbors on level k had 
+# some distance changed: otherwise s has a shortest path to u through an unchanged 
+# node, and no distance from s can change either. Targets are pruned the same way,
+# so the work done tracks the number of changed entries, not the size of the graph.
+
+def get_distances_to(nodeID):
+    """
+    Returns {<srcNodeID>: <distance>} for all nodes that can reach 'nodeID',
+    including nodeID itself at distance 0.
+    """
+    global curs
+    curs.execute("SELECT src_node_id, distance FROM routing_table WHERE dest_node_id = %s",
+                 (nodeID,))
+    distances = dict(curs.fetchall())
+    distances[nodeID] = 0
+    return distances
+
+def get_distances_from(nodeID):
+    """
+    Returns {<destNodeID>: <distance>} for all nodes reachable from 'nodeID',
+    including nodeID itself at distance 0.
+    """
+    global curs
+    curs.execute("SELECT dest_node_id, distance FROM routing_table WHERE src_node_id = %s",
+                 (nodeID,))
+    distances = dict(curs.fetchall())
+    distances[nodeID] = 0
+    return distances
+
+def ensure_nodes(idList):
+    """
+    Adds nodes from idList missing in nodes_table to it.
+    """
+    global curs
+    missing = []
+    for id in idList:
+        curs.execute("SELECT id FROM nodes_table WHERE id = %s", (id,))
+        if curs.fetchone() is None:
+            missing.append(id)
+    populate_nodes_table(missing)
+
+def write_distance_changes(nodeID, oldDistances, newDistances):
+    """
+    Brings routing table entries with src_node_id = 'nodeID' from oldDistances to
+    newDistances (both {<destNodeID>: <distance>}, covering the same affected 
+    destinations; None or a missing key stands for "unreachable").
+    Returns the set of destinations whose distance has changed.
+    """
+    global curs
+    inserted, updated, deleted = [], [], []
+    for destID in set(oldDistances) | set(newDistances):
+        oldDistance = oldDistances.get(destID)
+        newDistance = newDistances.get(destID)
+        if destID == nodeID or oldDistance == newDistance:
+            continue
+        if oldDistance is None:
+            inserted.append((nodeID, destID, newDistance))
+        elif newDistance is None:
+            deleted.append((nodeID, destID))
+        else:
+            updated.append((newDistance, nodeID, destID))
+    if inserted:
+        curs.executemany("INSERT INTO routing_table(src_node_id, dest_node_id, distance)"
+                         " VALUES (%s, %s, %s)", inserted)
+    if updated:
+        curs.executemany("UPDATE routing_table SET distance = %s"
+                         " WHERE src_node_id = %s AND dest_node_id = %s", updated)
+    if deleted:
+        curs.executemany("DELETE FROM routing_table"
+                         " WHERE src_node_id = %s AND dest_node_id = %s", deleted)
+    return set([row[1] for row in inserted]) | set([row[2] for row in updated]) \
+        | set([row[1] for row in deleted])
+
+def _propagate_edge_change(nodeID1, nodeID2, get_neighbors_fn, compute_fn):
+    """
+    Visits sources level by level (see the comment above), calling
+    compute_fn(srcNodeID, distToNodeID1, candidateTargets, oldDistances) for each
+    one. compute_fn returns the new {<destNodeID>: <distance>} for the candidate
+    targets; changed entries are written to the routing table.
+    Returns the number of changed routing table entries.
+    """
+    srcDistances = get_distances_to(nodeID1)
+    levels = {}
+    for srcID, distance in srcDistances.items():
+        levels.setdefault(distance, set([])).add(srcID)
+    
+    # initially, every node reachable from nodeID2 is a candidate target
+    changedTargets = {None: set(get_distances_from(nodeID2))}
+    changeCount = 0
+    distance = 0
+    while changedTargets and distance in levels:
+        nextChangedTargets = {}
+        for srcID in levels[distance]:
+            if distance == 0:
+                candidateTargets = changedTargets[None]
+            else:
+                # union of targets changed for neighbors one hop closer to nodeID1
+                candidateTargets = set([])
+                for neighbor in get_neighbors_fn(srcID):
+                    candidateTargets.update(changedTargets.get(neighbor, ()))
+                if not candidateTargets:
+                    continue    # pruned - nothing can change for this source
+            oldDistances = get_distances_from(srcID)
+            oldDistances = dict([(t, oldDistances.get(t)) for t in candidateTargets])
+            newDistances = compute_fn(srcID, srcDistances[srcID], candidateTargets, oldDistances)
+            changed = write_distance_changes(srcID, oldDistances, newDistances)
+            if changed:
+                nextChangedTargets[srcID] = changed
+                changeCount += len(changed)
+        changedTargets = nextChangedTargets
+        distance += 1
+    if changeCount:
+        bump_generation()
+    return changeCount
+
+def incremental_add_edge(nodeID1, nodeID2, get_neighbors_fn = get_neighbors):
+    """
+    Updates routing table after edge nodeID1 -> nodeID2 has been added to the graph
+    (get_neighbors_fn(nodeID1) must already list nodeID2). Only entries which get
+    shorter through the new edge are touched:
+        distance(s, t) = min(distance(s, t), distance(s, nodeID1) + 1 + distance(nodeID2, t))
+    Returns the number of changed routing table entries.
+    """
     # 1) check the nodes in the nodes_table
-    # 2) issue an update statement to update routing table entries 
-    #    with min(distance, d11 + d22 + 1, d12 + d21 + 1)
-    ROUTING_TABLE_UPDATE_ON_ADD_EDGE_STATEMENT ="""
-        UPDATE routing_table SET distance TO min(distance, )
+    ensure_nodes([nodeID1, nodeID2])
+    if nodeID1 == nodeID2:
+        return 0
+    # 2) update routing table entries with min(distance, d(s, nodeID1) + 1 + d(nodeID2, t))
+    destDistances = get_distances_from(nodeID2)
+    def compute_fn(srcID, srcDistance, candidateTargets, oldDistances):
+        newDistances = {}
+        for destID in candidateTargets:
+            throughEdge = srcDistance + 1 + destDistances[destID]
+            oldDistance = oldDistances[destID]
+            if oldDistance is None or throughEdge < oldDistance:
+                newDistances[destID] = throughEdge
+            else:
+                newDistances[destID] = oldDistance
+        return newDistances
+    return _propagate_edge_change(nodeID1, nodeID2, get_neighbors_fn, compute_fn)
+
+def incremental_remove_edge(nodeID1, nodeID2, get_neighbors_fn = get_neighbors):
+    """
+    Updates routing table after edge nodeID1 -> nodeID2 has been removed from the graph
+    (get_neighbors_fn(nodeID1) must no longer list nodeID2). Only sources with a 
+    shortest path running through the removed edge are recomputed, with a BFS on the
+    current graph; entries that become unreachable are deleted.
+    Returns the number of changed routing table entries.
     """
-     
+    if nodeID1 == nodeID2:
+        return 0
+    destDistances = get_distances_from(nodeID2)
+    def compute_fn(srcID, srcDistance, candidateTargets, oldDistances):
+        # only targets whose every shortest path might have used the edge are affected
+        affectedTargets = set([destID for destID in candidateTargets
+            if oldDistances[destID] == srcDistance + 1 + destDistances[destID]])
+        newDistances = dict(oldDistances)
+        if not affectedTargets:
+            return newDistances
+        for destID in affectedTargets:
+            newDistances[destID] = None
+        remaining = len(affectedTargets)
+        for distance, levelNodes in bfs_levels(srcID, get_neighbors_fn):
+            for destID in levelNodes & affectedTargets:
+                newDistances[destID] = distance
+                remaining -= 1
+            if not remaining:
+                break   # nothing more to change
+        return newDistances
+    return _propagate_edge_change(nodeID1, nodeID2, get_neighbors_fn, compute_fn)
@@ -80,15 +80,22 @@ def appendNodes(nodesDict):
     
 def appendEdges(id, edges):
     """
-    Add 'edges' to node 'id' neighbors
+    Add 'edges' to node 'id' neighbors. Neighbors already present are skipped.
+    Neighbor lists are replaced rather than changed in place, since populate_sw
+    copies only the outer dictionary.
     """
-    pass
+    global swGraph
+    neighbors = swGraph.get(id, [])
+    swGraph[id] = neighbors + [edge for edge in edges if edge not in neighbors]
     
 def deleteEdges(id, edges):
     """
     Delete 'edges' from node's 'id' neighbors
+    Exceptions: will pass raised KeyError if node 'id' is not present
     """
-    pass
+    global swGraph
+    edges = set(edges)
+    swGraph[id] = [neighbor for neighbor in swGraph[id] if neighbor not in edges]
 
 def deleteNodes(nodeIds):
     """
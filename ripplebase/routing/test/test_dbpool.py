@@ -0,0 +1,106 @@
+"""
+Unit test suite for the routing DB connection pool (routing.dbpool.py)
+"""
+import threading
+from twisted.trial import unittest
+
+from routing import dbpool
+from routing.dbpool import ConnectionPool, ConnectionPoolEx, ThreadCursor
+
+class FakeCursor(object):
+    def __init__(self, conn):
+        self.conn = conn
+    def execute(self, sql, params = ()):
+        if self.conn.closed or self.conn.broken:
+            raise Exception("connection lost")
+        self.conn.statements.append(sql)
+    def fetchone(self):
+        return (1,)
+
+class FakeConnection(object):
+    def __init__(self, connect_str):
+        self.statements = []
+        self.closed = self.broken = False
+    def cursor(self):
+        return FakeCursor(self)
+    def autocommit(self):
+        pass
+    def close(self):
+        self.closed = True
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = ConnectionPool("test", max_size = 2, connect_fn = FakeConnection)
+
+    def testCheckoutCheckin(self):
+        first = self.pool.checkout()
+        second = self.pool.checkout()
+        self.assertNotEquals(first.conn, second.conn)
+        self.assertEquals(self.pool.size(), 2)
+        self.assertRaises(ConnectionPoolEx, self.pool.checkout, 0.01)
+        self.pool.checkin(first)
+        self.assertEquals(self.pool.checkout(), first)
+        # broken connections free their slot
+        self.pool.checkin(second, broken = True)
+        self.assert_(second.conn.closed)
+        self.assertEquals(self.pool.size(), 1)
+
+    def testHealthCheck(self):
+        pooled = self.pool.checkout()
+        self.pool.checkin(pooled)
+        pooled.conn.broken = True
+        pooled.last_used -= dbpool.HEALTH_CHECK_INTERVAL + 1
+        replacement = self.pool.checkout()
+        self.assertNotEquals(replacement, pooled)
+        self.assert_(pooled.conn.closed)
+        self.assertEquals(self.pool.size(), 1)
+
+    def testThreadCursors(self):
+        curs = ThreadCursor(self.pool)
+        curs.execute("SELECT 'main'")
+        mainConn = curs.current_connection().conn
+        others = []
+        def work():
+            curs.execute("SELECT 'other'")
+            others.append(curs.current_connection().conn)
+            curs.release()
+        thread = threading.Thread(target = work)
+        thread.start()
+        thread.join()
+        self.assertNotEquals(others[0], mainConn)
+        self.assertEquals(others[0].statements, ["SELECT 'other'"])
+        self.assertEquals(mainConn.statements, ["SELECT 'main'"])
+        self.assertEquals(self.pool.idle_count(), 1)
+        curs.release()
+        self.assertEquals(self.pool.idle_count(), 2)
+
+    def testLazyAndWarmUp(self):
+        self.assertEquals(self.pool.size(), 0)
+        self.pool.warm_up()
+        self.assertEquals((self.pool.size(), self.pool.idle_count()), (1, 1))
+        self.pool.warm_up(5)
+        self.assertEquals((self.pool.size(), self.pool.idle_count()), (2, 2))
+
+    def testMoreThreadsThanConnections(self):
+        # threads that release their connection let others through
+        curs = ThreadCursor(self.pool)
+        otherCurs = ThreadCursor(self.pool)
+        errors = []
+        def work():
+            try:
+                for i in xrange(3):
+                    curs.execute("SELECT 1")
+                    otherCurs.execute("SELECT 2")
+                    if curs.current_connection() is not otherCurs.current_connection():
+                        errors.append("second connection")
+                    curs.release()
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target = work) for i in xrange(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(errors, [])
+        self.assert_(self.pool.size() <= 2)
+        self.assertEquals(self.pool.idle_count(), self.pool.size())
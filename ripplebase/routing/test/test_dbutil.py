@@ -0,0 +1,75 @@
+"""
+Unit test suite for routing DB helpers (routing.dbutil.py)
+"""
+from twisted.trial import unittest
+
+from routing.dbutil import PreparedStatement, int_array
+from routing.dbpool import ConnectionPool, ThreadCursor
+
+class RecordingCursor(object):
+    """
+    Records statements; pretends that nothing has been prepared in the session.
+    """
+    def __init__(self):
+        self.statements = []
+    def execute(self, sql, params = ()):
+        self.statements.append((sql, params))
+    def fetchone(self):
+        return (0,)
+
+class RecordingConnection(object):
+    def __init__(self, connect_str):
+        self.curs = RecordingCursor()
+        self.closed = False
+    def cursor(self):
+        return self.curs
+    def autocommit(self):
+        pass
+    def close(self):
+        self.closed = True
+
+class DBUtilTest(unittest.TestCase):
+    def testIntArray(self):
+        self.assertEquals(int_array([1, 22, 333]), "{1,22,333}")
+        self.assertEquals(int_array(set([]).union([5])), "{5}")
+        self.assertEquals(int_array([]), "{}")
+        self.assertRaises(ValueError, int_array, ["1) OR (1 = 1"])
+
+    def testPreparedOncePerCursor(self):
+        statement = PreparedStatement("test_stmt", ("int4", "int4[]"),
+            "SELECT 1 FROM routing_table WHERE dest_node_id = $1 AND src_node_id = ANY($2)")
+        curs, otherCurs = RecordingCursor(), RecordingCursor()
+        statement.execute(curs, (1, "{2,3}"))
+        statement.execute(curs, (4, "{5}"))
+        statement.execute(otherCurs, (6, "{7}"))
+        self.assertEquals([sql for sql, params in curs.statements], [
+            "SELECT count(*) FROM pg_prepared_statements WHERE name = %s",
+            "PREPARE test_stmt (int4, int4[]) AS SELECT 1 FROM routing_table"
+            " WHERE dest_node_id = $1 AND src_node_id = ANY($2)",
+            "EXECUTE test_stmt (%s, %s)",
+            "EXECUTE test_stmt (%s, %s)"])
+        self.assertEquals(curs.statements[-1][1], (4, "{5}"))
+        self.assertEquals(len(otherCurs.statements), 3)
+        # a new session has to prepare again
+        statement.forget(curs)
+        statement.execute(curs, (1, "{2}"))
+        self.assertEquals(len(curs.statements), 7)
+
+    def testPreparedOncePerPooledConnection(self):
+        statement = PreparedStatement("test_pooled_stmt", ("int4",),
+            "SELECT 1 FROM routing_table WHERE dest_node_id = $1")
+        pool = ConnectionPool("test", max_size = 1, connect_fn = RecordingConnection)
+        curs = ThreadCursor(pool)
+        statement.execute(curs, (1,))
+        statement.execute(curs, (2,))
+        pooled = curs.current_connection()
+        self.assertEquals(len(pooled.cursor.statements), 4)
+        self.assertEquals(pooled.prepared, set(["test_pooled_stmt"]))
+        # nothing is kept by the statement, so a discarded connection goes for good
+        self.assertEquals(statement._prepared_cursors, {})
+        curs.release(broken = True)
+        statement.execute(curs, (3,))
+        newPooled = curs.current_connection()
+        self.failIf(newPooled is pooled)
+        self.assertEquals(len(newPooled.cursor.statements), 3)
+        curs.release()
@@ -0,0 +1,97 @@
+"""
+Unit test suite for the routing data cache (routing.distcache.py)
+"""
+from twisted.trial import unittest
+
+from routing import distcache
+from routing.distcache import DistanceVector, DistanceVectorCache, \
+                              get_distance_vector, get_neighbor_ids
+
+class FakePool(object):
+    connect_str = "test"
+
+class FakeRoutingCursor(object):
+    """
+    Answers distcache queries from a list of routing table rows, counting the
+    routing_table reads.
+    """
+    def __init__(self, rows):
+        self.pool = FakePool()
+        self.rows = rows
+        self.generation = 1
+        self.reads = 0
+        self.res = []
+    def execute(self, sql, params = ()):
+        self.res = []
+        if "pg_tables" in sql or "pg_prepared_statements" in sql:
+            self.res = [(1,)]
+        elif sql == distcache.SQL_GET_GENERATION:
+            self.res = [(self.generation,)]
+        elif sql.startswith("EXECUTE dc_get_distance_vector"):
+            self.reads += 1
+            self.res = sorted([(src, d) for src, dest, d in self.rows if dest == params[0]])
+        elif sql.startswith("EXECUTE dc_get_neighbor_ids"):
+            self.reads += 1
+            self.res = sorted([(dest,) for src, dest, d in self.rows
+                               if src == params[0] and d == 1])
+    def fetchone(self):
+        return self.res[0]
+    def fetchall(self):
+        return self.res
+
+class Vector(object):
+    def __init__(self, nbytes):
+        self._nbytes = nbytes
+    def nbytes(self):
+        return self._nbytes
+
+class DistanceCacheTest(unittest.TestCase):
+    def setUp(self):
+        distcache.cache.clear()
+        distcache._generations.clear()
+        for statement in (distcache.SQL_GET_DISTANCE_VECTOR, distcache.SQL_GET_NEIGHBOR_IDS):
+            statement._prepared_cursors.clear()
+        # 1 -> 2 -> 3, 4 -> 3
+        self.curs = FakeRoutingCursor([(1, 2, 1), (2, 3, 1), (1, 3, 2), (4, 3, 1)])
+
+    def testDistanceVector(self):
+        vector = DistanceVector(3, [(1, 2), (2, 1), (4, 1)])
+        self.assertEquals([vector.get(n) for n in (1, 2, 3, 4, 5)], [2, 1, 0, 1, None])
+
+    def testMemoryBudget(self):
+        cache = DistanceVectorCache(memory_budget = 100)
+        cache.put('a', Vector(40))
+        cache.put('b', Vector(40))
+        cache.get('a')
+        cache.put('c', Vector(40))    # evicts 'b', the least recently used
+        self.assertEquals(sorted(cache.entries), ['a', 'c'])
+        self.assertEquals(cache.size, 80)
+        cache.put('d', Vector(200))   # over budget on its own - not cached
+        self.assertEquals(len(cache), 2)
+
+    def testEvictionOrder(self):
+        cache = DistanceVectorCache(memory_budget = 50)
+        for key in 'abcde':
+            cache.put(key, Vector(10))
+        cache.get('a')
+        cache.put('b', Vector(10))    # replaced - counts as used
+        cache.put('f', Vector(10))    # evicts 'c'
+        cache.put('g', Vector(20))    # evicts 'd' and 'e'
+        self.assertEquals(sorted(cache.entries), ['a', 'b', 'f', 'g'])
+        self.assertEquals(cache.size, 50)
+        cache.clear()
+        cache.put('h', Vector(10))
+        self.assertEquals(cache.entries.keys(), ['h'])
+
+    def testGenerations(self):
+        self.assertEquals(get_distance_vector(self.curs, 3).get(1), 2)
+        self.assertEquals(list(get_neighbor_ids(self.curs, 1)), [2])
+        self.assertEquals(self.curs.reads, 2)
+        get_distance_vector(self.curs, 3)
+        get_neighbor_ids(self.curs, 1)
+        self.assertEquals(self.curs.reads, 2)
+        # a routing table refresh makes the cached entries stale
+        self.curs.generation = 2
+        distcache._generations.clear()
+        get_distance_vector(self.curs, 3)
+        self.assertEquals(self.curs.reads, 3)
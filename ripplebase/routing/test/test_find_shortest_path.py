@@ -4,7 +4,9 @@ Unit test suite for Path Finder find_shortest_path() function (routing.pathfinde
 from twisted.trial import unittest
 from psycopg import connect
 
-from routing.pathfinder import find_shortest_path
+from routing.pathfinder import find_shortest_path, find_shortest_paths, \
+                    load_routing_index, unload_routing_index, PathFinderNoEntryEx
+from routing.smallworld import populate_sw
 from routing.rmanager import ROUTING_DB_CONNECT_STR
 
 
@@ -54,6 +56,55 @@ class FindShortestPathTestSuite(unittest.TestCase):
             
         
         
+    def testFSPRoutingIndex(self):
+        """
+        With a routing index loaded, paths come from memory - even for a graph the
+        routing DB knows nothing about.
+        """
+        populate_sw({100001: [100002], 100002: [100003], 100003: [], 100004: [100001]})
+        load_routing_index()
+        try:
+            self.assertEquals(find_shortest_path(100004, 100003),
+                              (3, [[100004, 100001], [100001, 100002], [100002, 100003]]))
+            self.assertRaises(PathFinderNoEntryEx, find_shortest_path, 100003, 100001)
+        finally:
+            unload_routing_index()
+
+    def testFSPBatch(self):
+        """
+        find_shortest_paths() answers pairs in order, sharing work between pairs with
+        the same destination, and agrees with find_shortest_path() on distances.
+        """
+        global conn, curs
+        curs.execute("SELECT src_node_id, dest_node_id FROM routing_table"
+                     " WHERE distance > 2 ORDER BY dest_node_id, src_node_id LIMIT 20")
+        pairs = curs.fetchall()
+        pairs.append(pairs[0])
+        pairs.append((pairs[0][0], pairs[0][0]))
+        results = find_shortest_paths(pairs)
+        self.assertEquals(len(results), len(pairs))
+        self.assertEquals(results[-1], (0, []))
+        for (src_node_id, dest_node_id), (d, path) in zip(pairs[:-1], results[:-1]):
+            self.assertEquals(d, find_shortest_path(src_node_id, dest_node_id)[0])
+            self.assertEquals(d, len(path))
+            self.assertEquals(path[0][0], src_node_id)
+            self.assertEquals(path[-1][1], dest_node_id)
+            for hop, nextHop in zip(path, path[1:]):
+                self.assertEquals(hop[1], nextHop[0])
+
+    def testFSPBatchRoutingIndex(self):
+        populate_sw({100001: [100002], 100002: [100003], 100003: [], 100004: [100001]})
+        load_routing_index()
+        try:
+            self.assertEquals(find_shortest_paths([(100004, 100003), (100001, 100003),
+                                                   (100003, 100001), (100002, 100003)]),
+                              [(3, [[100004, 100001], [100001, 100002], [100002, 100003]]),
+                               (2, [[100001, 100002], [100002, 100003]]),
+                               None,
+                               (1, [[100002, 100003]])])
+        finally:
+            unload_routing_index()
+
     def testFSPExceptions(self):
         """
         Bunch of tests that check behaviour of the function in exceptional situations.
@@ -0,0 +1,57 @@
+"""
+Unit test suite for the landmark distance oracle (routing.landmarks.py)
+"""
+from twisted.trial import unittest
+
+from routing.smallworld import populate_sw, ids, get_neighbors
+from routing.landmarks import LandmarkOracle
+from routing.test import testroutingmanager
+
+class LandmarkOracleTest(unittest.TestCase):
+    def setUp(self):
+        # reuse the test graph and its distance table
+        control = testroutingmanager.RoutingManagerTest('testRefresh')
+        control.setUp()
+        self.testAdjTable = control.testAdjTable
+        self.controlRTable = control.controlRTable
+        populate_sw(self.testAdjTable)
+
+    def assertBounds(self, oracle):
+        for src, distances in self.controlRTable.items():
+            self.assertEquals(oracle.estimate(src, src), 0)
+            for dest, distance in distances.items():
+                self.assert_(oracle.lower_bound(src, dest) <= distance)
+                self.assert_(oracle.upper_bound(src, dest) >= distance)
+
+    def testLandmarksByDegree(self):
+        oracle = LandmarkOracle.build(ids, get_neighbors, 2)
+        self.assertEquals(oracle.landmarks, [5, 1])
+        self.assertBounds(oracle)
+        # exact for landmarks
+        for dest, distance in self.controlRTable[5].items():
+            self.assertEquals(oracle.estimate(5, dest), distance)
+            self.assertEquals(oracle.lower_bound(5, dest), distance)
+
+    def testAllLandmarksExact(self):
+        oracle = LandmarkOracle.build(ids, get_neighbors, len(self.testAdjTable))
+        for src, distances in self.controlRTable.items():
+            for dest, distance in distances.items():
+                self.assertEquals(oracle.estimate(src, dest), distance)
+
+    def testUnreachableAndUnknown(self):
+        populate_sw({1: [2], 2: [3], 3: [], 4: [1]})
+        oracle = LandmarkOracle.build(ids, get_neighbors, 1)
+        self.assertEquals(oracle.landmarks, [1])
+        self.assertEquals(oracle.estimate(4, 3), 3)
+        self.assertEquals(oracle.estimate(3, 4), None)
+        self.assertEquals(oracle.estimate(1, 100), None)
+        self.assertEquals(oracle.lower_bound(1, 100), 0)
+
+    def testRowsRoundTrip(self):
+        oracle = LandmarkOracle.build(ids, get_neighbors, 3)
+        loaded = LandmarkOracle.from_rows(list(oracle.rows()))
+        self.assertEquals(sorted(loaded.landmarks), sorted(oracle.landmarks))
+        for src, distances in self.controlRTable.items():
+            for dest in distances:
+                self.assertEquals(loaded.estimate(src, dest), oracle.estimate(src, dest))
+                self.assertEquals(loaded.lower_bound(src, dest), oracle.lower_bound(src, dest))
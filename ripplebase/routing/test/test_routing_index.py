@@ -0,0 +1,46 @@
+"""
+Unit test suite for the in-memory routing index (routing.rindex.py)
+"""
+from twisted.trial import unittest
+
+from routing.smallworld import populate_sw, ids, get_neighbors
+from routing.rindex import RoutingIndex, RoutingIndexEx
+from routing.test import testroutingmanager
+
+class RoutingIndexTest(unittest.TestCase):
+    def setUp(self):
+        # reuse the test graph and its distance table
+        control = testroutingmanager.RoutingManagerTest('testRefresh')
+        control.setUp()
+        self.testAdjTable = control.testAdjTable
+        self.controlRTable = control.controlRTable
+        populate_sw(self.testAdjTable)
+        self.index = RoutingIndex(ids, get_neighbors)
+
+    def testLayout(self):
+        self.assertEquals(self.index.nodes_count(), 13)
+        for node, neighbors in self.testAdjTable.items():
+            i = self.index.index_of[node]
+            indexNeighbors = self.index.targets[self.index.offsets[i]:self.index.offsets[i + 1]]
+            self.assertEquals([self.index.node_ids[j] for j in indexNeighbors], neighbors)
+
+    def testShortestPaths(self):
+        for src, distances in self.controlRTable.items():
+            self.assertEquals(self.index.shortest_path(src, src), (0, []))
+            for dest, distance in distances.items():
+                d, path = self.index.shortest_path(src, dest)
+                self.assertEquals(d, distance)
+                self.assertEquals(len(path), distance)
+                self.assertEquals(path[0][0], src)
+                self.assertEquals(path[-1][1], dest)
+                for hop, nextHop in zip(path, path[1:]):
+                    self.assertEquals(hop[1], nextHop[0])
+                for a, b in path:
+                    self.assert_(b in self.testAdjTable[a])
+
+    def testDirectedAndUnreachable(self):
+        populate_sw({0: [1], 1: [2], 2: [], 3: [0]})
+        index = RoutingIndex(ids, get_neighbors)
+        self.assertEquals(index.shortest_path(3, 2), (3, [[3, 0], [0, 1], [1, 2]]))
+        self.assertEquals(index.shortest_path(2, 0), None)
+        self.assertRaises(RoutingIndexEx, index.shortest_path, 0, 42)
@@ -1,8 +1,10 @@
 from twisted.trial import unittest
 from routing.smallworld import ids, populate_sw, get_neighbors, \
-                    InvalidGraphEx
+                    appendEdges, deleteEdges, InvalidGraphEx
 from routing.rmanager import refresh_routing_table, add_distance,\
-                    RoutingTableEx
+                    incremental_add_edge, incremental_remove_edge, get_generation,\
+                    refresh_landmark_table, load_landmark_oracle, RoutingTableEx
+from routing import rmanager
 from psycopg import connect
 
 class RoutingManagerTest(unittest.TestCase):
@@ -82,6 +84,99 @@ class RoutingManagerTest(unittest.TestCase):
         # self.assertEquals(get_table(), self.controlRTable)
         self.curs.execute("SELECT src_node_id, dest_node_id, distance FROM routing_table ORDER BY src_node_id, dest_node_id")
         self.assertEquals(self.curs.fetchall(), self.controlDBRep)
+
+    def testRefreshParallel(self):
+        populate_sw(self.testAdjTable)
+        # small chunks, so that every worker gets a share of the source nodes
+        oldChunkSize = rmanager.ROUTING_WORKER_CHUNK_SIZE
+        rmanager.ROUTING_WORKER_CHUNK_SIZE = 2
+        try:
+            refresh_routing_table(ids, get_neighbors, workers = 3)
+        finally:
+            rmanager.ROUTING_WORKER_CHUNK_SIZE = oldChunkSize
+        self.assertEquals(self.fetch_routing_table(), self.controlDBRep)
+
+    def testRefreshWithoutCopy(self):
+        # a cursor lacking copy_from() makes the loader fall back to batched INSERTs
+        class NoCopyCursor(object):
+            def __init__(self, curs):
+                self.execute = curs.execute
+                self.executemany = curs.executemany
+                self.fetchone = curs.fetchone
+                self.fetchall = curs.fetchall
+        populate_sw(self.testAdjTable)
+        oldCurs, oldBatchSize = rmanager.curs, rmanager.BULK_LOAD_BATCH_SIZE
+        rmanager.curs, rmanager.BULK_LOAD_BATCH_SIZE = NoCopyCursor(oldCurs), 7
+        try:
+            refresh_routing_table(ids, get_neighbors)
+        finally:
+            rmanager.curs, rmanager.BULK_LOAD_BATCH_SIZE = oldCurs, oldBatchSize
+        self.assertEquals(self.fetch_routing_table(), self.controlDBRep)
+
+    def testRefreshSwapsGeneration(self):
+        populate_sw(self.testAdjTable)
+        refresh_routing_table(ids, get_neighbors)
+        generation = get_generation()
+        refresh_routing_table(ids, get_neighbors)
+        self.assertEquals(get_generation(), generation + 1)
+        self.assertEquals(self.fetch_routing_table(), self.controlDBRep)
+        # shadow, retired and staging tables are all gone after the swap
+        self.curs.execute("SELECT count(*) FROM pg_tables WHERE tablename LIKE 'routing_table_%'")
+        self.assertEquals(self.curs.fetchone()[0], 0)
+        self.curs.execute("SELECT count(*) FROM pg_tables WHERE tablename LIKE 'nodes_table_%'")
+        self.assertEquals(self.curs.fetchone()[0], 0)
+        # incremental updates that change the table start a new generation as well
+        appendEdges(0, [12])
+        incremental_add_edge(0, 12)
+        self.assertEquals(get_generation(), generation + 2)
+
+    def testRefreshLandmarks(self):
+        populate_sw(self.testAdjTable)
+        refresh_landmark_table(ids, get_neighbors, 3)
+        oracle = refresh_landmark_table(ids, get_neighbors, 3)
+        loaded = load_landmark_oracle()
+        self.assertEquals(sorted(loaded.rows()), sorted(oracle.rows()))
+        for src, distances in self.controlRTable.items():
+            for dest, distance in distances.items():
+                self.assert_(loaded.lower_bound(src, dest) <= distance <= loaded.upper_bound(src, dest))
+
+    def fetch_routing_table(self):
+        self.curs.execute("SELECT src_node_id, dest_node_id, distance FROM routing_table ORDER BY src_node_id, dest_node_id")
+        return self.curs.fetchall()
+
+    def assertIncrementalMatchesRefresh(self):
+        # compare the incrementally updated table against a full recomputation
+        incrementalRep = self.fetch_routing_table()
+        refresh_routing_table(ids, get_neighbors)
+        self.assertEquals(incrementalRep, self.fetch_routing_table())
+
+    def testIncrementalAddEdge(self):
+        populate_sw(self.testAdjTable)
+        refresh_routing_table(ids, get_neighbors)
+        # shortcut between far ends of the graph (3 -> 7 was 5 hops)
+        appendEdges(3, [7])
+        appendEdges(7, [3])
+        self.assert_(incremental_add_edge(3, 7) > 0)
+        self.assert_(incremental_add_edge(7, 3) > 0)
+        self.assertIncrementalMatchesRefresh()
+        # adding an edge that already exists changes nothing
+        self.assertEquals(incremental_add_edge(3, 7), 0)
+
+    def testIncrementalRemoveEdge(self):
+        populate_sw(self.testAdjTable)
+        refresh_routing_table(ids, get_neighbors)
+        deleteEdges(1, [8])
+        deleteEdges(8, [1])
+        self.assert_(incremental_remove_edge(1, 8) > 0)
+        self.assert_(incremental_remove_edge(8, 1) > 0)
+        self.assertIncrementalMatchesRefresh()
+        # disconnect node 0 entirely - its entries must disappear
+        deleteEdges(0, [1])
+        deleteEdges(1, [0])
+        incremental_remove_edge(0, 1)
+        incremental_remove_edge(1, 0)
+        self.curs.execute("SELECT count(*) FROM routing_table WHERE src_node_id = 0 OR dest_node_id = 0")
+        self.assertEquals(self.curs.fetchone()[0], 0)
         
 #    def testAdd_distance(self):
 #        # *** the function add_distance does not check whether nodeID is valid kind
@@ -0,0 +1,92 @@
+##################
+# Copyright 2008, Jevgenij Solovjov
+#
+# This file is part of Ripplebase.
+#
+# Ripplebase is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ripplebase is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with Ripplebase, in the file LICENSE.txt.  If not,
+# see <http://www.gnu.org/licenses/>.
+##################
+
+from array import array
+
+from twisted.trial import unittest
+
+from ripplebase.payment.creditgraph import CreditGraph
+
+class CreditGraphTest(unittest.TestCase):
+    def setUp(self):
+        # metrix_table rows: (id, src, dest, credit limit)
+        self.graph = CreditGraph([(1, 10, 20, 5.0), (2, 20, 10, 7.5), (3, 10, 30, 1.0),
+                                  (4, 30, 20, 2.0)])
+
+    def testLookups(self):
+        self.assertEquals(sorted(self.graph.neighbors(10)), [20, 30])
+        self.assertEquals(self.graph.neighbors(20), [10])
+        self.assertEquals(self.graph.credit_limit(10, 30), 1.0)
+        self.assertEquals(self.graph.endpoints(4), (30, 20))
+        self.assertEquals(self.graph.endpoints(99), None)
+        self.assertRaises(KeyError, self.graph.credit_limit, 20, 30)
+        self.assertRaises(KeyError, self.graph.neighbors, 40)
+
+    def testChanges(self):
+        self.graph.set_edge(1, 10, 20, 6.0)         # in place
+        self.assertEquals(self.graph.credit_limit(10, 20), 6.0)
+        self.assertEquals(self.graph.overlay_size(), 0)
+        self.graph.set_edge(3, 10, 40, 1.0)         # moved
+        self.graph.set_edge(5, 40, 10, 3.0)         # new node
+        self.graph.remove_edge(2)
+        self.assertEquals(sorted(self.graph.neighbors(10)), [20, 40])
+        self.assertEquals(self.graph.neighbors(20), [])
+        self.assertEquals(self.graph.neighbors(40), [10])
+        self.assertEquals(self.graph.endpoints(3), (10, 40))
+        self.assertEquals(self.graph.endpoints(2), None)
+        self.assertRaises(KeyError, self.graph.credit_limit, 10, 30)
+        self.graph.remove_edge(5)
+        self.assertRaises(KeyError, self.graph.neighbors, 40)
+        compacted = self.graph.compacted()
+        self.assertEquals(sorted(compacted.edges()), sorted(self.graph.edges()))
+        self.assertEquals(sorted(compacted.edges()),
+                          [(1, 10, 20, 6.0), (3, 10, 40, 1.0), (4, 30, 20, 2.0)])
+        self.assertEquals(compacted.overlay_size(), 0)
+
+    def testParallelEdges(self):
+        self.graph.set_edge(5, 30, 10, 2.0)
+        self.graph.set_edge(6, 30, 10, 3.0)        # same endpoints as 5
+        self.assertEquals(self.graph.credit_limit(30, 10), 2.0)
+        self.graph.remove_edge(5)
+        self.assertEquals(self.graph.credit_limit(30, 10), 3.0)
+        self.assertEquals(self.graph.endpoints(6), (30, 10))
+        self.assertEquals(sorted(self.graph.neighbors(30)), [10, 20])
+        self.graph.remove_edge(6)
+        self.assertEquals(self.graph.neighbors(30), [20])
+
+    def testParallelEdgesInRows(self):
+        graph = CreditGraph([(7, 10, 20, 1.0), (3, 10, 20, 4.0), (5, 10, 30, 2.0)])
+        self.assertEquals(graph.credit_limit(10, 20), 4.0)   # edge 3
+        self.assertEquals(graph.neighbors(10), [20, 30])
+        graph.remove_edge(3)
+        self.assertEquals(graph.credit_limit(10, 20), 1.0)
+        self.assertEquals(graph.neighbors(10), [20, 30])
+        graph.set_edge(9, 10, 30, 6.0)     # overlay edge beside edge 5
+        self.assertEquals(graph.credit_limit(10, 30), 6.0)
+        self.assertEquals(graph.neighbors(10), [20, 30])
+        graph.remove_edge(7)
+        self.assertRaises(KeyError, graph.credit_limit, 10, 20)
+
+    def testCapacityStorage(self):
+        graph = CreditGraph([(1, 10, 20, 5), (2, 20, 10, 7)])
+        self.assert_(isinstance(graph.capacities, array))
+        graph.set_edge(1, 10, 20, 10 ** 30)        # too big for a machine word
+        self.assertEquals(graph.credit_limit(10, 20), 10 ** 30)
+        self.assertEquals(graph.credit_limit(20, 10), 7)
@@ -0,0 +1,43 @@
+##################
+# Copyright 2008, Ryan Fugger
+#
+# This file is part of Ripplebase.
+#
+# Ripplebase is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as 
+# published by the Free Software Foundation, either version 3 of the 
+# License, or (at your option) any later version.
+#
+# Ripplebase is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public 
+# License along with Ripplebase, in the file LICENSE.txt.  If not,
+# see <http://www.gnu.org/licenses/>.
+##################
+
+
+from decimal import Decimal as D
+
+from twisted.trial import unittest
+
+from ripplebase.payment.fixedpoint import *
+
+class FixedPointTest(unittest.TestCase):
+    def testConversion(self):
+        self.assertEquals(from_fixed(to_fixed(D('12.5'))), D('12.5'))
+        self.assertEquals(to_fixed(3), 3 * ONE)
+        self.assertEquals(to_fixed('0.1'), to_fixed(0.1))
+        # rounding is towards zero
+        tiny = D(1).scaleb(-SCALE - 1)
+        self.assertEquals(to_fixed(D(1) + tiny), ONE)
+        self.assertEquals(to_fixed(-tiny), 0)
+
+    def testArithmetic(self):
+        self.assertEquals(fixed_mul(to_fixed('1.5'), to_fixed(4)), to_fixed(6))
+        self.assertEquals(fixed_div(to_fixed(6), to_fixed('1.5')), to_fixed(4))
+        third = fixed_div(ONE, to_fixed(3))
+        self.assert_(fixed_mul(third, to_fixed(3)) <= ONE)
+        self.assert_(UNLIMITED > to_fixed(10 ** 6))
@@ -0,0 +1,92 @@
+##################
+# Copyright 2008, Ryan Fugger
+#
+# This file is part of Ripplebase.
+#
+# Ripplebase is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as 
+# published by the Free Software Foundation, either version 3 of the 
+# License, or (at your option) any later version.
+#
+# Ripplebase is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public 
+# License along with Ripplebase, in the file LICENSE.txt.  If not,
+# see <http://www.gnu.org/licenses/>.
+##################
+
+import threading
+import time
+
+from twisted.trial import unittest
+
+from ripplebase.payment.jobs import *
+
+def wait_for(job, status=None, timeout=5.0):
+    "Waits for job to reach status, or to finish."
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if job.status == status or (status is None and job.is_finished()):
+            break
+        time.sleep(0.01)
+
+class JobPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = JobPool(max_workers=1, max_queued=1)
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+
+    def blocking_job(self, job):
+        while not self.release.isSet():
+            job.check()
+            time.sleep(0.01)
+
+    def testRunAndCancel(self):
+        results = []
+        first = self.pool.submit('a', self.blocking_job)
+        wait_for(first, RUNNING)
+        second = self.pool.submit('b', lambda job: results.append(job.key))
+        self.assertRaises(PoolFull, self.pool.submit, 'c', results.append)
+        self.failUnless(self.pool.cancel('a'))
+        wait_for(second)
+        self.assertEquals(first.status, CANCELLED)
+        self.assertEquals(second.status, DONE)
+        self.assertEquals(results, ['b'])
+        self.failIf(self.pool.cancel('b'))
+        self.assertEquals(self.pool.get('b'), second)
+
+    def testTimeoutAndReplace(self):
+        slow = self.pool.submit('a', self.blocking_job, timeout=0.05)
+        wait_for(slow)
+        self.assertEquals(slow.status, TIMED_OUT)
+        first = self.pool.submit('a', self.blocking_job)
+        wait_for(first, RUNNING)
+        second = self.pool.submit('a', lambda job: None)
+        wait_for(second)
+        self.assertEquals(first.status, CANCELLED)
+        self.assertEquals(self.pool.get('a'), second)
+        failing = self.pool.submit('b', lambda job: 1 / 0)
+        wait_for(failing)
+        self.assertEquals(failing.status, FAILED)
+
+    def testReplacedJobFinishesFirst(self):
+        pool = JobPool(max_workers=2)
+        results = []
+        def slow_to_stop(job):
+            # busy with something that doesn't check for cancellation
+            self.release.wait()
+            results.append('old')
+        old = pool.submit('a', slow_to_stop)
+        wait_for(old, RUNNING)
+        new = pool.submit('a', lambda job: results.append('new'))
+        time.sleep(0.1)
+        self.assertEquals(results, [])
+        self.release.set()
+        wait_for(new)
+        self.assertEquals(results, ['old', 'new'])
+        self.assertEquals(new.status, DONE)
@@ -0,0 +1,135 @@
+##################
+# Copyright 2008, Ryan Fugger
+#
+# This file is part of Ripplebase.
+#
+# Ripplebase is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as 
+# published by the Free Software Foundation, either version 3 of the 
+# License, or (at your option) any later version.
+#
+# Ripplebase is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public 
+# License along with Ripplebase, in the file LICENSE.txt.  If not,
+# see <http://www.gnu.org/licenses/>.
+##################
+
+from decimal import Decimal as D
+
+from twisted.trial import unittest
+
+from ripplebase.payment.pathsearch import *
+from ripplebase.payment.fixedpoint import ONE, to_fixed
+
+class DictPathSearch(PathSearch):
+    "Searches forward over {node: [(next_node, available_credit), ...]}."
+    graph = {}
+    
+    def get_next_hop_list(self, node, in_acct, dest_list):
+        return [Hop(Link(node, next_node, (node, next_node), (next_node, node),
+                         self.backward), to_fixed(credit), ONE, [])
+                for next_node, credit in self.graph.get(node, [])]
+
+class PathSearchTest(unittest.TestCase):
+    def setUp(self):
+        DictPathSearch.graph = {
+            'a': [('b', '5'), ('c', '3')],
+            'b': [('d', '4'), ('c', '2')],
+            'c': [('d', '4')],
+        }
+
+    def search(self, amount, **kwargs):
+        ps = DictPathSearch(['a'], ['d'], [D(amount)], [None], backward=False)
+        return ps.find_pathset(**kwargs)[0]
+
+    def testSinglePath(self):
+        pathset = self.search('3')
+        self.assertEquals(pathset.get_decimal_amount(), D('3'))
+        self.assertEquals(len(pathset.path_list), 1)
+
+    def testMultiplePaths(self):
+        pathset = self.search('7')
+        self.assertEquals(pathset.amount, to_fixed(7))
+        for path in pathset.path_list:
+            nodes = [elt.link.src_node for elt in path.element_list]
+            self.assertEquals(nodes[0], 'a')
+            self.assertEquals(path.element_list[-1].link.dest_node, 'd')
+        # no link carries more than its credit
+        used = {}
+        for path in pathset.path_list:
+            for elt in path.element_list:
+                key = (elt.link.src_node, elt.link.dest_node)
+                used[key] = used.get(key, 0) + elt.amount
+        for src, next_list in DictPathSearch.graph.items():
+            for dest, credit in next_list:
+                self.assert_(used.get((src, dest), 0) <= to_fixed(credit))
+
+    def testMaximumAvailable(self):
+        # only 8 can reach 'd'
+        self.assertEquals(self.search('20').amount, to_fixed(8))
+
+    def testReroute(self):
+        # the shortest path u-v takes the only way into v other than
+        # y2's, so reaching the maximum of 2 means rerouting it via w1
+        DictPathSearch.graph = {
+            's': [('u', '1'), ('y1', '1')],
+            'u': [('v', '1'), ('w1', '1')],
+            'v': [('t', '1')],
+            'w1': [('w2', '1')],
+            'w2': [('t', '1')],
+            'y1': [('y2', '1')],
+            'y2': [('v', '1')],
+        }
+        rerouted = []
+        ps = DictPathSearch(['s'], ['t'], [D('3')], [None], backward=False)
+        ps.paths_rerouted = lambda node, pathset: rerouted.append(pathset)
+        pathset = ps.find_pathset()[0]
+        self.assertEquals(pathset.amount, to_fixed(2))
+        self.assertEquals(len(rerouted), 1)
+        self.assertEquals(sorted([[elt.link.dest_node for elt in path.element_list]
+                                  for path in pathset.path_list]),
+                          [['u', 'w1', 'w2', 't'], ['y1', 'y2', 'v', 't']])
+        self.assertEquals([path.amount for path in pathset.path_list],
+                          [to_fixed(1), to_fixed(1)])
+
+    def testPathLength(self):
+        pathset = self.search('8', max_path_length=2)
+        self.assertEquals(pathset.amount, to_fixed(7))
+        for path in pathset.path_list:
+            self.assertEquals(len(path.element_list), 2)
+
+    def testHopLimit(self):
+        self.assertRaises(HopLimitReached, self.search, '3', hops_to_live=1)
+
+    def testExchangeRates(self):
+        # 'a' -> 'b' doubles amounts: its credit of 8 carries 4 path units
+        DictPathSearch.graph = {'a': [('b', '8')], 'b': [('d', '10')]}
+        rates = {'b': to_fixed(2), 'd': ONE}
+        def get_next_hop_list(node, in_acct, dest_list):
+            return [Hop(Link(node, next_node, (node, next_node), (next_node, node),
+                             False), to_fixed(credit), rates[next_node], [])
+                    for next_node, credit in DictPathSearch.graph.get(node, [])]
+        ps = DictPathSearch(['a'], ['d'], [D('5')], [None], backward=False)
+        ps.get_next_hop_list = get_next_hop_list
+        pathset = ps.find_pathset()[0]
+        self.assertEquals(pathset.get_decimal_amount(), D('4'))
+        self.assertEquals([elt.amount for elt in pathset.path_list[0].element_list],
+                          [to_fixed(8), to_fixed(8)])
+
+    def testCreditBelowOnePathUnit(self):
+        # 'a' -> 'b' has less credit than one path unit is worth there
+        DictPathSearch.graph = {'a': [('b', 1)], 'b': [('d', to_fixed(10))]}
+        rates = {'b': 2 * ONE, 'd': ONE}
+        def get_next_hop_list(node, in_acct, dest_list):
+            return [Hop(Link(node, next_node, (node, next_node), (next_node, node),
+                             False), credit, rates[next_node], [])
+                    for next_node, credit in DictPathSearch.graph.get(node, [])]
+        ps = DictPathSearch(['a'], ['d'], [D('5')], [None], backward=False)
+        ps.get_next_hop_list = get_next_hop_list
+        pathset = ps.find_pathset()[0]
+        self.assertEquals(pathset.path_list, [])
+        self.assertEquals(ps.hops_to_live, MAX_HOPS - 1)
@@ -0,0 +1,168 @@
+##################
+# Copyright 2008, Jevgenij Solovjov
+#
+# This file is part of Ripplebase.
+#
+# Ripplebase is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ripplebase is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with Ripplebase, in the file LICENSE.txt.  If not,
+# see <http://www.gnu.org/licenses/>.
+##################
+
+import time
+
+from twisted.trial import unittest
+
+from ripplebase import simplejson
+from ripplebase.payment.pathsetv1 import MetricAccessObject, PathSetCr, \
+     PathGenerator, ContextRegistry, Hop, Edge, CreditGraph, to_fixed
+
+# metrix_table rows: (id, src, dest, credit limit).  The only two-hop
+# path is 101-102-106; two more paths share the 104 -> 106 edge.
+EDGES = [(1, 101, 102, 5), (2, 102, 106, 5), (3, 101, 103, 4), (4, 103, 104, 4),
+         (5, 104, 106, 4), (6, 101, 105, 3), (7, 105, 104, 3)]
+
+class BFSOracle(object):
+    "Exact distances, by breadth-first search."
+    def __init__(self, edges):
+        self.neighbors = {}
+        for edge_id, src, dest, credit in edges:
+            self.neighbors.setdefault(src, []).append(dest)
+
+    def shortest_path(self, src_id, dest_id):
+        parents = {src_id: None}
+        queue = [src_id]
+        for node_id in queue:
+            if node_id == dest_id:
+                path = []
+                while node_id is not None:
+                    path.insert(0, node_id)
+                    node_id = parents[node_id]
+                return path
+            for neighbor_id in self.neighbors.get(node_id, []):
+                if neighbor_id not in parents:
+                    parents[neighbor_id] = node_id
+                    queue.append(neighbor_id)
+        return None
+
+    def estimate(self, src_id, dest_id):
+        path = self.shortest_path(src_id, dest_id)
+        return path and len(path) - 1
+
+def node_ids(path):
+    return [hop.id for hop, edge in path.hop_edge_sequence]
+
+class PathSetTest(unittest.TestCase):
+    "Path searches on an in-memory credit graph, without the routing DB."
+    stubbed = ('credit_graph', 'metric_cache_loaded', 'distance_oracle',
+               'synchronize_delta')
+
+    def setUp(self):
+        self.saved = dict([(name, MetricAccessObject.__dict__[name])
+                           for name in self.stubbed])
+        self.oracle = BFSOracle(EDGES)
+        MetricAccessObject.credit_graph = CreditGraph(
+            [(edge_id, src, dest, to_fixed(credit))
+             for edge_id, src, dest, credit in EDGES])
+        MetricAccessObject.metric_cache_loaded = True
+        MetricAccessObject.distance_oracle = self.oracle
+        MetricAccessObject.synchronize_delta = lambda self: 0
+        # edges cached from an earlier graph are stale
+        MetricAccessObject.generation += 1
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(MetricAccessObject, name, value)
+        MetricAccessObject.generation += 1
+
+    def test_astar_shortest_path(self):
+        for src_id, dest_id in [(101, 106), (103, 106), (101, 104)]:
+            search = PathSetCr(src_id, dest_id)
+            path = search.find_path_astar()
+            self.assertEquals(node_ids(path),
+                              self.oracle.shortest_path(src_id, dest_id))
+            hop_edges = path.hop_edge_sequence[:-1]
+            for (hop, edge), (next_hop, next_edge) in zip(
+                    hop_edges, path.hop_edge_sequence[1:]):
+                self.assertEquals((edge.src.id, edge.dest.id),
+                                  (hop.id, next_hop.id))
+            self.assertEquals(path.credit_limit,
+                              min([edge.credit_limit for hop, edge in hop_edges]))
+            self.failIf(search.astar_interrupted)
+            search.close()
+
+    def test_astar_no_path(self):
+        search = PathSetCr(106, 101)
+        self.assertEquals(search.find_path_astar(), None)
+        self.failIf(search.astar_interrupted)
+        search.close()
+
+    def test_astar_budgets(self):
+        search = PathSetCr(101, 106)
+        self.assertEquals(search.find_path_astar(max_expansions=1), None)
+        self.failUnless(search.astar_interrupted)
+        self.assertEquals(search.expansions, 1)
+        self.assertEquals(search.find_path_astar(deadline=time.time() - 1), None)
+        self.failUnless(search.astar_interrupted)
+        self.assertEquals(search.expansions, 0)
+        search.close()
+        generator = PathGenerator(101, 106, max_expansions=1)
+        self.assertEquals(generator.next_paths(3), [])
+        self.failIf(generator.exhausted)
+        self.failIf(generator.budget_left())
+        generator.close()
+
+    def test_resume(self):
+        generator = PathGenerator(101, 106)
+        first = [node_ids(path) for path in generator.next_paths(1)]
+        checkpoint = simplejson.loads(simplejson.dumps(generator.checkpoint()))
+        generator.close()
+        generator = PathGenerator.resume(checkpoint)
+        rest = [node_ids(path) for path in generator]
+        generator.close()
+        self.assertEquals(first, [[101, 102, 106]])
+        self.assertEquals(rest, [[101, 103, 104, 106]])
+        self.failUnless(generator.exhausted)
+        self.assertEquals(generator.found_paths,
+                          [([101, 102, 106], to_fixed(5)),
+                           ([101, 103, 104, 106], to_fixed(4))])
+        # each path's credit counted once, on each of its edges
+        self.assertEquals(generator.credit_used, {
+            (101, 102): to_fixed(5), (102, 106): to_fixed(5),
+            (101, 103): to_fixed(4), (103, 104): to_fixed(4),
+            (104, 106): to_fixed(4)})
+
+    def test_context_eviction(self):
+        registry = ContextRegistry(10)
+        for context in range(1, 11):
+            registry.get(context)[context] = context
+        registry.get(1)  # now 2 is the least recently used
+        registry.get(11)
+        self.assertEquals(len(registry), 10)
+        self.failIf(2 in registry.dicts)
+        self.assertEquals(registry.get(1), {1: 1})
+        self.assertEquals(registry.get(2), {})  # starts over
+        registry.release([1, 3])
+        self.failIf(1 in registry.dicts or 3 in registry.dicts)
+        self.failIf(1 in registry.last_used or 3 in registry.last_used)
+
+    def test_close_releases_clones(self):
+        search = PathSetCr(101, 106)
+        path = search.find_path_astar()
+        context = path.context
+        self.failUnless(context in Hop._contextual_hop_dicts.dicts)
+        self.failUnless(context in Edge._contextual_edge_dicts.dicts)
+        search.close()
+        self.failIf(context in Hop._contextual_hop_dicts.dicts)
+        self.failIf(context in Edge._contextual_edge_dicts.dicts)
+        # the path keeps its own hops and edges
+        self.assertEquals(node_ids(path), [101, 102, 106])
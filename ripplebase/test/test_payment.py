@@ -0,0 +1,306 @@
+##################
+# Copyright 2008, Ryan Fugger
+#
+# This file is part of Ripplebase.
+#
+# Ripplebase is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ripplebase is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with Ripplebase, in the file LICENSE.txt.  If not,
+# see <http://www.gnu.org/licenses/>.
+##################
+
+import threading
+import time
+from decimal import Decimal as D
+
+import sqlalchemy as sql
+
+from twisted.trial import unittest
+
+from ripplebase import db, settings
+from ripplebase.account.mappers import *
+from ripplebase.account.dao import AccountDAO
+from ripplebase.payment.mappers import *
+from ripplebase.payment.dao import PaymentDAO, PaymentPathDAO
+from ripplebase.payment.pathsearch import Link, PathElement, Path, PathSet
+from ripplebase.payment.fixedpoint import to_fixed
+from ripplebase.payment import resources
+from ripplebase.payment.jobs import *
+from ripplebase.payment.reservations import ReservationLedger
+
+class FakeRequest(object):
+    parsed_content = None
+
+class StopAfterPaths(object):
+    "Stands in for a Job that is cancelled once count paths are stored."
+    def __init__(self, count):
+        self.count = count
+
+    def stopped(self):
+        return db.query(PaymentPath).count() >= self.count
+
+    def check(self):
+        if self.stopped():
+            raise JobStopped()
+
+def wait_for(job, timeout=10.0):
+    deadline = time.time() + timeout
+    while not job.is_finished() and time.time() < deadline:
+        time.sleep(0.05)
+
+class PaymentTest(unittest.TestCase):
+    """Payer and recipient are joined directly, with 30 of credit,
+    and through middle, with 50.
+    """
+    def setUp(self):
+        db.reset()
+        self.client = db.query(Client).filter_by(name=settings.TEST_CLIENT).one()
+        self.cad = db.query(Unit).filter_by(name=u'CAD').one()
+        payer, middle, recipient = [self.make_address(name) for name in
+                                    (u'payer', u'middle', u'recipient')]
+        self.direct = self.connect(payer, recipient, D('30'))
+        self.first = self.connect(payer, middle, D('50'))
+        self.second = self.connect(middle, recipient, D('50'))
+        exchange = Exchange()
+        exchange.source_account = self.first[1]
+        exchange.target_account = self.second[0]
+        exchange.is_active = True
+        self.payer, self.recipient = payer, recipient
+        self.pmt = self.make_payment()
+        self.search_jobs = resources.search_jobs
+        self.account_reservations = resources.account_reservations
+        resources.account_reservations = ReservationLedger()
+
+    def tearDown(self):
+        resources.search_jobs = self.search_jobs
+        resources.account_reservations = self.account_reservations
+        db.close()
+
+    def make_payment(self):
+        "An approved payment of 70 to recipient."
+        payment = Payment()
+        payment.payer = self.payer
+        payment.recipient = self.recipient
+        payment.amount = D('70')
+        payment.amount_for_recipient = True
+        payment.units = u'CAD'
+        payment.status = resources.APPROVED
+        db.commit()
+        return PaymentDAO(payment)
+
+    def make_address(self, name):
+        address = Address()
+        address.address = name
+        address.client = self.client
+        return address
+
+    def connect(self, src, dest, credit):
+        """Makes a relationship between src and dest in which src can
+        pay dest up to credit.  Returns the (src, dest) accounts.
+        """
+        relationship = Relationship()
+        accounts = []
+        for address, other, upper_limit, lower_limit in (
+                (src, dest, D('0'), -credit), (dest, src, credit, D('0'))):
+            account = Account()
+            account.name = u'%s-%s' % (address.address, other.address)
+            account.relationship = relationship
+            account.client = self.client
+            account.is_active = True
+            account.balance = D('0')
+            account.unit = self.cad
+            address.accounts.append(account)
+            limits = AccountLimits()
+            limits.account = account
+            limits.is_active = True
+            limits.upper_limit = upper_limit
+            limits.lower_limit = lower_limit
+            accounts.append(account)
+        db.flush()
+        return accounts
+
+    def make_path(self, hops):
+        "hops is a list of ((src, dest) accounts, amount) in payment order."
+        element_list = []
+        for (src, dest), amount in hops:
+            link = Link(src.id, dest.id, src.id, dest.id, False)
+            element_list.append(PathElement(link, to_fixed(amount),
+                                            to_fixed(amount)))
+        return Path(to_fixed(hops[-1][1]), element_list)
+
+    def test_create_from_pathset(self):
+        pathset = PathSet([
+            self.make_path([(self.first, D('41')), (self.second, D('40'))]),
+            self.make_path([(self.direct, D('30'))])])
+        path_ids = PaymentPathDAO.create_from_pathset(self.pmt.id, pathset)
+        db.commit()
+        self.assertEquals(len(path_ids), 2)
+        self.assertEquals(path_ids, sorted(path_ids))
+        paths = [db.query(PaymentPath).get(path_id) for path_id in path_ids]
+        self.assertEquals([(path.payer_amount, path.recipient_amount)
+                           for path in paths],
+                          [(D('41'), D('40')), (D('30'), D('30'))])
+        for path_id, accounts in zip(path_ids, [[self.first, self.second],
+                                                [self.direct]]):
+            query = sql.select([payment_link_table.c.sequence_number,
+                                payment_link_table.c.paying_account_id,
+                                payment_link_table.c.receiving_account_id],
+                               payment_link_table.c.path_id == path_id,
+                               order_by=[payment_link_table.c.sequence_number])
+            self.assertEquals([tuple(row) for row in db.execute(query)],
+                              [(i, src.id, dest.id) for i, (src, dest)
+                               in enumerate(accounts)])
+        amounts = sql.select([payment_link_table.c.amount],
+                             payment_link_table.c.path_id == path_ids[0],
+                             order_by=[payment_link_table.c.sequence_number])
+        self.assertEquals([row[0] for row in db.execute(amounts)],
+                          [D('41'), D('40')])
+
+    def test_search(self):
+        resources.path_search(self.pmt)
+        paths = resources.get_paths(self.pmt)
+        self.assertEquals(sorted([path['recipient_amount'] for path in paths]),
+                          [D('30'), D('40')])
+        self.assertEquals(sorted([path['paying_account'] for path in paths]),
+                          [u'payer-middle', u'payer-recipient'])
+
+    def test_reservations(self):
+        "Credit on the paths of one payment is held from others."
+        resources.path_search(self.pmt)
+        other = self.make_payment()
+        resources.path_search(other)
+        self.assertEquals([path['recipient_amount']
+                           for path in resources.get_paths(other)], [D('10')])
+        resources.account_reservations.release(self.pmt.id)
+        resources.path_search(other)  # replaces its own paths and holds
+        self.assertEquals(sorted([path['recipient_amount']
+                                  for path in resources.get_paths(other)]),
+                          [D('30'), D('40')])
+
+    def test_partial_results(self):
+        "Paths found before the search stops are kept."
+        self.assertRaises(JobStopped, resources.path_search, self.pmt,
+                          StopAfterPaths(1))
+        self.assertEquals(len(resources.get_paths(self.pmt)), 1)
+
+    def test_search_handler(self):
+        handler = resources.PathSearchHandler(FakeRequest())
+        job_id = handler.post(str(self.pmt.id))['job']['id']
+        db.close()
+        job = resources.search_jobs.get(self.pmt.id)
+        self.assertEquals(job.id, job_id)
+        wait_for(job)
+        db.close()  # see what the search committed
+        result = handler.get(str(self.pmt.id))
+        self.assertEquals(result['job']['status'], DONE)
+        self.assertEquals(len(result['paths']), 2)
+
+    def test_cancel(self):
+        resources.search_jobs = JobPool(max_workers=1)
+        release = threading.Event()
+        resources.search_jobs.submit('other', lambda job: release.wait())
+        handler = resources.PathSearchHandler(FakeRequest())
+        handler.post(str(self.pmt.id))
+        handler.delete(str(self.pmt.id))
+        db.close()
+        release.set()
+        job = resources.search_jobs.get(self.pmt.id)
+        wait_for(job)
+        self.assertEquals(job.status, CANCELLED)
+        self.assertEquals(resources.get_paths(self.pmt), [])
+
+    def balances(self):
+        "Balances by account name, as stored in the database."
+        query = sql.select([account_table.c.name, account_table.c.balance])
+        return dict([(name, balance)
+                     for name, balance in db.execute(query).fetchall()])
+
+    def payment_status(self):
+        query = sql.select([payment_table.c.status],
+                           payment_table.c.id == self.pmt.id)
+        return db.execute(query).fetchone()[0]
+
+    def assert_commit_fails(self, path_ids=None):
+        """commit_payment must raise ValueError and, once rolled back,
+        leave every balance and the payment status alone.
+        """
+        before = self.balances()
+        self.assertRaises(ValueError, resources.commit_payment, self.pmt,
+                          path_ids)
+        db.close()
+        self.assertEquals(self.balances(), before)
+        self.assertEquals(self.payment_status(), resources.APPROVED)
+
+    def test_commit(self):
+        resources.path_search(self.pmt)
+        path_ids = [path['id'] for path in resources.get_paths(self.pmt)]
+        resources.commit_payment(self.pmt, path_ids)
+        db.commit()
+        self.assertEquals(self.balances(), {
+            u'payer-recipient': D('-30'), u'recipient-payer': D('30'),
+            u'payer-middle': D('-40'), u'middle-payer': D('40'),
+            u'middle-recipient': D('-40'), u'recipient-middle': D('40')})
+        self.assertEquals(self.payment_status(), resources.COMPLETED)
+
+    def test_commit_twice(self):
+        resources.path_search(self.pmt)
+        resources.commit_payment(self.pmt)
+        db.commit()
+        balances = self.balances()
+        self.assertRaises(ValueError, resources.commit_payment, self.pmt)
+        db.close()
+        self.assertEquals(self.balances(), balances)
+
+    def test_commit_handler(self):
+        "Holds on the paths' credit go once the commit is done."
+        resources.path_search(self.pmt)
+        request = FakeRequest()
+        request.parsed_content = {'paths': [-1]}
+        handler = resources.PaymentCommitHandler(request)
+        self.assertRaises(ValueError, handler.post, str(self.pmt.id))
+        db.close()
+        self.assertEquals(len(resources.account_reservations), 1)
+        handler = resources.PaymentCommitHandler(FakeRequest())
+        self.assertEquals(handler.post(str(self.pmt.id))['status'],
+                          resources.COMPLETED)
+        self.assertEquals(len(resources.account_reservations), 0)
+        db.close()
+        self.assertEquals(self.payment_status(), resources.COMPLETED)
+
+    def test_commit_limit_exceeded(self):
+        "Limits lowered after the search are checked at commit."
+        resources.path_search(self.pmt)
+        AccountDAO(self.first[0]).update(lower_limit=D('-10'))
+        db.flush()
+        db.commit()
+        limits = db.query(AccountLimits).filter_by(
+            account=self.first[0]).order_by(AccountLimits.id).all()
+        self.assertEquals([(l.is_active, l.upper_limit, l.lower_limit)
+                           for l in limits],
+                          [(False, D('0'), D('-50')), (True, D('0'), D('-10'))])
+        self.assert_commit_fails()
+
+    def test_commit_paths_changed(self):
+        resources.path_search(self.pmt)
+        path_ids = [path['id'] for path in resources.get_paths(self.pmt)]
+        self.assert_commit_fails(path_ids[:1])
+
+    def test_commit_inactive_account(self):
+        resources.path_search(self.pmt)
+        self.second[1].is_active = False
+        db.flush()
+        db.commit()
+        self.assert_commit_fails()
+
+    def test_commit_without_paths(self):
+        "Nothing stored carries the payment amount."
+        self.assert_commit_fails()
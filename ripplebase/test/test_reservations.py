@@ -0,0 +1,59 @@
+##################
+# Copyright 2008, Jevgenij Solovjov
+#
+# This file is part of Ripplebase.
+#
+# Ripplebase is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ripplebase is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with Ripplebase, in the file LICENSE.txt.  If not,
+# see <http://www.gnu.org/licenses/>.
+##################
+
+from twisted.trial import unittest
+
+from ripplebase.payment.reservations import ReservationLedger
+
+class ReservationLedgerTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.ledger = ReservationLedger(ttl = 10, clock = lambda: self.now)
+
+    def testReserveRelease(self):
+        self.ledger.reserve_path('p1', [1, 2, 3], 5)
+        self.ledger.reserve_path('p2', [1, 2], 2)
+        self.assertEquals(self.ledger.get_reserved(1, 2), 7)
+        self.assertEquals(self.ledger.get_reserved(1, 2, exclude_payment_id = 'p1'), 2)
+        self.assertEquals(self.ledger.get_reserved(2, 3), 5)
+        version = self.ledger.version
+        self.ledger.release('p1')
+        self.assertNotEquals(self.ledger.version, version)
+        self.assertEquals(self.ledger.get_reserved(1, 2), 2)
+        self.assertEquals(self.ledger.get_reserved(2, 3), 0)
+
+    def testExpiry(self):
+        self.ledger.reserve_path('p1', [1, 2], 5)
+        self.now += 6
+        self.ledger.reserve_path('p2', [1, 2], 1)
+        self.ledger.renew('p1')
+        self.now += 6
+        self.assertEquals(self.ledger.get_reserved(1, 2), 6)
+        self.now += 6
+        self.assertEquals(self.ledger.get_reserved(1, 2), 0)
+        self.assertEquals(len(self.ledger), 0)
+
+    def testListeners(self):
+        changes = []
+        self.ledger.listeners.append(changes.append)
+        self.ledger.reserve_path('p1', [1, 2, 3], 5)
+        self.ledger.release('p1')
+        self.assertEquals(changes[0], [(1, 2), (2, 3)])
+        self.assertEquals(sorted(changes[1]), [(1, 2), (2, 3)])